@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Admission control for the web app: caps in-flight requests per route class
+and sheds load with fast 503 responses instead of letting latency grow
+without bound when the database pool is saturated.
+
+    admission = Admission()
+    app = web.Application(middlewares=[response_cache, admission.middleware, response_factory])
+
+Requests are classified as 'read' (GET/HEAD) or 'write' (everything else),
+or by @get(..., admission='name') / @post(..., admission='name'). Each class
+has its own in-flight limit, so reads can never take the slots that writes
+need. When a class is full, requests wait in a FIFO queue:
+    - a request that waits longer than the class target is rejected
+    - once every request in the last interval waited at least the target
+      (a standing queue), new requests are rejected without queueing
+    - while a higher-priority class is queueing, or is using a saturated
+      orm pool, lower-priority requests are rejected instead of queueing
+Rejected requests get 503 with Retry-After.
+'''
+
+import asyncio, logging, math, time
+
+from collections import deque
+
+from aiohttp import web
+
+import orm
+from metrics import Histogram
+
+class RouteClass(object):
+    """一类路由的准入配置和状态"""
+
+    def __init__(self, name, limit, max_queue, target, priority=0, pool_timeout=None, interval=1.0):
+        """初始化
+
+        :param name:类名
+        :param limit:同时处理的请求数上限
+        :param max_queue:排队的请求数上限
+        :param target:排队时间目标（秒），超出时拒绝
+        :param priority:优先级，更高优先级的类排队或正在使用已满的链接池时，本类请求不再排队
+        :param pool_timeout:本类请求等待数据库链接的最长时间（秒），为None时使用orm.create_pool()的设置
+        :param interval:判断是否持续排队的时间窗口（秒）
+        """
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.target = target
+        self.priority = priority
+        self.pool_timeout = pool_timeout
+        self.interval = interval
+        self.in_flight = 0
+        self.waiters = deque()          # 排队请求的future，按到达顺序
+        self.admitted = 0
+        self.queued = 0                 # 排过队的请求数
+        self.shed = 0
+        self.pool_timeouts = 0
+        self.delay = Histogram()        # 排队时间
+        self.overloaded = False         # 上一个窗口内所有请求的排队时间都达到目标
+        self._window_start = time.monotonic()
+        self._window_min = 0.0
+
+    def observe(self, delay):
+        """记录一次排队时间，每个窗口结束时更新是否持续排队
+
+        :param delay:排队时间（秒）
+        :return:
+        """
+        self.delay.observe(delay)
+        now = time.monotonic()
+        if now - self._window_start >= self.interval:
+            self.overloaded = self._window_min >= self.target
+            self._window_start = now
+            self._window_min = delay
+        elif delay < self._window_min:
+            self._window_min = delay
+
+    def release(self):
+        """请求处理完成，把名额交给下一个排队的请求
+
+        :return:
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)     # 名额直接转交，in_flight不变
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return dict(in_flight=self.in_flight, waiting=len(self.waiters), admitted=self.admitted,
+                    queued=self.queued, shed=self.shed, pool_timeouts=self.pool_timeouts,
+                    overloaded=self.overloaded, queue_delay=self.delay.snapshot())
+
+def default_classes():
+    """默认的路由类：读请求多但可以快速失败，写请求少但排队时间更长、优先级更高
+
+    :return:RouteClass列表
+    """
+    return [RouteClass('read', limit=64, max_queue=128, target=0.05, priority=0),
+            RouteClass('write', limit=16, max_queue=64, target=0.5, priority=1)]
+
+class Admission(object):
+    """准入控制中间件"""
+
+    def __init__(self, classes=None, retry_after=1.0, exempt=('/static/',)):
+        """初始化
+
+        :param classes:RouteClass列表，默认为default_classes()
+        :param retry_after:拒绝时Retry-After头的秒数
+        :param exempt:不做准入控制的路径前缀
+        """
+        self.classes = {c.name: c for c in classes or default_classes()}
+        self.retry_after = retry_after
+        self.exempt = tuple(exempt)
+
+    def classify(self, request):
+        """确定请求所属的路由类
+
+        :param request:请求
+        :return:RouteClass
+        """
+        name = getattr(request.match_info.handler, '_admission', None)
+        if name is None:
+            name = 'read' if request.method in ('GET', 'HEAD') else 'write'
+        try:
+            return self.classes[name]
+        except KeyError:
+            raise ValueError('Unknown admission class: %s' % name)
+
+    def contended(self, rc):
+        """是否有更高优先级的类在争用资源
+
+        :param rc:RouteClass
+        :return:
+        """
+        higher = [c for c in self.classes.values() if c.priority > rc.priority]
+        if any(c.waiters for c in higher):
+            return True
+        return any(c.in_flight for c in higher) and orm.pool_saturated()
+
+    async def enter(self, rc):
+        """申请处理名额
+
+        :param rc:RouteClass
+        :return:获得名额时返回True，被拒绝时返回False
+        """
+        if rc.in_flight < rc.limit and not rc.waiters:
+            rc.in_flight += 1
+            rc.admitted += 1
+            rc.observe(0.0)
+            return True
+        if len(rc.waiters) >= rc.max_queue or rc.overloaded or self.contended(rc):
+            rc.shed += 1
+            return False
+        waiter = asyncio.get_event_loop().create_future()
+        rc.waiters.append(waiter)
+        rc.queued += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait((waiter,), timeout=rc.target)
+        except asyncio.CancelledError:      # 客户端断开
+            if waiter.done():
+                rc.release()
+            else:
+                self._abandon(rc, waiter)
+            raise
+        rc.observe(time.monotonic() - start)
+        if not waiter.done():               # 超时
+            self._abandon(rc, waiter)
+            rc.shed += 1
+            return False
+        rc.admitted += 1
+        return True
+
+    def _abandon(self, rc, waiter):
+        """放弃排队：从队列中移除，否则会继续计入排队数，并让contended()误以为仍有请求在排队
+
+        :param rc:RouteClass
+        :param waiter:排队的future
+        :return:
+        """
+        waiter.cancel()
+        if waiter in rc.waiters:
+            rc.waiters.remove(waiter)
+
+    def reject(self, rc, reason):
+        logging.debug('shed %s request (%s)', rc.name, reason)
+        return web.Response(status=503, text='Service Unavailable: %s' % reason,
+                            headers={'Retry-After': str(int(math.ceil(self.retry_after)))})
+
+    async def middleware(self, app, handler):
+        """aiohttp中间件，放在response_factory之前
+
+        :param app:web Application
+        :param handler:下一级处理函数
+        :return:
+        """
+        async def admit(request):
+            if request.path.startswith(self.exempt):
+                return await handler(request)
+            rc = self.classify(request)
+            if not await self.enter(rc):
+                return self.reject(rc, 'overloaded')
+            try:
+                if rc.pool_timeout is None:
+                    return await handler(request)
+                with orm.acquire_timeout(rc.pool_timeout):
+                    return await handler(request)
+            except orm.PoolTimeoutError:
+                rc.pool_timeouts += 1
+                rc.shed += 1
+                return self.reject(rc, 'database busy')
+            finally:
+                rc.release()
+        return admit
+
+    def stats(self):
+        """各路由类的准入统计
+
+        :return:类名 ==> 处理中/排队中/放行/排过队/拒绝/等待链接超时次数及排队时间分布
+        """
+        return {name: rc.stats() for name, rc in self.classes.items()}
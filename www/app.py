@@ -10,16 +10,35 @@ from datetime import datetime
 
 from aiohttp import web
 
+import ids, orm
+from admission import Admission
+from coroweb import response_cache, response_factory, purge_cache
+
 def index(request):
     return web.Response(body=b'<h1>Awesome</h1>', content_type='text/html')
 
-async def init(loop):
-    app = web.Application(loop=loop)
+def create_app(admission=None):
+    """创建web Application
+
+    :param admission: 准入控制，默认为Admission()，统计信息通过app['admission'].stats()获取
+    :return:
+    """
+    admission = admission or Admission()
+    app = web.Application(middlewares=[response_cache, admission.middleware, response_factory])  # 缓存命中的请求不占用名额
+    app['admission'] = admission
+    orm.add_change_listener(lambda model, action, objs: purge_cache(tag=model.__table__))  # 数据变更时清除对应表的响应缓存
     app.router.add_route('GET', '/', index)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    return app
+
+async def init(loop):
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 9000).start()
     logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    return runner
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
\ No newline at end of file
+if __name__ == '__main__':
+    ids.set_worker_id(int(os.environ.get('WORKER_ID', 0)))     # 单进程运行，默认使用0号worker编号；多进程部署使用server.py
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
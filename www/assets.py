@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Static file serving and the offline asset build step.
+
+Build hashed and precompressed assets before deploying:
+    python3 assets.py build [static_dir]
+'''
+
+import asyncio, gzip, hashlib, json, logging, mimetypes, os, re, sys
+
+from collections import OrderedDict
+
+from aiohttp import web
+
+try:
+    import brotli   # 可选依赖，未安装时不生成.br文件
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'      # 原文件名 ==> 带内容哈希的文件名
+HASHED_RE = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.xml', '.txt', '.html', '.map', '.ttf', '.eot')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))    # 按优先级排列
+
+def hashed_name(rel, data):
+    """生成带内容哈希的文件名
+
+    :param rel:相对路径，例如：css/app.css
+    :param data:文件内容
+    :return:例如：css/app.0123456789ab.css
+    """
+    base, ext = os.path.splitext(rel)
+    return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:12], ext)
+
+def accepted_encodings(header):
+    """解析Accept-Encoding请求头
+
+    :param header:例如：'gzip;q=1.0, br;q=0, *;q=0.5'
+    :return:ENCODINGS中客户端接受（q值大于0）的编码集合
+    """
+    quality = dict()
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0     # 无法解析的q值视为不接受
+        quality[coding] = q
+    wildcard = quality.get('*', 0.0)
+    return {encoding for encoding, ext in ENCODINGS if quality.get(encoding, wildcard) > 0}
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _compress(path, data):
+    """在文件旁生成.gz和.br压缩版本
+
+    :param path:文件路径
+    :param data:文件内容
+    :return:
+    """
+    _write(path + '.gz', gzip.compress(data, 9, mtime=0))
+    if brotli is not None:
+        _write(path + '.br', brotli.compress(data))
+
+def build(root):
+    """离线构建静态资源
+
+    为每个文件生成带内容哈希的副本，为可压缩的文件生成.gz/.br版本，并写入manifest.json
+
+    :param root:静态文件目录
+    :return:manifest字典
+    """
+    manifest = dict()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            if rel == MANIFEST or HASHED_RE.search(rel) or filename.endswith(('.gz', '.br')):
+                continue    # 跳过上次构建的产物
+            with open(path, 'rb') as f:
+                data = f.read()
+            hashed = hashed_name(rel, data)
+            _write(os.path.join(root, hashed), data)
+            if filename.endswith(COMPRESSIBLE):
+                _compress(path, data)
+                _compress(os.path.join(root, hashed), data)
+            manifest[rel] = hashed
+            logging.info('build asset %s => %s' % (rel, hashed))
+    with open(os.path.join(root, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+class StaticFiles(object):
+    """静态文件处理函数
+
+    - 客户端支持时返回预先压缩的.br/.gz版本
+    - 带内容哈希的文件使用一年有效期的immutable缓存头
+    - 小文件保存在LRU内存缓存中，大文件通过FileResponse以sendfile零拷贝发送
+    """
+
+    def __init__(self, root, prefix='/static/', memory_limit=32 * 1024 * 1024, small_file=64 * 1024, max_age=3600):
+        """初始化
+
+        :param root:静态文件目录
+        :param prefix:URL前缀
+        :param memory_limit:内存缓存的总字节数上限
+        :param small_file:不超过该大小的文件放入内存缓存
+        :param max_age:不带内容哈希的文件的缓存时间（秒）
+        """
+        self.root = os.path.realpath(root)
+        self.prefix = prefix
+        self.memory_limit = memory_limit
+        self.small_file = small_file
+        self.max_age = max_age
+        self.manifest = dict()
+        manifest = os.path.join(self.root, MANIFEST)
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                self.manifest = json.load(f)
+        self._hashed = set(self.manifest.values())
+        self._cache = OrderedDict()     # (相对路径, 编码) ==> (内容, 修改时间, ETag, Content-Type)
+        self._cache_size = 0
+
+    def url(self, name):
+        """获取静态文件的URL，构建过的文件返回带内容哈希的URL
+
+        :param name:相对路径，例如：css/app.css
+        :return:
+        """
+        return self.prefix + self.manifest.get(name, name)
+
+    def _resolve(self, rel):
+        path = os.path.realpath(os.path.join(self.root, rel))
+        if not path.startswith(self.root + os.sep):     # 禁止访问静态目录之外的文件
+            return None
+        return path
+
+    def _choose(self, request, path):
+        """选择要发送的文件版本
+
+        :return:(文件路径, Content-Encoding, stat结果)
+        """
+        accept = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+        for encoding, ext in ENCODINGS:
+            if encoding in accept:
+                try:
+                    return path + ext, encoding, os.stat(path + ext)
+                except OSError:
+                    pass
+        return path, None, os.stat(path)
+
+    def _headers(self, rel, encoding):
+        headers = {'Vary': 'Accept-Encoding'}
+        if rel in self._hashed or HASHED_RE.search(rel):
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'public, max-age=%d' % self.max_age
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return headers
+
+    def _remember(self, key, entry):
+        if key in self._cache:
+            self._cache_size -= len(self._cache.pop(key)[0])
+        self._cache[key] = entry
+        self._cache_size += len(entry[0])
+        while self._cache_size > self.memory_limit:
+            self._cache_size -= len(self._cache.popitem(last=False)[1][0])
+
+    async def __call__(self, request):
+        rel = request.match_info['filename']
+        path = self._resolve(rel)
+        if path is None:
+            raise web.HTTPForbidden()
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        filepath, encoding, st = self._choose(request, path)
+        headers = self._headers(rel, encoding)
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if st.st_size > self.small_file:                    # 大文件使用sendfile
+            headers['Content-Type'] = content_type
+            return web.FileResponse(filepath, headers=headers)
+        key = (rel, encoding)
+        entry = self._cache.get(key)
+        if entry is None or entry[1] != st.st_mtime_ns:     # 未缓存或文件已修改
+            loop = asyncio.get_event_loop()
+            body = await loop.run_in_executor(None, _read, filepath)
+            entry = (body, st.st_mtime_ns, '"%x-%x"' % (st.st_mtime_ns, st.st_size), content_type)
+            self._remember(key, entry)
+        else:
+            self._cache.move_to_end(key)
+        body, mtime, etag, content_type = entry
+        headers['ETag'] = etag
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, headers=headers, content_type=content_type)
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != 'build':
+        print('Usage: python3 assets.py build [static_dir]')
+        sys.exit(1)
+    build(sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
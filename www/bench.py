@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks for orm and coroweb.
+
+Usage:
+    python3 bench.py                                   # run every benchmark that needs no database server
+    python3 bench.py save_many --user www-data --password www-data --db awesome
+    python3 bench.py save_many pagination --fake       # run database benchmarks against fakedb
+    python3 bench.py --json after.json --baseline before.json
+'''
+
+import argparse, asyncio, json, logging, os, platform, socket, sys, tempfile, time, tracemalloc, uuid
+
+from urllib import parse
+
+import aiohttp
+from aiohttp import web
+from multidict import MultiDict, MultiDictProxy
+
+import fakedb
+import ids
+import orm
+import schema
+import sqlitedb
+from coroweb import add_route, get, make_request_handler, response_cache, response_factory
+from models import Blog, Comment
+
+BENCHMARKS = {}
+
+def benchmark(name, db=False):
+    """注册基准测试
+
+    :param name: 基准测试名称
+    :param db: 是否需要数据库链接，'fake'表示总是使用fakedb
+    :return:
+    """
+    def decorator(func):
+        func.__bench_db__ = db
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+def result(case, seconds, ops, latencies=None):
+    """生成一条测试结果
+
+    :param case: 测试用例说明
+    :param seconds: 耗时（秒）
+    :param ops: 操作次数
+    :param latencies: 每次操作的耗时列表（秒），提供时计算p50/p99
+    :return: 结果字典
+    """
+    r = dict(case=case, seconds=seconds, ops=ops, ops_per_sec=ops / seconds if seconds else 0.0)
+    if latencies:
+        latencies = sorted(latencies)
+        r['p50'] = latencies[int(0.50 * (len(latencies) - 1))]
+        r['p99'] = latencies[int(0.99 * (len(latencies) - 1))]
+    return r
+
+def legacy_select_sql(cls, where=None, args=None, **kw):
+    """findAll()原来的SQL拼接方式，作为对照
+
+    :param cls: 模型类
+    :return: (转换占位符后的查询语句, 参数值)
+    """
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if args is None:
+        args = []
+    orderBy = kw.get('orderBy', None)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    limit = kw.get('limit', None)
+    if limit is not None:
+        sql.append('limit')
+        if isinstance(limit, int):
+            sql.append('?')
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            sql.append('?, ?')
+            args.extend(limit)
+    return ' '.join(sql).replace('?', '%s'), args
+
+@benchmark('sql')
+async def bench_sql(args):
+    """比较每次拼接SQL与按查询形态缓存已编译SQL的开销
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    n = args.iterations
+    start = time.perf_counter()
+    for i in range(n):
+        legacy_select_sql(Blog, '`user_id`=?', ['u'], orderBy='created_at desc', limit=(i, 10))
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(n):
+        orm.driver_sql(Blog._selectSQL('`user_id`=?', ['u'], orderBy='created_at desc', limit=(i, 10))[0])
+    compiled_seconds = time.perf_counter() - start
+    return [result('build + replace per call', legacy_seconds, n),
+            result('compiled query cache', compiled_seconds, n)]
+
+@benchmark('records')
+async def bench_records(args):
+    """比较由字典行构造Model对象与由元组行构造__record__对象的速度和内存占用
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    columns = Blog.__record__._fields
+    rows = [tuple('%s-%d' % (c, i) for c in columns) for i in range(args.rows)]
+    results = []
+    for case, hydrate in (('Model(**dict_row)', lambda: [Blog(**dict(zip(columns, r))) for r in rows]),
+                          ('__record__._make(tuple_row)', lambda: list(map(Blog.__record__._make, rows)))):
+        tracemalloc.start()
+        objs = hydrate()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del objs
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            hydrate()
+        r = result('%s, %d bytes/row' % (case, memory // args.rows), time.perf_counter() - start, args.rows * args.repeat)
+        results.append(r)
+    return results
+
+class FakeRequest(object):
+    """只提供RequestHandler用到的属性的请求对象（不支持multipart请求体）"""
+
+    def __init__(self, method, query=None, json_body=None, form=None, match_info=None):
+        self.method = method
+        self.query = MultiDictProxy(MultiDict(query or {}))
+        self.query_string = parse.urlencode(query or {})
+        self.match_info = match_info or {}
+        self.content_type = 'application/json' if json_body is not None else \
+            'application/x-www-form-urlencoded' if form is not None else 'application/octet-stream'
+        self._body = json.dumps(json_body) if json_body is not None else None
+        self._form = form
+
+    async def json(self):
+        return json.loads(self._body)
+
+    async def post(self):
+        return MultiDictProxy(MultiDict(self._form or {}))
+
+async def api_blogs(*, page='1'):
+    return dict(page=page)
+
+async def api_register_user(*, email, name, passwd):
+    return dict(email=email, name=name)
+
+async def api_blog_comments(id, request, *, content):
+    return dict(id=id, content=content)
+
+@benchmark('handler')
+async def bench_handler(args):
+    """测量经过RequestHandler的请求速度（不含网络和路由）
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    cases = (
+        ('GET query', api_blogs, lambda: FakeRequest('GET', query=dict(page='2', size='10'))),
+        ('JSON POST', api_register_user,
+         lambda: FakeRequest('POST', json_body=dict(email='a@b.c', name='a', passwd='x' * 40))),
+        ('form POST', api_blog_comments,
+         lambda: FakeRequest('POST', form=dict(content='hello'), match_info=dict(id='001'))),
+    )
+    results = []
+    for case, fn, make_request in cases:
+        handler = make_request_handler(None, fn)
+        requests = [make_request() for _ in range(1000)]
+        n = args.iterations // 10
+        start = time.perf_counter()
+        for i in range(n):
+            await handler(requests[i % 1000])
+        results.append(result(case, time.perf_counter() - start, n))
+    return results
+
+@benchmark('save_many', db=True)
+async def bench_save_many(args):
+    """比较逐条save()与save_many()的写入速度
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    def make_comments():
+        return [Comment(blog_id='bench', user_id='bench', user_name='bench', user_image='', content='x' * 200)
+                for _ in range(args.rows)]
+
+    comments = make_comments()
+    start = time.perf_counter()
+    for c in comments:
+        await c.save()
+    loop_seconds = time.perf_counter() - start
+
+    comments = make_comments()
+    start = time.perf_counter()
+    await Comment.save_many(comments, batch_size=args.batch_size)
+    batch_seconds = time.perf_counter() - start
+
+    await orm.execute('delete from `comments` where `blog_id`=?', ['bench'])    # 清理测试数据
+    return [result('save() x %d' % args.rows, loop_seconds, args.rows),
+            result('save_many(batch_size=%d)' % args.batch_size, batch_seconds, args.rows)]
+
+@benchmark('pagination', db=True)
+async def bench_pagination(args):
+    """比较LIMIT偏移分页与findPage()键集分页翻到最后一页的速度
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    await Comment.save_many([Comment(blog_id='bench', user_id='bench', user_name='bench', user_image='', content='')
+                             for _ in range(args.rows)], batch_size=args.batch_size)
+    pages = args.rows // args.page_size
+
+    start = time.perf_counter()
+    for page in range(pages):
+        await Comment.findAll('`blog_id`=?', ['bench'], orderBy='created_at desc, id desc',
+                              limit=(page * args.page_size, args.page_size))
+    offset_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    await Comment.findAll('`blog_id`=?', ['bench'], orderBy='created_at desc, id desc',
+                          limit=((pages - 1) * args.page_size, args.page_size))
+    offset_last = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cursor = last_cursor = None
+    for page in range(pages):
+        last_cursor = cursor
+        items, cursor = await Comment.findPage('`blog_id`=?', ['bench'], after=cursor, size=args.page_size)
+    keyset_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    await Comment.findPage('`blog_id`=?', ['bench'], after=last_cursor, size=args.page_size)
+    keyset_last = time.perf_counter() - start
+
+    await orm.execute('delete from `comments` where `blog_id`=?', ['bench'])    # 清理测试数据
+    return [result('limit offset, all %d pages' % pages, offset_seconds, pages),
+            result('findPage(), all %d pages' % pages, keyset_seconds, pages),
+            result('limit offset, last page', offset_last, 1),
+            result('findPage(), last page', keyset_last, 1)]
+
+def legacy_id():
+    """models.next_id()原来的ID生成方式，作为对照"""
+    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+@benchmark('ids')
+async def bench_ids(args):
+    """比较旧ID与时间有序ID的生成速度
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    results = []
+    for case, fn in (('legacy 50-char id', legacy_id), ('ids.next_id()', ids.next_id),
+                     ('ids.next_id_str()', ids.next_id_str)):
+        n = args.iterations
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        results.append(result(case, time.perf_counter() - start, n))
+    return results
+
+@benchmark('insert_ids', db=True)
+async def bench_insert_ids(args):
+    """比较使用旧ID和时间有序ID作为主键时的写入速度
+
+    每张测试表都带有一个二级索引，测试结束后删除
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    results = []
+    for case, ddl, make_id in (('varchar(50) legacy id', 'varchar(50)', legacy_id),
+                               ('char(20) ids.next_id_str()', 'char(20)', ids.next_id_str),
+                               ('bigint ids.next_id()', 'bigint', ids.next_id)):
+        await orm.execute('drop table if exists `bench_ids`', [])
+        await orm.execute('create table `bench_ids` (`id` %s not null primary key, `user_id` %s not null, '
+                          '`created_at` real not null, key `idx_user_id` (`user_id`)) engine=innodb' % (ddl, ddl), [])
+        rows = [(make_id(), make_id(), time.time()) for _ in range(args.rows)]
+        start = time.perf_counter()
+        await orm.executemany('insert into `bench_ids` (`id`, `user_id`, `created_at`) values (?, ?, ?)',
+                              rows, batch_size=args.batch_size)
+        results.append(result(case, time.perf_counter() - start, args.rows))
+    await orm.execute('drop table if exists `bench_ids`', [])
+    return results
+
+@benchmark('orm', db='fake')
+async def bench_orm(args):
+    """通过fakedb测量orm每次查询的开销（SQL生成、驱动调用、统计、对象构造）
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    cases = (
+        ('select() %d dict rows' % args.fetch_rows, lambda: orm.select(Blog.__select__, [])),
+        ('findAll() %d rows' % args.fetch_rows, lambda: Blog.findAll('`user_id`=?', ['u'], orderBy='created_at desc', limit=10)),
+        ('findRecords() %d rows' % args.fetch_rows, lambda: Blog.findRecords('`user_id`=?', ['u'], orderBy='created_at desc', limit=10)),
+        ('findAll(fields=...) %d rows' % args.fetch_rows, lambda: Blog.findAll('`user_id`=?', ['u'], orderBy='created_at desc', limit=10,
+                                                                        fields=['name', 'summary', 'created_at'])),
+        ('find()', lambda: Blog.find('blog-0')),
+        ('save()', lambda: Blog(user_id='u', user_name='u', user_image='', name='n', summary='s', content='c').save()),
+    )
+    results = []
+    n = args.iterations // 10
+    for case, call in cases:
+        await call()    # 预热查询形态缓存
+        start = time.perf_counter()
+        for _ in range(n):
+            await call()
+        results.append(result(case, time.perf_counter() - start, n))
+    return results
+
+async def api_load_blogs():
+    return dict(blogs=await Blog.findAll(orderBy='created_at desc', limit=10))
+
+async def api_load_blog(*, id):
+    return await Blog.find(id)
+
+def make_load_app():
+    """生成压测用的Application，经过与app.py相同的中间件和add_route()
+
+    :return:
+    """
+    app = web.Application(middlewares=[response_cache, response_factory])
+    for path, fn in (('/api/blogs', api_load_blogs), ('/api/blog', api_load_blog)):
+        add_route(app, get(path)(fn))
+    return app
+
+@benchmark('load', db='fake')
+async def bench_load(args):
+    """端到端压测：aiohttp服务端和客户端在同一进程中，数据库为fakedb
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    runner = web.AppRunner(make_load_app(), access_log=None)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    site = web.SockSite(runner, sock)
+    await site.start()
+    base = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+    results = []
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            for case, path in (('GET /api/blogs', '/api/blogs'), ('GET /api/blog?id=', '/api/blog?id=blog-1')):
+                latencies = []
+                remaining = [args.requests]
+
+                async def client():
+                    while remaining[0] > 0:
+                        remaining[0] -= 1
+                        started = time.perf_counter()
+                        async with session.get(base + path) as resp:
+                            await resp.read()
+                            if resp.status != 200:
+                                raise Exception('%s returned %s' % (path, resp.status))
+                        latencies.append(time.perf_counter() - started)
+
+                start = time.perf_counter()
+                await asyncio.gather(*[client() for _ in range(args.concurrency)])
+                results.append(result('%s x%d' % (case, args.concurrency), time.perf_counter() - start,
+                                      len(latencies), latencies))
+    finally:
+        await runner.cleanup()
+    return results
+
+async def backend_workload(args, label):
+    """在当前链接池上执行一组典型的读写操作
+
+    :param args: 命令行参数
+    :param label: 结果中的后端名称
+    :return: 结果列表
+    """
+    def make_comment():
+        return Comment(blog_id='bench', user_id='bench', user_name='bench', user_image='', content='x' * 200)
+
+    results = []
+    comments = [make_comment() for _ in range(args.rows)]
+    start = time.perf_counter()
+    for i in range(0, len(comments), args.concurrency):     # 并发的单条写入，SQLite后端会合并为组提交
+        await asyncio.gather(*[c.save() for c in comments[i:i + args.concurrency]])
+    results.append(result('%s: save() x%d concurrent' % (label, args.concurrency), time.perf_counter() - start, args.rows))
+
+    start = time.perf_counter()
+    await Comment.save_many([make_comment() for _ in range(args.rows)], batch_size=args.batch_size)
+    results.append(result('%s: save_many()' % label, time.perf_counter() - start, args.rows))
+
+    start = time.perf_counter()
+    for c in comments:
+        await Comment.find(c.id)
+    results.append(result('%s: find()' % label, time.perf_counter() - start, len(comments)))
+
+    n = args.repeat * 10
+    start = time.perf_counter()
+    for _ in range(n):
+        await Comment.findAll('`blog_id`=?', ['bench'], orderBy='created_at desc', limit=args.page_size)
+    results.append(result('%s: findAll() page of %d' % (label, args.page_size), time.perf_counter() - start, n))
+
+    await orm.execute('delete from `comments` where `blog_id`=?', ['bench'])    # 清理测试数据
+    return results
+
+@benchmark('backends', db=True)
+async def bench_backends(args):
+    """比较MySQL（或--fake时的fakedb）与嵌入式SQLite后端
+
+    SQLite数据库默认建在临时目录中，测试结束后删除
+
+    :param args: 命令行参数
+    :return: 结果列表
+    """
+    results = await backend_workload(args, 'fakedb' if args.fake else 'mysql')
+    await orm.close_pool()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.sqlite or os.path.join(tmp, 'bench.db')
+        await orm.create_pool(asyncio.get_event_loop(), driver=sqlitedb.SQLiteDriver(), db=path)
+        if not args.sqlite:
+            for sql in schema.ddl([Comment]):
+                await orm.execute(sql, [])
+        try:
+            results.extend(await backend_workload(args, 'sqlite'))
+        finally:
+            await orm.close_pool()
+    return results
+
+async def run(loop, args):
+    """运行所选的基准测试
+
+    需要数据库的基准测试各自使用新建的链接池，指定--fake或声明为db='fake'时使用fakedb
+
+    :param loop: 事件循环实例
+    :param args: 命令行参数
+    :return: (基准测试名称, 结果)列表
+    """
+    names = args.names or [name for name, func in BENCHMARKS.items() if func.__bench_db__ in (False, 'fake')]
+    results = []
+    for name in names:
+        db = BENCHMARKS[name].__bench_db__
+        if db == 'fake' or (db and args.fake):
+            driver = fakedb.FakeDriver(latency=args.latency, rows=args.fetch_rows)
+            await orm.create_pool(loop, driver=driver, user='bench', password='', db='bench')
+        elif db:
+            await orm.create_pool(loop, host=args.host, port=args.port, user=args.user, password=args.password, db=args.db)
+        try:
+            for r in await BENCHMARKS[name](args):
+                results.append((name, r))
+                line = '%-12s %-40s %10.4f s %14.1f ops/s' % (name, r['case'], r['seconds'], r['ops_per_sec'])
+                if 'p50' in r:
+                    line += '   p50 %.2f ms  p99 %.2f ms' % (r['p50'] * 1000, r['p99'] * 1000)
+                print(line)
+        finally:
+            if db:
+                await orm.close_pool()
+    return results
+
+def write_json(path, args, results):
+    """以JSON格式保存结果，便于比较不同版本
+
+    :param path: 文件路径
+    :param args: 命令行参数
+    :param results: run()的结果
+    :return:
+    """
+    data = dict(
+        meta=dict(time=time.time(), python=sys.version.split()[0], platform=platform.platform(),
+                  cpus=os.cpu_count(), args={k: v for k, v in vars(args).items() if k not in ('password', 'json', 'baseline')}),
+        results=[dict(benchmark=name, **r) for name, r in results])
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+def compare(path, results):
+    """与之前保存的结果比较吞吐量
+
+    :param path: write_json()生成的文件
+    :param results: run()的结果
+    :return:
+    """
+    with open(path) as f:
+        baseline = {(r['benchmark'], r['case']): r for r in json.load(f)['results']}
+    print('\ncompared with %s:' % path)
+    for name, r in results:
+        old = baseline.get((name, r['case']))
+        if old and old['ops_per_sec']:
+            print('%-12s %-40s %+8.1f%%' % (name, r['case'], (r['ops_per_sec'] / old['ops_per_sec'] - 1) * 100))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for orm and coroweb.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run: %s' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='www-data')
+    parser.add_argument('--password', default='www-data')
+    parser.add_argument('--db', default='awesome')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--fake', action='store_true', help='run database benchmarks against fakedb')
+    parser.add_argument('--latency', type=float, default=0.0, help='fakedb latency per statement in seconds')
+    parser.add_argument('--fetch-rows', type=int, default=20, help='rows returned by each fakedb SELECT')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent clients in the load benchmark')
+    parser.add_argument('--requests', type=int, default=5000, help='requests per case in the load benchmark')
+    parser.add_argument('--sqlite', help='existing SQLite database for the backends benchmark (default: a temporary file)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='compare throughput with results written by --json')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+    logging.basicConfig(level=logging.WARNING)
+    ids.set_worker_id(int(os.environ.get('WORKER_ID', 0)))     # 基准测试只有一个进程生成ID
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(loop, args))
+    if args.json:
+        write_json(args.json, args, results)
+    if args.baseline:
+        compare(args.baseline, results)
+
+if __name__ == '__main__':
+    main()
@@ -5,18 +5,23 @@
 
 __author__ = 'Michael Liao'
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, json, hashlib, shutil, tempfile, time
 
-from urllib import parse
+from collections import OrderedDict
 
 from aiohttp import web
 
 from apis import APIError
+from assets import StaticFiles
 
-def get(path):
+def get(path, cache=None, vary=(), tags=(), admission=None):
     """装饰Get方法
 
     :param path:路径
+    :param cache:响应缓存时间（秒），为None时不缓存
+    :param vary:参与缓存键的请求头，例如：('Cookie',)
+    :param tags:缓存标签，用于在数据变更时通过purge_cache(tag=...)清除，例如：('blogs',)
+    :param admission:准入控制的路由类名，默认为'read'
     :return:
     """
     def decorator(func):
@@ -25,24 +30,142 @@ def get(path):
             return func(*args,**kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__cache__ = (cache, tuple(vary), tuple(tags)) if cache else None
+        wrapper.__admission__ = admission
         return wrapper
     return decorator
 
-def post(path):
+def post(path, stream=False, max_body=None, admission=None):
     """装饰Post方法
 
     :param path: 路径
+    :param stream: multipart请求体的读取方式：
+        False     - 由request.post()整体读入内存
+        True      - 逐块读取，普通字段作为字符串传入，文件部分按块写入SpooledTemporaryFile后以UploadFile传入
+        'reader'  - 不读取请求体，通过reader参数传入aiohttp的MultipartReader，由处理函数自行读取
+    :param max_body: 请求体字节数上限，Content-Length超出时在读取前返回413，流式读取时超出也返回413
+    :param admission: 准入控制的路由类名，默认为'write'
     :return:
     """
+    if stream not in (False, True, 'reader'):
+        raise ValueError('Invalid stream value: %s' % stream)
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args,**kw):
             return func(*args,**kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__stream__ = stream
+        wrapper.__max_body__ = max_body
+        wrapper.__admission__ = admission
         return wrapper
     return decorator
 
+SPOOL_MEMORY = 256 * 1024       # 上传文件在内存中保留的字节数，超出后写入临时文件
+READ_CHUNK = 64 * 1024          # 流式读取请求体时每次读取的字节数
+MAX_FIELD = 1024 * 1024         # 流式读取时普通字段的字节数上限
+
+class BodyTooLarge(Exception):
+    """请求体超出大小限制"""
+
+    def __init__(self, max_size, actual_size=0):
+        super().__init__('Request body exceeds %s bytes' % max_size)
+        self.max_size = max_size
+        self.actual_size = actual_size
+
+class UploadFile(object):
+    """流式读取的上传文件
+
+    内容保存在SpooledTemporaryFile中，小文件留在内存，大文件写入临时文件；请求处理完成后自动关闭
+    """
+
+    def __init__(self, name, filename, content_type):
+        """初始化
+
+        :param name:表单字段名
+        :param filename:客户端提供的文件名
+        :param content_type:文件的Content-Type
+        """
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    async def save(self, path):
+        """在线程池中将内容复制到文件
+
+        :param path:目标路径
+        :return:
+        """
+        def copy():
+            self.file.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(self.file, f, READ_CHUNK)
+        await asyncio.get_event_loop().run_in_executor(None, copy)
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<UploadFile %s: %s (%s, %d bytes)>' % (self.name, self.filename, self.content_type, self.size)
+
+async def read_multipart(request, max_body=None, uploads=None):
+    """逐块读取multipart请求体
+
+    每次最多读取READ_CHUNK字节，文件部分写入UploadFile，内存占用与上传文件的大小无关
+
+    :param request:请求
+    :param max_body:所有部分的字节数上限，None表示不限制（普通字段仍受MAX_FIELD限制）
+    :param uploads:用于登记UploadFile的队列，出错时也能由调用方关闭
+    :return:字段名 ==> 字符串或UploadFile，同名字段有多个时为列表
+    """
+    reader = await request.multipart()
+    params = dict()
+    total = 0
+    uploads = [] if uploads is None else uploads
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if not hasattr(part, 'read_chunk'):                 # 嵌套的multipart/mixed
+            raise web.HTTPBadRequest(text='Nested multipart is not supported')
+        if part.filename is None:                           # 普通字段
+            limit = MAX_FIELD if max_body is None else min(MAX_FIELD, max_body - total)
+            data = bytearray()
+            while True:
+                chunk = await part.read_chunk(READ_CHUNK)
+                if not chunk:
+                    break
+                data.extend(chunk)
+                if len(data) > limit:
+                    raise BodyTooLarge(limit if limit == MAX_FIELD else max_body, total + len(data))
+            total += len(data)
+            value = part.decode(bytes(data)).decode(part.get_charset(default='utf-8'))
+        else:                                               # 文件
+            value = UploadFile(part.name, part.filename, part.headers.get('Content-Type'))
+            uploads.append(value)
+            while True:
+                chunk = await part.read_chunk(READ_CHUNK)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if max_body is not None and total > max_body:
+                    raise BodyTooLarge(max_body, total)
+                data = part.decode(chunk)
+                value.file.write(data)
+                value.size += len(data)
+            value.file.seek(0)
+        if part.name in params:
+            previous = params[part.name]
+            params[part.name] = (previous if isinstance(previous, list) else [previous]) + [value]
+        else:
+            params[part.name] = value
+    return params
+
 
 def get_required_kw_args(fn):
     """获取必要参数（及默认值为空的参数）
@@ -109,6 +232,99 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
+def compile_binder(fn):
+    """根据处理函数的签名生成参数绑定函数
+
+    在add_route时只分析一次函数签名，之后每个请求只执行与该签名相关的步骤
+
+    :param fn:处理函数
+    :return:绑定函数 bind(request)，返回参数字典，参数有误时返回错误响应
+    """
+    has_request = has_request_arg(fn)                           # 是否处理request参数
+    has_var_kw_arg = has_var_kw_args(fn)                        # 是否有字典类型参数
+    named_kw_args = get_name_kw_args(fn)                        # 获取名称参数
+    required_kw_args = get_required_kw_args(fn)                 # 获取必要参数
+    stream = getattr(fn, '__stream__', False)                   # multipart请求体的读取方式
+    max_body = getattr(fn, '__max_body__', None)                # 请求体字节数上限
+
+    if stream == 'reader' and 'reader' not in named_kw_args and not has_var_kw_arg:
+        raise ValueError('stream=\'reader\' requires a reader keyword argument in function: %s' % fn.__name__)
+
+    if max_body is not None:
+        bind = _compile_binder(fn, has_request, has_var_kw_arg, named_kw_args, required_kw_args, stream, max_body)
+
+        async def checked(request):
+            length = request.content_length
+            if length is not None and length > max_body:        # 读取请求体之前拒绝
+                return web.HTTPRequestEntityTooLarge(max_size=max_body, actual_size=length)
+            if length is None and stream == 'reader' and request.method == 'POST':
+                return web.HTTPLengthRequired()                 # 由处理函数自行读取时只能依据Content-Length限制大小
+            return await bind(request)
+        return checked
+    return _compile_binder(fn, has_request, has_var_kw_arg, named_kw_args, required_kw_args, stream, max_body)
+
+def _compile_binder(fn, has_request, has_var_kw_arg, named_kw_args, required_kw_args, stream, max_body):
+    if not (has_var_kw_arg or named_kw_args):                   # 处理函数没有参数，只需要match_info
+        async def bind(request):
+            kw = dict(**request.match_info)
+            if has_request:
+                kw['request'] = request
+            return kw
+        return bind
+
+    def select(params):
+        """从请求参数中取出处理函数需要的参数"""
+        if has_var_kw_arg:
+            return dict(**params)
+        kw = dict()
+        for name in named_kw_args:
+            if name in params:
+                kw[name] = params[name]
+        return kw
+
+    async def bind(request):
+        method = request.method
+        if method == 'POST':                                                # 如果提交类型为POST
+            ct = request.content_type
+            if not ct:                                                      # 如果内容类型不存在返回类型丢失错误
+                return web.HTTPBadRequest(text='Missing Content-Type')
+            ct = ct.lower()                                                 # 将返回类型字符串处理为小写
+            if ct.startswith('application/json'):                           # 如果开头为json类型
+                params = await request.json()                               # 获取json数据
+                if not isinstance(params, dict):                            # 如果获取的类型不为字典类型，则返回错误，提示json的体应为一个对象
+                    return web.HTTPBadRequest(text='JSON body must be object.')
+                kw = select(params)
+            # http://blog.csdn.net/xiaoliuliu2050/article/details/52875881
+            elif ct.startswith('multipart/form-data') and stream == 'reader':
+                kw = dict(reader=await request.multipart())                 # 由处理函数自行读取
+            elif ct.startswith('multipart/form-data') and stream:
+                uploads = request['uploads'] = []                           # 请求处理完成后由StreamRequestHandler关闭
+                try:
+                    kw = select(await read_multipart(request, max_body, uploads))
+                except BodyTooLarge as e:
+                    return web.HTTPRequestEntityTooLarge(max_size=e.max_size, actual_size=e.actual_size)
+                except web.HTTPException as e:
+                    return e
+            elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                kw = select(await request.post())                           # 获取所提交的数据
+            else:                                                           # 如果都不是就报错
+                return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+        elif method == 'GET':                                               # 如果提交类型为GET，aiohttp已经解析好查询字符串
+            kw = select(request.query)
+        else:
+            kw = dict()
+        for k, v in request.match_info.items():
+            if k in kw:
+                logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+            kw[k] = v
+        if has_request:
+            kw['request'] = request
+        for name in required_kw_args:
+            if name not in kw:
+                return web.HTTPBadRequest(text='Missing argument: %s' % name)
+        return kw
+    return bind
+
 class RequestHandler(object):
     """请求捕获
 
@@ -122,11 +338,9 @@ class RequestHandler(object):
         """
         self._app = app                                     # APP
         self._func = fn                                     # 处理函数
-        self._has_request_arg = has_request_arg(fn)         # 是否处理request参数
-        self._has_var_kw_arg = has_var_kw_args(fn)          # 是否有字典类型参数
-        self._has_named_kw_args = has_name_kw_args(fn)      # 是否有名称参数
-        self._named_kw_args = get_name_kw_args(fn)          # 获取名称参数
-        self._required_kw_args = get_required_kw_args(fn)   # 获取必要参数
+        self._bind = compile_binder(fn)                     # 根据函数签名预先生成参数绑定函数
+        self._cache = getattr(fn, '__cache__', None)        # 响应缓存配置(ttl, vary, tags)
+        self._admission = getattr(fn, '__admission__', None)    # 准入控制的路由类名
 
     async def __call__(self, request):
         """调用参数
@@ -134,70 +348,398 @@ class RequestHandler(object):
         :param request:客户端所提交的数据
         :return:
         """
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:   # 如果处理函数有参数
-            if request.method == 'POST':                                        # 如果提交类型为POST
-                if not request.content_type:                                    # 如果内容类型不存在返回类型丢失错误
-                    return web.HTTPBadRequest('Missing Content-Type')
-                ct = request.content_type.lower()                               # 将返回类型字符串处理为小写
-                if ct.startswith('application/json'):                           # 如果开头为json类型
-                    params = await request.json()                               # 获取json数据
-                    if not isinstance(params, dict):                            # 如果获取的类型不为字典类型，则返回错误，提示json的体应为一个对象
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params                                                 # 将数据存入kw
-                # http://blog.csdn.net/xiaoliuliu2050/article/details/52875881
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()                               # 获取所提交的数据
-                    kw = dict(**params)                                         # 转换为dict并存入kw
-                else:                                                           # 如果都不是就报错
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':                                         # 如果提交类型为GET
-                qs = request.query_string                                       # 获取地址栏中所提交的查询字符串
-                if qs:                                                          # 如果存在这将这些查询依次存入字典
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:                                                          # 如果处理函数没有参数
-            kw = dict(**request.match_info)                                     # match_info内部暂时不清楚
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:                # 不存在字典类型参数并且存在关键字参数
-                copy = dict()                                                   # 创建一个空字典
-                for name in self._named_kw_args:                                # 获取关键字
-                    if name in kw:                                              # 如果关键字在参数中
-                        copy[name] = kw[name]                                   # 将数据存入字典
-                kw = copy
-            for k, v in request.match_info.items():                             # 如果
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        kw = await self._bind(request)
+        if not isinstance(kw, dict):                        # 参数有误，返回错误响应
+            return kw
+        logging.debug('call with args: %s', kw)             # 只在DEBUG级别格式化参数
         try:
             r = await self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
+class StreamRequestHandler(RequestHandler):
+    """@post(..., stream=True)的路由使用的请求捕获，处理完成后关闭绑定函数登记的上传文件
+
+    """
+
+    async def __call__(self, request):
+        try:
+            return await super().__call__(request)
+        finally:
+            for upload in request.get('uploads', ()):       # 关闭流式读取的上传文件，删除临时文件
+                upload.close()
+
+def make_request_handler(app, fn):
+    """为处理函数创建请求捕获，只有流式读取上传文件的路由需要在处理完成后清理
+
+    :param app:web Application
+    :param fn:处理函数
+    :return:RequestHandler
+    """
+    if getattr(fn, '__stream__', False) is True:
+        return StreamRequestHandler(app, fn)
+    return RequestHandler(app, fn)
+
+def to_jsonable(obj):
+    """转换为json模块可以直接序列化的对象
+
+    只转换紧凑记录（Model.__record__）：记录是元组，json模块会直接编码为数组而不调用default；
+    Model等字典子类原样返回，普通字典和列表只在包含记录时才复制，其他类型交给json_default()
+
+    :param obj:处理函数的返回值
+    :return:
+    """
+    t = type(obj)
+    if t is dict:
+        out = None
+        for k, v in obj.items():
+            c = to_jsonable(v)
+            if c is not v:
+                if out is None:
+                    out = dict(obj)
+                out[k] = c
+        return obj if out is None else out
+    if t is list or t is tuple:
+        out = None
+        for i, v in enumerate(obj):
+            c = to_jsonable(v)
+            if c is not v:
+                if out is None:
+                    out = list(obj)
+                out[i] = c
+        return obj if out is None else out
+    if isinstance(obj, tuple) and hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    return obj
+
+def json_default(obj):
+    """序列化json模块不支持的对象
+
+    :param obj:
+    :return:
+    """
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError('Object of type %s is not JSON serializable' % obj.__class__.__name__)
+
+_json_dumps = functools.partial(json.dumps, ensure_ascii=False, default=json_default)
+
+def set_json_encoder(dumps):
+    """替换JSON编码函数，例如使用orjson.dumps
+
+    :param dumps:编码函数，接收to_jsonable()转换后的对象，返回str或bytes
+    :return:
+    """
+    global _json_dumps
+    _json_dumps = dumps
+
+def json_bytes(obj):
+    """将处理函数的返回值编码为JSON
+
+    :param obj:
+    :return:utf-8编码的bytes
+    """
+    body = _json_dumps(to_jsonable(obj))
+    return body.encode('utf-8') if isinstance(body, str) else body
+
+STREAM_THRESHOLD = 1000     # 列表长度达到该值时以分块流的形式返回
+STREAM_CHUNK = 200          # 流式返回时每次写出的元素数量
+
+async def stream_json_array(request, items):
+    """以分块传输的方式返回JSON数组
+
+    每编码STREAM_CHUNK个元素就写出一次并让出事件循环，首字节时间和内存占用不随结果大小增长
+
+    :param request:请求
+    :param items:列表或异步生成器
+    :return:已经写完的StreamResponse
+    """
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    buf = []
+    sep = b'['
+
+    async def flush():
+        nonlocal sep
+        await resp.write(sep + b','.join(buf))
+        sep = b','
+        buf.clear()
+        await asyncio.sleep(0)      # 让出事件循环，避免长时间阻塞其他请求
+
+    if inspect.isasyncgen(items):
+        async for item in items:
+            buf.append(json_bytes(item))
+            if len(buf) >= STREAM_CHUNK:
+                await flush()
+    else:
+        for item in items:
+            buf.append(json_bytes(item))
+            if len(buf) >= STREAM_CHUNK:
+                await flush()
+    if buf:
+        await flush()
+    await resp.write(b']' if sep == b',' else b'[]')
+    await resp.write_eof()
+    return resp
+
+async def response_factory(app, handler):
+    """响应中间件：将处理函数的返回值转换为web.Response
+
+    :param app:web Application
+    :param handler:下一级处理函数
+    :return:
+    """
+    async def response(request):
+        r = await handler(request)
+        if isinstance(r, web.StreamResponse):                   # 已经是响应对象
+            return r
+        if isinstance(r, bytes):
+            resp = web.Response(body=r)
+            resp.content_type = 'application/octet-stream'
+            return resp
+        if isinstance(r, str):
+            if r.startswith('redirect:'):                       # 重定向
+                return web.HTTPFound(r[9:])
+            resp = web.Response(body=r.encode('utf-8'))
+            resp.content_type = 'text/html'
+            resp.charset = 'utf-8'
+            return resp
+        if isinstance(r, dict):                                 # 包括Model和APIError转换后的错误字典
+            resp = web.Response(body=json_bytes(r))
+            resp.content_type = 'application/json'
+            resp.charset = 'utf-8'
+            return resp
+        if inspect.isasyncgen(r) or (isinstance(r, list) and len(r) >= STREAM_THRESHOLD):
+            return await stream_json_array(request, r)          # 大列表和异步生成器以流的形式返回
+        if isinstance(r, list):
+            resp = web.Response(body=json_bytes(r))
+            resp.content_type = 'application/json'
+            resp.charset = 'utf-8'
+            return resp
+        if isinstance(r, int) and 100 <= r < 600:               # 状态码
+            return web.Response(status=r)
+        if isinstance(r, tuple) and len(r) == 2:                # (状态码, 说明)
+            t, m = r
+            if isinstance(t, int) and 100 <= t < 600:
+                return web.Response(status=t, text=str(m))
+        resp = web.Response(body=str(r).encode('utf-8'))        # 默认返回文本
+        resp.content_type = 'text/plain'
+        resp.charset = 'utf-8'
+        return resp
+    return response
+
+class CachedResponse(object):
+    """缓存的响应"""
+
+    __slots__ = ('body', 'etag', 'content_type', 'charset', 'headers', 'expires', 'tags')
+
+    def __init__(self, body, content_type, charset, headers, ttl, tags):
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()     # 强ETag
+        self.content_type = content_type
+        self.charset = charset
+        self.headers = headers                                  # 命中时原样返回的响应头 (名称, 值) 元组
+        self.expires = time.monotonic() + ttl
+        self.tags = tags
+
+# 由aiohttp根据响应体或缓存本身生成，不随缓存条目保存的响应头
+_UNCACHED_HEADERS = frozenset(('content-length', 'content-type', 'transfer-encoding', 'connection',
+                               'date', 'server', 'etag'))
+
+def _cacheable_headers(resp):
+    """取出可以随缓存条目保存的响应头
+
+    :param resp:处理函数返回的响应
+    :return:(名称, 值) 元组，响应设置了Cookie时返回None，这类响应不能缓存
+    """
+    if resp.cookies or 'Set-Cookie' in resp.headers:
+        return None
+    return tuple((k, v) for k, v in resp.headers.items() if k.lower() not in _UNCACHED_HEADERS)
+
+class ResponseCache(object):
+    """进程内的响应缓存
+
+    按总字节数和条目数限制大小，超出时淘汰最久未使用的条目
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=10000):
+        """初始化
+
+        :param max_bytes:缓存的响应体总字节数上限
+        :param max_entries:条目数上限
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()      # 缓存键 ==> CachedResponse
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry.expires < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes or len(self._data) > self.max_entries:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= len(self._data.pop(key).body)
+
+    def purge(self, path=None, tag=None):
+        """清除缓存
+
+        :param path:清除该路径（不论查询字符串）的缓存
+        :param tag:清除带有该标签的缓存
+        :return:清除的条目数
+        """
+        keys = [key for key, entry in self._data.items()
+                if (path is None and tag is None) or key[0] == path or tag in entry.tags]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self._data), bytes=self.size)
+
+_response_cache = ResponseCache()
+
+def configure_response_cache(max_bytes=64 * 1024 * 1024, max_entries=10000):
+    """设置响应缓存的大小，会清空已有缓存
+
+    :param max_bytes:响应体总字节数上限
+    :param max_entries:条目数上限
+    :return:
+    """
+    global _response_cache
+    _response_cache = ResponseCache(max_bytes, max_entries)
+
+def purge_cache(path=None, tag=None):
+    """清除响应缓存，不指定参数时全部清除
+
+    :param path:路由路径
+    :param tag:@get(..., tags=...)中声明的标签
+    :return:清除的条目数
+    """
+    return _response_cache.purge(path, tag)
+
+def response_cache_stats():
+    """响应缓存统计
+
+    :return:命中/未命中/淘汰次数及当前条目数和字节数
+    """
+    return _response_cache.stats()
+
+def _etag_matches(request, etag):
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    return any(tag.strip() in (etag, '*') for tag in header.split(','))
+
+async def response_cache(app, handler):
+    """响应缓存中间件，需放在response_factory之前
+
+    只缓存声明了@get(path, cache=ttl)的路由的200响应，响应带强ETag，If-None-Match匹配时返回304；
+    设置了Cookie的响应不缓存，其他响应头随缓存条目保存，命中时一并返回
+
+    :param app:web Application
+    :param handler:下一级处理函数
+    :return:
+    """
+    async def cached(request):
+        policy = getattr(request.match_info.handler, '_cache', None)
+        if policy is None or request.method != 'GET':
+            return await handler(request)
+        ttl, vary, tags = policy
+        key = (request.path, request.query_string) + tuple(request.headers.get(h) for h in vary)
+        entry = _response_cache.get(key)
+        if entry is None:
+            resp = await handler(request)
+            if type(resp) is not web.Response or resp.status != 200 or not isinstance(resp.body, bytes):
+                return resp     # 只缓存完整的成功响应
+            headers = _cacheable_headers(resp)
+            if headers is None:
+                return resp
+            entry = CachedResponse(resp.body, resp.content_type, resp.charset, headers, ttl, tags)
+            _response_cache.put(key, entry)
+            if _etag_matches(request, entry.etag):
+                return web.Response(status=304, headers={'ETag': entry.etag})
+            resp.headers['ETag'] = entry.etag                   # 未命中时返回处理函数的响应本身
+            resp.headers.setdefault('Cache-Control', 'no-cache')
+            return resp
+        if _etag_matches(request, entry.etag):
+            return web.Response(status=304, headers={'ETag': entry.etag})
+        resp = web.Response(body=entry.body, headers=entry.headers)
+        resp.headers['ETag'] = entry.etag
+        resp.headers.setdefault('Cache-Control', 'no-cache')
+        resp.content_type = entry.content_type
+        resp.charset = entry.charset
+        return resp
+    return cached
+
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
+    static = StaticFiles(path, '/static/')                              # 预压缩/内容哈希/内存缓存/sendfile
+    app.router.add_route('GET', '/static/{filename:.+}', static)
+    app['static'] = static                                              # 模板中通过 app['static'].url(name) 获取带哈希的URL
     logging.info('add static %s => %s' % ('/static/', path))
 
+def make_route(app, fn):
+    """生成注册到router的处理函数
+
+    aiohttp 3.x会包装不是协程函数的处理函数（例如RequestHandler对象），并要求其返回StreamResponse，
+    返回dict等值的处理函数会在response_factory转换之前出错，因此用协程函数包装；
+    response_cache和准入控制从包装函数上读取_cache和_admission
+
+    :param app:web Application
+    :param fn:处理函数
+    :return:协程函数
+    """
+    handler = make_request_handler(app, fn)
+
+    async def route(request):
+        return await handler(request)
+    route.__name__ = fn.__name__
+    route._cache = handler._cache
+    route._admission = handler._admission
+    return route
+
 def add_route(app, fn):
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    if not asyncio.iscoroutine(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
+    if not asyncio.iscoroutinefunction(inspect.unwrap(fn)) and not inspect.isgeneratorfunction(fn):    # @get/@post包装的普通函数
+        func = fn
+
+        @functools.wraps(func)      # 保留签名和@get/@post设置的属性
+        async def fn(*args, **kw):
+            return func(*args, **kw)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    app.router.add_route(method, path, make_route(app, fn))
 
 def add_routes(app, module_name):
     n = module_name.rfind('.')
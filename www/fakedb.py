@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+An in-memory stand-in for the parts of aiomysql that orm uses, for benchmarks
+and load tests that must run without a database server.
+
+    driver = fakedb.FakeDriver(latency=0.001, rows=20)
+    await orm.create_pool(loop, driver=driver, user='bench', password='', db='bench')
+
+Every statement sleeps for the configured latency. SELECT statements return
+generated rows whose columns are taken from the select list.
+'''
+
+import asyncio, re
+
+class Cursor(object):
+    """返回元组的游标"""
+    dict_rows = False
+
+class DictCursor(Cursor):
+    """返回字典的游标"""
+    dict_rows = True
+
+class SSCursor(Cursor):
+    """无缓冲游标"""
+    pass
+
+class SSDictCursor(DictCursor):
+    """无缓冲的字典游标"""
+    pass
+
+_SELECT_RE = re.compile(r'^\s*(?:explain\s+)?select\s+(.*?)\s+from\s', re.I | re.S)
+_COLUMN_RE = re.compile(r'`?(\w+)`?\s*$')
+
+def default_row(columns, i):
+    """生成一行数据
+
+    :param columns: 列名元组
+    :param i: 行号
+    :return: 与列名对应的值列表
+    """
+    values = []
+    for c in columns:
+        if c == '_num_':
+            values.append(i + 1)
+        elif c.endswith('_at'):
+            values.append(1500000000.0 + i)
+        elif c == 'admin':
+            values.append(False)
+        else:
+            values.append('%s-%d' % (c, i))
+    return values
+
+class FakeDriver(object):
+    """模拟的aiomysql模块
+
+    传入orm.create_pool(driver=...)，提供create_pool()和游标类
+    """
+
+    Cursor = Cursor
+    DictCursor = DictCursor
+    SSCursor = SSCursor
+    SSDictCursor = SSDictCursor
+
+    def __init__(self, latency=0.0, rows=10, row_factory=default_row, affected=1):
+        """初始化
+
+        :param latency: 每条语句的模拟耗时（秒），0表示只让出一次事件循环
+        :param rows: SELECT返回的行数
+        :param row_factory: 生成行数据的函数 row_factory(columns, i)
+        :param affected: 非SELECT语句影响的行数
+        """
+        self.latency = latency
+        self.rows = rows
+        self.row_factory = row_factory
+        self.affected = affected
+        self.statements = 0
+        self._columns = dict()  # SQL语句 ==> 列名元组
+
+    async def create_pool(self, maxsize=10, minsize=1, **kw):
+        return FakePool(self, maxsize, minsize)
+
+    def columns(self, sql):
+        """从查询语句中解析列名
+
+        :param sql: 查询语句
+        :return: 列名元组，不是SELECT语句时返回None
+        """
+        if sql in self._columns:
+            return self._columns[sql]
+        columns = None
+        m = _SELECT_RE.match(sql)
+        if m is not None:
+            columns = []
+            for expr in _split(m.group(1)):
+                c = _COLUMN_RE.search(expr)
+                columns.append(c.group(1) if c else expr)
+            columns = tuple(columns)
+        self._columns[sql] = columns
+        return columns
+
+    def result(self, sql):
+        columns = self.columns(sql)
+        if columns is None:
+            return None, []
+        if columns == ('_num_',):
+            return columns, [(self.rows,)]
+        return columns, [tuple(self.row_factory(columns, i)) for i in range(self.rows)]
+
+def _split(select_list):
+    """按顶层逗号拆分select列表"""
+    parts, depth, start = [], 0, 0
+    for i, ch in enumerate(select_list):
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            parts.append(select_list[start:i].strip())
+            start = i + 1
+    parts.append(select_list[start:].strip())
+    return parts
+
+class FakePool(object):
+    """模拟的链接池，链接数上限与aiomysql一致，超出时等待"""
+
+    def __init__(self, driver, maxsize, minsize):
+        self.driver = driver
+        self.maxsize = maxsize
+        self.minsize = minsize
+        self.size = minsize
+        self.freesize = minsize
+        self._free = [FakeConnection(driver) for _ in range(minsize)]
+        self._available = asyncio.Semaphore(maxsize)
+
+    def get(self):
+        return _PoolContext(self)
+
+    async def _acquire(self):
+        await self._available.acquire()
+        if self._free:
+            conn = self._free.pop()
+            self.freesize -= 1
+        else:
+            conn = FakeConnection(self.driver)
+            self.size += 1
+        return conn
+
+    def _release(self, conn):
+        self._free.append(conn)
+        self.freesize += 1
+        self._available.release()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+class _PoolContext(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.pool._acquire()
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool._release(self.conn)
+
+class FakeConnection(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def cursor(self, cursorclass=Cursor):
+        return FakeCursor(self.driver, cursorclass)
+
+    async def begin(self):
+        pass
+
+    async def commit(self):
+        await _wait(self.driver.latency)
+
+    async def rollback(self):
+        pass
+
+class FakeCursor(object):
+
+    def __init__(self, driver, cursorclass):
+        self.driver = driver
+        self.dict_rows = cursorclass.dict_rows
+        self.rowcount = -1
+        self._rows = []
+        self._pos = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def execute(self, sql, args=None):
+        driver = self.driver
+        driver.statements += 1
+        await _wait(driver.latency)
+        columns, rows = driver.result(sql)
+        if columns is None:
+            self.rowcount = driver.affected
+            self._rows = []
+        else:
+            self._rows = [dict(zip(columns, r)) for r in rows] if self.dict_rows else rows
+            self.rowcount = len(self._rows)
+        self._pos = 0
+        return self.rowcount
+
+    async def executemany(self, sql, args):
+        self.driver.statements += 1
+        await _wait(self.driver.latency)
+        self.rowcount = len(args) * self.driver.affected
+        return self.rowcount
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+    async def fetchmany(self, size=1):
+        rs = self._rows[self._pos:self._pos + size]
+        self._pos += len(rs)
+        return rs
+
+    async def fetchall(self):
+        rs = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rs
+
+async def _wait(latency):
+    await asyncio.sleep(latency)    # latency为0时也让出一次事件循环，与真实驱动的行为一致
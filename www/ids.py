@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Compact, time-ordered 64-bit ids.
+
+Layout (most significant bit first):
+    1 bit   always 0, ids are positive bigints
+    41 bits milliseconds since EPOCH (about 69 years)
+    10 bits worker id, unique per process that generates ids
+    12 bits sequence within the millisecond
+
+Ids from one process are strictly increasing, and ids from different
+processes sort by creation time to within clock drift. next_id_str()
+returns the same value zero-padded to 20 digits, so string keys sort
+in the same order.
+
+There is no default worker id: every process must set one with the
+WORKER_ID environment variable or set_worker_id() before generating ids,
+and a forked child must set its own. next_id() raises WorkerIdError
+otherwise.
+The single-process entry points (app.py, bench.py) default to worker 0;
+server.py sets one per worker from --worker-id-base.
+'''
+
+import logging, os, threading, time
+
+EPOCH = 1514764800000           # 2018-01-01 00:00:00 UTC，毫秒
+TIMESTAMP_BITS = 41
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+WORKER_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_BITS
+STR_WIDTH = 20                  # 2**63的十进制位数
+
+class ClockSkewError(Exception):
+    """系统时钟回拨超过允许范围"""
+    pass
+
+def _now_ms():
+    return time.time_ns() // 1000000
+
+class IdGenerator(object):
+    """ID生成器
+
+    时钟回拨不超过max_drift毫秒时，沿用上一次的时间戳继续递增序列号，保证ID单调递增；
+    超过时抛出ClockSkewError
+    """
+
+    def __init__(self, worker_id=0, epoch=EPOCH, max_drift=10000):
+        """初始化
+
+        :param worker_id: 0到1023之间的worker编号
+        :param epoch: 起始时间（毫秒）
+        :param max_drift: 允许的最大时钟回拨（毫秒）
+        """
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError('worker id must be between 0 and %d' % MAX_WORKER)
+        self.worker_id = worker_id
+        self.epoch = epoch
+        self.max_drift = max_drift
+        self._lock = threading.Lock()
+        self._last = -1         # 上一个ID的时间戳（相对epoch）
+        self._sequence = 0
+
+    def reset(self, worker_id=None):
+        """重置状态，fork之后在子进程中调用
+
+        :param worker_id: 新的worker编号，为None时保持不变
+        :return:
+        """
+        if worker_id is not None:
+            if not 0 <= worker_id <= MAX_WORKER:
+                raise ValueError('worker id must be between 0 and %d' % MAX_WORKER)
+            self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last = -1
+        self._sequence = 0
+
+    def next(self):
+        """生成下一个ID
+
+        :return: 64位整数ID
+        """
+        with self._lock:
+            now = _now_ms() - self.epoch
+            last = self._last
+            if now > last:
+                self._sequence = 0
+                self._last = now
+            else:
+                if last - now > self.max_drift:
+                    raise ClockSkewError('clock moved backwards by %d ms' % (last - now))
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:     # 当前毫秒的序列号用完，借用下一毫秒
+                    self._last = last = last + 1
+                now = last
+            return (now << TIMESTAMP_SHIFT) | (self.worker_id << WORKER_SHIFT) | self._sequence
+
+def make_id(ms, worker_id=0, sequence=0, epoch=EPOCH):
+    """由各部分组装ID，用于迁移旧数据
+
+    :param ms: Unix时间戳（毫秒）
+    :param worker_id: worker编号
+    :param sequence: 序列号
+    :param epoch: 起始时间（毫秒）
+    :return: 64位整数ID
+    """
+    if ms < epoch:
+        raise ValueError('timestamp %d is before the id epoch' % ms)
+    return ((ms - epoch) << TIMESTAMP_SHIFT) | ((worker_id & MAX_WORKER) << WORKER_SHIFT) | (sequence & MAX_SEQUENCE)
+
+def id_time(id, epoch=EPOCH):
+    """获取ID的生成时间
+
+    :param id: 整数或字符串形式的ID
+    :return: Unix时间戳（秒）
+    """
+    return ((int(id) >> TIMESTAMP_SHIFT) + epoch) / 1000.0
+
+def id_worker(id):
+    """获取生成ID的worker编号
+
+    :param id: 整数或字符串形式的ID
+    :return:
+    """
+    return (int(id) >> WORKER_SHIFT) & MAX_WORKER
+
+def to_str(id):
+    """转换为补零到20位的字符串，字符串顺序与数值顺序一致
+
+    :param id: 整数ID
+    :return:
+    """
+    return '%020d' % id
+
+class WorkerIdError(Exception):
+    """当前进程没有设置worker编号"""
+    pass
+
+def _default_worker_id():
+    """默认的worker编号：环境变量WORKER_ID，未设置时为None，生成ID前必须调用set_worker_id()"""
+    worker = os.environ.get('WORKER_ID')
+    if worker is None:
+        return None
+    return int(worker)
+
+_worker = _default_worker_id()
+_generator = IdGenerator(0 if _worker is None else _worker)
+
+def set_worker_id(worker_id):
+    """设置当前进程的worker编号
+
+    同一时刻生成ID的每个进程（包括不同主机上的进程）必须使用不同的编号，
+    server.py为每个worker进程设置 --worker-id-base + worker序号
+
+    :param worker_id: 0到1023之间的整数
+    :return:
+    """
+    global _worker
+    _generator.reset(worker_id)
+    _worker = worker_id
+    logging.info('id generator worker id: %s' % worker_id)
+
+def _after_fork():
+    # 子进程与父进程的编号相同，继续使用会生成重复的ID，必须重新调用set_worker_id()
+    global _worker
+    _generator.reset()
+    _worker = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def _check_worker():
+    if _worker is None:
+        raise WorkerIdError('worker id is not set: set the WORKER_ID environment variable or call ids.set_worker_id()')
+
+def next_id():
+    """生成整数ID
+
+    :return: 64位整数ID
+    """
+    _check_worker()
+    return _generator.next()
+
+def next_id_str():
+    """生成字符串ID
+
+    :return: 20位数字字符串
+    """
+    _check_worker()
+    return '%020d' % _generator.next()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Lightweight metrics used by orm and coroweb.
+'''
+
+import bisect
+
+# 默认的延迟分桶上界（秒），从0.5毫秒到10秒
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    """固定分桶的直方图
+
+    每次记录只做一次二分查找和几次加法，可以在生产环境中常开
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """初始化
+
+        :param buckets:升序排列的分桶上界，超出最后一个上界的值记入溢出桶
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """记录一个值
+
+        :param value:值
+        :return:
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """估算分位数
+
+        :param q:分位，0到1之间
+        :return:所在分桶的上界，落在溢出桶时返回最大值
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        """导出当前数据
+
+        :return:包含次数/总和/最大值/分位数/分桶计数的字典
+        """
+        return dict(count=self.count, sum=self.sum, max=self.max,
+                    p50=self.percentile(0.5), p90=self.percentile(0.9), p99=self.percentile(0.99),
+                    buckets=list(zip(self.buckets + ('+Inf',), self.counts)))
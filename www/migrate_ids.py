@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Migrate legacy 50-character ids ('%015d' milliseconds + uuid4 hex + '000')
+to 20-digit time-ordered ids from ids.py, including foreign key columns.
+
+Deploy the new models first, so new rows already get new ids, then run:
+    python3 migrate_ids.py --user www-data --password www-data --db awesome
+
+The migration is resumable: rerun it after an interruption and it continues
+where it stopped. The app may keep running: every table keeps a legacy id
+column until the end, and foreign keys are rewritten through it after the
+primary keys are swapped, so rows inserted with a legacy parent id during
+the migration are rewritten too.
+'''
+
+import argparse, asyncio, logging
+
+import ids
+import orm
+
+# 表名 ==> {外键列: 被引用的表}，被引用的表排在前面
+PLAN = (
+    ('users', {}),
+    ('blogs', {'user_id': 'users'}),
+    ('comments', {'blog_id': 'blogs', 'user_id': 'users'}),
+)
+TEMP_COLUMN = 'new_id'
+LEGACY_COLUMN = 'legacy_id'
+
+def legacy_time(legacy_id):
+    """获取旧ID中的毫秒时间戳
+
+    :param legacy_id: 旧ID
+    :return:
+    """
+    return int(legacy_id[:15])
+
+class IdMapper(object):
+    """由旧ID的时间戳生成新ID
+
+    同一毫秒内的旧ID依次占用worker和序列号位，每毫秒最多可容纳2**22个ID
+    """
+
+    def __init__(self, last=None):
+        """初始化
+
+        :param last: 上次中断前生成的最大新ID，用于继续编号
+        """
+        self.ms = -1
+        self.counter = 0
+        if last is not None:
+            last = int(last)
+            self.ms = (last >> ids.TIMESTAMP_SHIFT) + ids.EPOCH
+            self.counter = last & ((1 << ids.TIMESTAMP_SHIFT) - 1)
+
+    def map(self, legacy_id):
+        ms = legacy_time(legacy_id)
+        if ms == self.ms:
+            self.counter += 1
+            if self.counter >> ids.TIMESTAMP_SHIFT:
+                raise ValueError('too many ids in millisecond %d' % ms)
+        else:
+            self.ms, self.counter = ms, 0
+        return ids.to_str(ids.make_id(ms, self.counter >> ids.WORKER_SHIFT, self.counter))
+
+async def column_exists(table, column):
+    rs = await orm.select('select count(*) as `n` from information_schema.columns '
+                          'where table_schema=database() and table_name=? and column_name=?', [table, column])
+    return rs[0]['n'] > 0
+
+async def assign(table, batch_size):
+    """为旧记录生成新ID，保存在临时列中
+
+    :param table: 表名
+    :param batch_size: 每批处理的行数
+    :return: 处理的行数
+    """
+    if not await column_exists(table, TEMP_COLUMN):
+        await orm.execute('alter table `%s` add column `%s` char(%d) null' % (table, TEMP_COLUMN, ids.STR_WIDTH), [])
+    if not await column_exists(table, LEGACY_COLUMN):
+        await orm.execute('alter table `%s` add column `%s` varchar(50) null, add index (`%s`)'
+                          % (table, LEGACY_COLUMN, LEGACY_COLUMN), [])
+    rs = await orm.select('select max(`%s`) as `last` from `%s`' % (TEMP_COLUMN, table), [])
+    mapper = IdMapper(rs[0]['last'])
+    total = 0
+    while True:
+        # 旧ID以补零的毫秒时间戳开头，按ID排序即按时间排序，已处理的记录总是排在前面
+        rs = await orm.select('select `id` from `%s` where length(`id`) > ? and `%s` is null order by `id` limit ?'
+                              % (table, TEMP_COLUMN), [ids.STR_WIDTH, batch_size], primary=True)
+        if not rs:
+            return total
+        await orm.executemany('update `%s` set `%s`=? where `id`=?' % (table, TEMP_COLUMN),
+                              [(mapper.map(r['id']), r['id']) for r in rs])
+        total += len(rs)
+        logging.info('%s: assigned %d new ids' % (table, total))
+
+async def swap(table):
+    """用新ID替换主键，旧ID保存在LEGACY_COLUMN中
+
+    :param table: 表名
+    :return: 替换的行数
+    """
+    # MySQL按顺序执行赋值，先保存旧ID再替换
+    return await orm.execute('update `%s` set `%s`=`id`, `id`=`%s` where length(`id`) > ? and `%s` is not null'
+                             % (table, LEGACY_COLUMN, TEMP_COLUMN, TEMP_COLUMN), [ids.STR_WIDTH])
+
+async def rewrite_references(table, refs):
+    """通过被引用表的LEGACY_COLUMN将仍为旧ID的外键改为新ID
+
+    :param table: 表名
+    :param refs: {外键列: 被引用的表}
+    :return:
+    """
+    for column, parent in refs.items():
+        n = await orm.execute('update `%s` c join `%s` p on c.`%s`=p.`%s` set c.`%s`=p.`id` where length(c.`%s`) > ?'
+                              % (table, parent, column, LEGACY_COLUMN, column, column), [ids.STR_WIDTH])
+        logging.info('%s.%s: rewrote %d references to %s' % (table, column, n, parent))
+
+async def count_legacy_references(table, refs):
+    """统计仍为旧ID的外键
+
+    :param table: 表名
+    :param refs: {外键列: 被引用的表}
+    :return: 外键列 ==> 记录数
+    """
+    counts = dict()
+    for column in refs:
+        rs = await orm.select('select count(*) as `n` from `%s` where length(`%s`) > ?' % (table, column), [ids.STR_WIDTH])
+        if rs[0]['n']:
+            counts[column] = rs[0]['n']
+    return counts
+
+async def migrate(plan=PLAN, batch_size=1000):
+    """执行迁移
+
+    1. 为每张表的旧记录生成新ID
+    2. 用新ID替换主键，旧ID保留在LEGACY_COLUMN中
+    3. 通过LEGACY_COLUMN将外键列改为被引用记录的新ID，迁移期间新写入的旧外键也会被改写
+    4. 删除临时列，缩短ID列
+
+    仍有外键无法对应到被引用记录时（例如被引用的记录已删除）停止迁移，保留临时列，处理后重新运行
+
+    :param plan: 迁移计划，格式同PLAN
+    :param batch_size: 每批处理的行数
+    :return:
+    """
+    for table, _ in plan:
+        await assign(table, batch_size)
+    for table, _ in plan:
+        n = await swap(table)
+        logging.info('%s: replaced %d primary keys' % (table, n))
+    for table, refs in plan:
+        await rewrite_references(table, refs)
+    for table, refs in plan:
+        left = await count_legacy_references(table, refs)
+        if left:
+            raise ValueError('%s still has references to legacy ids that match no row: %s' % (table, left))
+    for table, refs in reversed(plan):    # 先处理引用其他表的表，被引用表的LEGACY_COLUMN最后删除
+        columns = ['drop column `%s`' % TEMP_COLUMN, 'drop column `%s`' % LEGACY_COLUMN,
+                   'modify `id` char(%d) not null' % ids.STR_WIDTH]
+        columns.extend('modify `%s` char(%d) not null' % (c, ids.STR_WIDTH) for c in refs)
+        await orm.execute('alter table `%s` %s' % (table, ', '.join(columns)), [])
+        logging.info('%s: shrank id columns to char(%d)' % (table, ids.STR_WIDTH))
+
+async def count_legacy(plan=PLAN):
+    """统计仍使用旧ID的记录数
+
+    :param plan: 迁移计划
+    :return: 表名 ==> 记录数
+    """
+    counts = dict()
+    for table, _ in plan:
+        rs = await orm.select('select count(*) as `n` from `%s` where length(`id`) > ?' % table, [ids.STR_WIDTH])
+        counts[table] = rs[0]['n']
+    return counts
+
+async def run(loop, args):
+    await orm.create_pool(loop, host=args.host, port=args.port, user=args.user, password=args.password, db=args.db)
+    try:
+        if args.dry_run:
+            for table, n in (await count_legacy()).items():
+                print('%-12s %d rows with legacy ids' % (table, n))
+        else:
+            await migrate(batch_size=args.batch_size)
+    finally:
+        await orm.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate legacy 50-character ids to time-ordered ids.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='www-data')
+    parser.add_argument('--password', default='www-data')
+    parser.add_argument('--db', default='awesome')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true', help='only count rows that still have legacy ids')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop, args))
+
+if __name__ == '__main__':
+    main()
@@ -7,47 +7,64 @@ Models for user, blog, comment.
 
 __author__ = 'Michael Liao'
 
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+import ids
+from orm import Model, StringField, BooleanField, FloatField, TextField, BelongsTo, HasMany
 
 def next_id():
     """生成ID
 
-    :return:ID
+    旧版本的ID为50位的字符串（毫秒时间戳 + uuid4 + '000'），迁移方法见migrate_ids.py
+
+    :return:20位数字字符串，按生成时间排序
     """
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+    return ids.next_id_str()
 
 class User(Model):
     __table__ = 'users'     # 表名
+    __cache__ = dict(maxsize=1000, ttl=5)                                       # 按主键缓存find()的结果，缓存在进程内，其他worker的修改最多5秒后生效
+    __batch_find__ = True                                                       # 合并同一轮事件循环中的find()调用
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')      # ID主键
-    email = StringField(ddl='varchar(50)')                                      # 邮件
+    id = StringField(primary_key=True, default=next_id, ddl='char(20)')         # ID主键
+    email = StringField(ddl='varchar(50)', unique=True)                         # 邮件
     passwd = StringField(ddl='varchar(50)')                                     # 密码
     admin = BooleanField()                                                      # 是否是管理员
     name = StringField(ddl='varchar(50)')                                       # 姓名
     image = StringField(ddl='varchar(500)')                                     # 头像
-    created_at = FloatField(default=time.time)                                  # 创建时间
+    created_at = FloatField(default=time.time, index=True)                      # 创建时间
+
+    blogs = HasMany('Blog', 'user_id', orderBy='created_at desc')               # 用户的日志
 
 class Blog(Model):
     __table__ = 'blogs'     # 表名
+    __counters__ = [(), ('user_id',)]                                           # 维护日志总数以及每个用户的日志数
+    __indexes__ = [('user_id', 'created_at')]                                   # 按用户列出日志
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')      # ID主键
-    user_id = StringField(ddl='varchar(50)')                                    # 用户ID
+    id = StringField(primary_key=True, default=next_id, ddl='char(20)')         # ID主键
+    user_id = StringField(ddl='char(20)')                                       # 用户ID
     user_name = StringField(ddl='varchar(50)')                                  # 用户姓名
     user_image = StringField(ddl='varchar(500)')                                # 用户图像
     name = StringField(ddl='varchar(50)')                                       # 日志标题
     summary = StringField(ddl='varchar(200)')                                   # 简介
-    content = TextField()                                                       # 内容
-    created_at = FloatField(default=time.time)                                  # 创建时间
+    content = TextField()                                                       # 内容，列表页只显示摘要，延迟加载
+    created_at = FloatField(default=time.time, index=True)                      # 创建时间
+
+    user = BelongsTo('User', 'user_id')                                         # 作者
+    comments = HasMany('Comment', 'blog_id', orderBy='created_at desc')         # 日志的评论
 
 class Comment(Model):
     __table__ = 'comments'  # 表名
+    __counters__ = [(), ('blog_id',)]                                           # 维护评论总数以及每篇日志的评论数
+    __indexes__ = [('blog_id', 'created_at')]                                   # 按日志列出评论
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')      # ID主键
-    blog_id = StringField(ddl='varchar(50)')                                    # 日志ID
-    user_id = StringField(ddl='varchar(50)')                                    # 用户ID
+    id = StringField(primary_key=True, default=next_id, ddl='char(20)')         # ID主键
+    blog_id = StringField(ddl='char(20)')                                       # 日志ID
+    user_id = StringField(ddl='char(20)')                                       # 用户ID
     user_name = StringField(ddl='varchar(50)')                                  # 用户名
     user_image = StringField(ddl='varchar(500)')                                # 用户图像
-    content = TextField()                                                       # 内容
-    created_at = FloatField(default=time.time)                                  # 创建时间
\ No newline at end of file
+    content = TextField(deferred=False)                                         # 内容，评论列表需要显示
+    created_at = FloatField(default=time.time, index=True)                      # 创建时间
+
+    blog = BelongsTo('Blog', 'blog_id')                                         # 所属日志
+    user = BelongsTo('User', 'user_id')                                         # 评论者
\ No newline at end of file
@@ -3,34 +3,218 @@
 #!/usr/bin/env python3
 #-*- coding:utf-8 -*-
 
-import asyncio, logging
+import asyncio, logging, time, json, base64, contextlib, contextvars, itertools, re
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
 
 import aiomysql
 
+from metrics import Histogram
+
 def log(sql, args=()):
     """日志函数
 
+    只在DEBUG级别输出，未开启时不做字符串格式化
+
     :param sql:所执行的SQL语句
     :param args:
     :return:
     """
-    logging.info('SQL: %s' % sql)
+    logging.debug('SQL: %s', sql)
+
+class QueryHook(object):
+    """查询指标的导出接口
+
+    通过add_hook()注册，子类按需覆盖方法，例如把指标发送到StatsD或Prometheus
+    """
+
+    def on_query(self, sql, seconds, rows, error):
+        """每条语句执行结束后调用
+
+        :param sql:语句形态（已转换占位符的SQL语句）
+        :param seconds:执行耗时，不含获取链接的等待时间
+        :param rows:返回或影响的行数，出错时为None
+        :param error:是否出错
+        :return:
+        """
+        pass
+
+    def on_acquire(self, seconds):
+        """每次获取链接后调用
+
+        :param seconds:等待链接的时间
+        :return:
+        """
+        pass
+
+    def on_slow_query(self, sql, args, seconds):
+        """语句耗时超过慢查询阈值时调用
+
+        :param sql:SQL语句
+        :param args:参数
+        :param seconds:执行耗时
+        :return:
+        """
+        pass
+
+class StatementStats(object):
+    """单个语句形态的统计"""
+
+    __slots__ = ('calls', 'errors', 'rows', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return dict(calls=self.calls, errors=self.errors, rows=self.rows, latency=self.latency.snapshot())
+
+_hooks = []                         # 已注册的QueryHook
+_statements = dict()                # 语句形态 ==> StatementStats
+_statements_maxsize = 1000          # 超出后的语句形态统一记入'<other>'
+_acquire_wait = Histogram()         # 获取链接的等待时间
+_acquire_timeouts = 0               # 等待链接超时的次数
+_slow_query = None                  # 慢查询阈值（秒），为None时不记录
+
+def add_hook(hook):
+    """注册指标导出接口
+
+    :param hook:QueryHook
+    :return:
+    """
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    """注销指标导出接口
+
+    :param hook:QueryHook
+    :return:
+    """
+    _hooks.remove(hook)
+
+def set_slow_query_threshold(seconds):
+    """设置慢查询阈值
+
+    :param seconds:耗时达到该值的语句以WARNING级别写入日志，为None时关闭
+    :return:
+    """
+    global _slow_query
+    _slow_query = seconds
+
+def _observe(sql, args, started, acquired, rows, error):
+    """记录一条语句的指标
+
+    :param sql:CompiledSQL
+    :param args:参数
+    :param started:开始获取链接的时间
+    :param acquired:获得链接的时间
+    :param rows:返回或影响的行数
+    :param error:是否出错
+    :return:
+    """
+    seconds = time.perf_counter() - acquired
+    wait = acquired - started
+    _acquire_wait.observe(wait)
+    stats = _statements.get(sql)
+    if stats is None:
+        key = sql if len(_statements) < _statements_maxsize else '<other>'
+        stats = _statements.setdefault(key, StatementStats())
+    stats.calls += 1
+    stats.latency.observe(seconds)
+    if error:
+        stats.errors += 1
+    else:
+        stats.rows += rows
+    if _slow_query is not None and seconds >= _slow_query:
+        logging.warning('slow query (%.3fs): %s args: %s', seconds, sql, args)
+        for hook in _hooks:
+            hook.on_slow_query(sql, args, seconds)
+    for hook in _hooks:
+        hook.on_acquire(wait)
+        hook.on_query(sql, seconds, None if error else rows, error)
+
+def query_stats():
+    """导出查询指标
+
+    :return:包含每个语句形态的调用次数/出错次数/行数/延迟分布以及获取链接等待时间的字典
+    """
+    return dict(statements={sql: stats.snapshot() for sql, stats in _statements.items()},
+                acquire_wait=_acquire_wait.snapshot(), acquire_timeouts=_acquire_timeouts)
+
+def pool_stats():
+    """导出链接池状态
+
+    :return:主库和各副本链接池的 in_use/idle/size/maxsize
+    """
+    def gauges(pool):
+        return dict(in_use=pool.size - pool.freesize, idle=pool.freesize, size=pool.size, maxsize=pool.maxsize)
+    return dict(primary=gauges(__pool), replicas=[gauges(pool) for pool in __replicas])
+
+def reset_stats():
+    """清空查询指标
+
+    :return:
+    """
+    global _acquire_wait, _acquire_timeouts
+    _statements.clear()
+    _acquire_wait = Histogram()
+    _acquire_timeouts = 0
 
-async def create_pool(loop, **kw):
+async def create_pool(loop, replicas=None, replica_policy='round_robin', slow_query=None, driver=None, acquire_timeout=None, **kw):
     """ 创建MySQL链接池
 
+    读操作可以分流到只读副本：select()/find*()默认使用副本，写操作以及事务中的语句始终使用主库
+
     :param loop: 事件循环实例
+    :param replicas: 只读副本的参数队列，每项为一个字典，未指定的参数沿用主库的参数，例如：[dict(host='10.0.0.2')]
+    :param replica_policy: 副本选择方式，'round_robin'为轮询，'least_busy'为选择正在使用的链接最少的副本
+    :param slow_query: 慢查询阈值（秒）
+    :param driver: 数据库驱动，默认为aiomysql，基准测试中可以传入fakedb.FakeDriver
+    :param acquire_timeout: 链接池已满时等待链接的最长时间（秒），超时抛出PoolTimeoutError，为None时一直等待
     :param kw:参数
     :return:
     """
     logging.info('create database connection pool...')
-    global __pool   # 创建全局__pool对象
+    global __pool, __replicas, __replica_policy, _driver, _default_acquire_timeout   # 创建全局__pool对象
+    if replica_policy not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid replica policy: %s' % replica_policy)
+
+    _driver = driver or aiomysql
+    set_placeholder(getattr(_driver, 'placeholder', '%s'))
+    __pool = await _create_pool(loop, kw)
+    __replicas = []
+    for replica in replicas or []:
+        logging.info('create replica connection pool for %s:%s...' % (replica.get('host', kw.get('host', 'localhost')),
+                                                                       replica.get('port', kw.get('port', 3306))))
+        __replicas.append(await _create_pool(loop, dict(kw, **replica)))
+    __replica_policy = replica_policy
+    _default_acquire_timeout = acquire_timeout
+    set_slow_query_threshold(slow_query)
+
+async def close_pool():
+    """关闭主库和副本链接池，等待正在使用的链接归还
 
-    __pool = await aiomysql.create_pool(        # 创建池 create_pool(minsize=1, maxsize=10, loop=None, **kwargs)
+    :return:
+    """
+    global __pool, __replicas
+    if __pool is not None:
+        await flush_counters()
+    pools = ([__pool] if __pool is not None else []) + __replicas
+    __pool, __replicas = None, []
+    for pool in pools:
+        pool.close()
+    for pool in pools:
+        await pool.wait_closed()
+
+async def _create_pool(loop, kw):
+    return await _driver.create_pool(           # 创建池 create_pool(minsize=1, maxsize=10, loop=None, **kwargs)
         host=kw.get('host', 'localhost'),       # Mysql服务器地址
         port=kw.get('port', 3306),              # 服务器端口
-        user=kw['user'],                        # 用户名
-        password=kw['password'],                # 密码
+        user=kw.get('user'),                    # 用户名
+        password=kw.get('password', ''),        # 密码
         db=kw['db'],                            # 所用数据库名
         charset=kw.get('charset', 'utf8'),      # 字符集
         autocommit=kw.get('autocommit', True),  # 是否自动提交
@@ -39,27 +223,312 @@ async def create_pool(loop, **kw):
         loop=loop                               # 事件循环实例
     )
 
-async def select(sql, args, size=None):
+_driver = aiomysql                  # 数据库驱动，也可以是fakedb.FakeDriver或sqlitedb.SQLiteDriver
+__pool = None                       # 主库链接池
+__replicas = []                     # 只读副本链接池
+__replica_policy = 'round_robin'    # 副本选择方式
+_replica_counter = itertools.count()
+
+def dialect():
+    """当前驱动的SQL方言
+
+    :return:'mysql'或'sqlite'
+    """
+    return getattr(_driver, 'dialect', 'mysql')
+
+def pick_replica():
+    """选择一个只读副本链接池
+
+    :return:副本链接池，没有副本时返回None
+    """
+    if not __replicas:
+        return None
+    if __replica_policy == 'least_busy':    # 正在使用的链接最少
+        return min(__replicas, key=lambda pool: pool.size - pool.freesize)
+    return __replicas[next(_replica_counter) % len(__replicas)]
+
+_transaction = contextvars.ContextVar('orm_transaction', default=None)    # 当前上下文中的事务
+
+class _Lease(object):
+    """借用事务绑定的链接
+
+    同一事务中的语句可能来自并发的子任务，借用时加锁保证同一时刻只有一条语句使用该链接
+    """
+
+    def __init__(self, tx):
+        self.tx = tx
+
+    async def __aenter__(self):
+        await self.tx.lock.acquire()
+        return self.tx.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.tx.lock.release()
+
+class PoolTimeoutError(Exception):
+    """等待链接池中的链接超时"""
+    pass
+
+_default_acquire_timeout = None                                             # 等待链接的默认最长时间
+_acquire_timeout = contextvars.ContextVar('orm_acquire_timeout', default=None)  # 当前上下文中等待链接的最长时间
+
+@contextlib.contextmanager
+def acquire_timeout(seconds):
+    """在with块中使用指定的等待链接最长时间，例如按请求类型设置不同的期限
+
+    :param seconds:最长等待时间（秒），为None时使用create_pool()的设置
+    :return:
+    """
+    token = _acquire_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _acquire_timeout.reset(token)
+
+def pool_saturated():
+    """主库链接池是否已满，此时新的语句需要排队等待链接
+
+    :return:
+    """
+    pool = __pool
+    return pool is not None and pool.freesize == 0 and pool.size >= pool.maxsize
+
+def _idle(pool):
+    """能否不等待地获取链接
+
+    需要有空闲链接；aiomysql补充链接期间持有_cond，此时获取链接要先排队，空闲链接可能被其他协程拿走，
+    之后在_cond.wait()中等待，因此也按需要等待处理
+
+    :param pool:链接池
+    :return:
+    """
+    if pool.freesize == 0:
+        return False
+    cond = getattr(pool, '_cond', None)
+    return cond is None or not cond.locked()
+
+class _TimedAcquire(object):
+    """带超时的链接获取
+
+    超时后取消等待；如果取消时恰好已经拿到链接，则立即归还，不会泄漏链接
+    """
+
+    def __init__(self, ctx, timeout):
+        self.ctx = ctx
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        global _acquire_timeouts
+        task = asyncio.ensure_future(self.ctx.__aenter__())
+        try:
+            done, _ = await asyncio.wait((task,), timeout=self.timeout)
+        except asyncio.CancelledError:
+            self._abandon(task)
+            raise
+        if not done:
+            self._abandon(task)
+            _acquire_timeouts += 1
+            raise PoolTimeoutError('Timed out after %.3fs waiting for a database connection' % self.timeout)
+        return task.result()
+
+    def _abandon(self, task):
+        def release(task):
+            if not task.cancelled() and task.exception() is None:
+                asyncio.ensure_future(self.ctx.__aexit__(None, None, None))
+        task.cancel()
+        task.add_done_callback(release)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self.ctx.__aexit__(exc_type, exc, tb)
+
+def acquire(readonly=False):
+    """获取执行语句所用的链接
+
+    在事务中返回事务绑定的链接，只读语句从副本链接池中获取，其他语句从主库链接池中获取；
+    需要等待链接且设置了等待期限时，超时抛出PoolTimeoutError
+
+    :param readonly:是否为可以在副本上执行的只读语句
+    :return:异步上下文管理器，进入时返回链接对象
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        return _Lease(tx)
+    pool = pick_replica() if readonly and __replicas else __pool
+    timeout = _acquire_timeout.get()
+    if timeout is None:
+        timeout = _default_acquire_timeout
+    if timeout is not None and not _idle(pool):    # 能立即拿到链接时不计时，不创建Task
+        return _TimedAcquire(pool.get(), timeout)
+    return pool.get()
+
+def on_commit(callback, always=False):
+    """登记事务结束后执行的回调
+
+    不在事务中时立即执行
+
+    :param callback:无参回调函数
+    :param always:为True时事务回滚后也执行，否则只在提交后执行
+    :return:
+    """
+    tx = _transaction.get()
+    if tx is None:
+        callback()
+    else:
+        tx.root.callbacks.append((callback, always))
+
+def on_rollback(callback):
+    """登记事务（或保存点）回滚后执行的回调，用于撤销内存中的状态
+
+    不在事务中时不执行；回滚时按登记的相反顺序执行
+
+    :param callback:无参回调函数
+    :return:
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        tx.rollbacks.append(callback)
+
+_change_listeners = []      # 数据变更监听函数
+
+def add_change_listener(listener):
+    """注册数据变更监听函数
+
+    Model写入成功后调用 listener(model, action, objs)，action为'save'/'update'/'remove'，
+    objs为受影响的对象队列；在事务中则等到提交后才调用
+
+    :param listener:监听函数
+    :return:
+    """
+    _change_listeners.append(listener)
+
+def notify_change(model, action, objs):
+    """通知数据变更
+
+    :param model:模型类
+    :param action:'save'/'update'/'remove'
+    :param objs:受影响的对象队列
+    :return:
+    """
+    if not _change_listeners:
+        return
+    def callback():
+        for listener in _change_listeners:
+            listener(model, action, objs)
+    on_commit(callback)
+
+class Transaction(object):
+    """事务
+
+    用法：async with orm.transaction() as tx: ...
+    作用域内的select/execute以及Model的save/update/remove都在同一个链接上执行，
+    退出时统一提交或回滚；嵌套使用时以保存点实现
+    """
+
+    def __init__(self):
+        self.conn = None            # 事务绑定的链接
+        self.root = self            # 最外层事务
+        self.lock = None            # 链接锁
+        self.savepoint = None       # 嵌套事务的保存点名称
+        self.savepoints = 0         # 已创建的保存点数量（仅最外层事务使用）
+        self.callbacks = []         # 事务结束后执行的回调（仅最外层事务使用）
+        self.parent = None          # 外层事务
+        self.rollbacks = []         # 本事务回滚后执行的回调，提交保存点时转交外层事务
+        self._mark = 0
+        self._pool_ctx = None
+        self._token = None
+
+    async def _run(self, sql):
+        async with _Lease(self) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql)
+
+    async def __aenter__(self):
+        parent = _transaction.get()
+        if parent is not None:      # 嵌套事务，创建保存点
+            self.parent = parent
+            self.root = parent.root
+            self.conn = parent.conn
+            self.lock = parent.lock
+            self.root.savepoints += 1
+            self.savepoint = 'sp_%d' % self.root.savepoints
+            self._mark = len(self.root.callbacks)
+            await self._run('savepoint %s' % self.savepoint)
+        else:
+            self._pool_ctx = acquire()      # 不在事务中，从链接池中获取链接
+            self.conn = await self._pool_ctx.__aenter__()
+            self.lock = asyncio.Lock()
+            try:
+                await self.conn.begin()
+            except BaseException:
+                await self._pool_ctx.__aexit__(None, None, None)
+                raise
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _transaction.reset(self._token)
+        if self.savepoint is not None:
+            if exc_type is None:
+                await self._run('release savepoint %s' % self.savepoint)
+                self.parent.rollbacks.extend(self.rollbacks)    # 外层事务仍可能回滚
+            else:                   # 回滚到保存点，丢弃保存点之后登记的提交回调
+                await self._run('rollback to savepoint %s' % self.savepoint)
+                root = self.root
+                root.callbacks = root.callbacks[:self._mark] + [c for c in root.callbacks[self._mark:] if c[1]]
+                for callback in reversed(self.rollbacks):
+                    callback()
+            return False
+        committed = False
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+                committed = True
+            else:
+                await self.conn.rollback()
+        finally:
+            await self._pool_ctx.__aexit__(None, None, None)
+            if not committed:
+                for callback in reversed(self.rollbacks):
+                    callback()
+            for callback, always in self.callbacks:
+                if committed or always:
+                    callback()
+        return False
+
+def transaction():
+    """开始一个事务
+
+    :return:Transaction，配合 async with 使用
+    """
+    return Transaction()
+
+async def select(sql, args, size=None, tuples=False, primary=False):
     """数据库select操作
 
     :param sql:查询语句
     :param args:查询值
     :param size:指定的返回数量
+    :param tuples:是否以元组而不是字典的形式返回每行记录
+    :param primary:是否强制在主库上查询，用于需要读到刚写入数据的场合
     :return:
     """
     log(sql, args)  # 日志中记录SQL语句和查询值
-    global __pool   # 链接池
-    async with __pool.get() as conn:    # 从链接池中获取链接对象
-        async with conn.cursor(aiomysql.DictCursor) as cur:         # 获取游标
-            await cur.execute(sql.replace('?', '%s'), args or ())   # 先将SQL语句中的'?'替换为查询值，如果值为None则设置为空元组，然后执行SQL语句
-            if size:
-                # 取出指定数量的记录
-                rs = await  cur.fetchmany(size)
-            else:
-                # 取出所有记录
-                rs = await cur.fetchall()
-
-        logging.info('row returned: %s' % len(rs))  # 返回查询的记录条数
+    sql = driver_sql(sql)   # 先将SQL语句中的'?'替换为驱动的占位符
+    started = time.perf_counter()
+    async with acquire(not primary) as conn:    # 获取事务绑定的链接或者从链接池中获取链接对象
+        acquired = time.perf_counter()
+        rs = None
+        try:
+            async with conn.cursor(_driver.Cursor if tuples else _driver.DictCursor) as cur:   # 获取游标
+                await cur.execute(sql, args or ())  # 如果值为None则设置为空元组，然后执行SQL语句
+                if size:
+                    # 取出指定数量的记录
+                    rs = await  cur.fetchmany(size)
+                else:
+                    # 取出所有记录
+                    rs = await cur.fetchall()
+        finally:
+            _observe(sql, args, started, acquired, len(rs) if rs is not None else 0, rs is None)   # 记录耗时和返回的记录条数
         return rs
 
 async def execute(sql, args, autocommit=True):
@@ -72,21 +541,107 @@ async def execute(sql, args, autocommit=True):
     """
 
     log(sql)    # 日志SQL语句
-    async with __pool.get() as conn:    # 从链接池中获取链接对象
+    sql = driver_sql(sql)               # 先将SQL语句中的'?'替换为驱动的占位符
+    autocommit = autocommit or _transaction.get() is not None  # 在事务中由事务统一提交
+    started = time.perf_counter()
+    async with acquire() as conn:       # 获取事务绑定的链接或者从链接池中获取链接对象
+        acquired = time.perf_counter()
+        affected = None
         if not autocommit:              # 如果不自动提交
             await conn.begin()          # 开始链接
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur: # 获取游标
-                await cur.execute(sql.replace('?','%s'), args)  # 先将SQL语句中的'?'替换为查询值，如果值为None则设置为空元组，然后执行SQL语句
+            async with conn.cursor(_driver.DictCursor) as cur:  # 获取游标
+                await cur.execute(sql, args)                    # 执行SQL语句
                 affected = cur.rowcount # 所影响的行数
             if not autocommit:          # 如果不自动提交
                 await conn.commit()     # 提交链接
         except BaseException as e:      # 如果存在错误
             if not autocommit:          # 如果不自动提交
                 await conn.rollback()   # 滚回
+            affected = None
             raise                       # 抛出错误
+        finally:
+            _observe(sql, args, started, acquired, affected or 0, affected is None)
         return affected                 # 返回所影响的函数
 
+async def executemany(sql, args_list, batch_size=None, autocommit=True):
+    """数据库批量执行操作
+
+    在同一个链接上分批执行同一条SQL语句，INSERT语句会被驱动合并为多行插入
+
+    :param sql: SQL语句
+    :param args_list: 参数列表，每一项对应一行的参数
+    :param batch_size: 每批的行数，为None时一次全部执行
+    :param autocommit: 是否自动提交
+    :return: 返回每一批所影响的行数列表
+    """
+    log(sql)
+    sql = driver_sql(sql)
+    args_list = list(args_list)
+    if not args_list:                   # 没有数据则不需要获取链接
+        return []
+    batch_size = batch_size or len(args_list)
+    autocommit = autocommit or _transaction.get() is not None
+    result = []
+    started = time.perf_counter()
+    async with acquire() as conn:       # 所有批次共用一个链接
+        acquired = time.perf_counter()
+        error = True
+        if not autocommit:
+            await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                for i in range(0, len(args_list), batch_size):
+                    await cur.executemany(sql, args_list[i:i + batch_size])  # 多行插入
+                    result.append(cur.rowcount)
+            if not autocommit:
+                await conn.commit()
+            error = False
+        except BaseException:
+            if not autocommit:
+                await conn.rollback()
+            raise
+        finally:
+            _observe(sql, None, started, acquired, sum(result), error)
+        return result
+
+async def select_iter(sql, args, chunk_size=100, primary=False):
+    """数据库流式select操作
+
+    使用无缓冲的服务端游标按批取出记录，只在迭代期间占用链接，内存占用与结果集大小无关；
+    在事务中无法在迭代的同时执行其他语句，因此一次取出全部记录
+
+    :param sql:查询语句
+    :param args:查询值
+    :param chunk_size:每次从服务端取出的记录数
+    :param primary:是否强制在主库上查询
+    :return:逐条返回记录的异步生成器
+    """
+    if _transaction.get() is not None:
+        for r in await select(sql, args):
+            yield r
+        return
+    log(sql, args)
+    sql = driver_sql(sql)
+    started = time.perf_counter()
+    async with acquire(not primary) as conn:
+        acquired = time.perf_counter()
+        rows = 0
+        error = True
+        try:
+            async with conn.cursor(_driver.SSDictCursor) as cur:  # 无缓冲游标
+                await cur.execute(sql, args or ())
+                while True:
+                    rs = await cur.fetchmany(chunk_size)
+                    if not rs:
+                        break
+                    rows += len(rs)
+                    for r in rs:
+                        yield r
+            error = False
+        finally:
+            _observe(sql, args, started, acquired, rows, error)    # 耗时包括调用方处理记录的时间
+
 def create_args_string(num):
     """创建参数字符串
 
@@ -98,23 +653,570 @@ def create_args_string(num):
         L.append('?')       # 添加'?'到队列
     return ', '.join(L)     # 使用', '分割队列组成字符串。例如：'?, ?, ...'
 
+def encode_page_cursor(value, key):
+    """生成分页游标
+
+    :param value:当前页最后一条记录排序字段的值
+    :param key:当前页最后一条记录的主键
+    :return:不透明的游标字符串
+    """
+    return base64.urlsafe_b64encode(json.dumps([value, key]).encode('utf-8')).decode('ascii')
+
+def decode_page_cursor(cursor):
+    """解析分页游标
+
+    :param cursor:encode_page_cursor()生成的游标字符串
+    :return:(排序字段的值, 主键)
+    """
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('Invalid page cursor: %s' % cursor)
+    return value, key
+
+class LRUCache(object):
+    """LRU缓存
+
+    超出容量时淘汰最久未使用的条目，可选TTL过期，并记录命中/未命中/淘汰次数
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """初始化
+
+        :param maxsize:最大条目数
+        :param ttl:过期时间（秒），为None时永不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()      # key ==> (value, 过期时间)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """获取缓存值
+
+        :param key:键
+        :param default:未命中时返回的值
+        :return:缓存值
+        """
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires is not None and expires < time.monotonic():  # 已过期则删除
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)     # 标记为最近使用
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """写入缓存值，超出容量时淘汰最久未使用的条目
+
+        :param key:键
+        :param value:值
+        :return:
+        """
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        """删除缓存值
+
+        :param key:键
+        :return:
+        """
+        self._data.pop(key, None)
+
+    def clear(self):
+        """清空缓存
+
+        :return:
+        """
+        self._data.clear()
+
+    def stats(self):
+        """缓存统计
+
+        :return:包含命中/未命中/淘汰/过期次数及当前大小的字典
+        """
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    expirations=self.expirations, size=len(self._data), maxsize=self.maxsize)
+
+class CompiledSQL(str):
+    """已转换为驱动占位符的SQL语句
+
+    select()/execute()遇到该类型时不再做'?'的替换
+    """
+    pass
+
+_compiled = {}          # 已编译的SQL语句缓存，SQL语句或查询形态 ==> CompiledSQL
+_compiled_maxsize = 1024
+_placeholder = '%s'     # 驱动的参数占位符
+
+def set_placeholder(placeholder):
+    """设置驱动的参数占位符，改变时清空已编译的SQL语句
+
+    :param placeholder:aiomysql为'%s'，sqlite3为'?'
+    :return:
+    """
+    global _placeholder
+    if placeholder != _placeholder:
+        _placeholder = placeholder
+        _compiled.clear()
+
+def compile_sql(sql, key=None):
+    """将使用'?'占位符的SQL语句转换为驱动的占位符，同一语句只转换一次
+
+    按查询形态缓存时调用方先用 _compiled.get(key) 查找，未命中时才拼接SQL语句
+
+    :param sql:SQL语句
+    :param key:缓存键，默认为SQL语句本身
+    :return:CompiledSQL
+    """
+    if key is None:
+        key = sql
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = CompiledSQL(sql if _placeholder == '?' else sql.replace('?', _placeholder))
+        if len(_compiled) >= _compiled_maxsize:    # 超出容量时淘汰最早加入的语句
+            del _compiled[next(iter(_compiled))]
+        _compiled[key] = compiled
+    return compiled
+
+def driver_sql(sql):
+    """获取可以直接交给驱动执行的SQL语句
+
+    :param sql:SQL语句
+    :return:CompiledSQL
+    """
+    if type(sql) is CompiledSQL:
+        return sql
+    return compile_sql(sql)
+
+def make_record_class(name, columns):
+    """生成紧凑的记录类
+
+    记录类是声明了__slots__的namedtuple子类，直接由元组游标返回的行构造，
+    每行只占用一个元组，不需要像Model那样为每行创建字典，适合只读的列表页
+
+    :param name:模型类名
+    :param columns:列名队列，顺序与查询语句中的列一致
+    :return:记录类
+    """
+    base = namedtuple('%sRecord' % name, columns)
+
+    def to_dict(self):
+        """转换为字典，用于JSON序列化
+
+        :return:列名 ==> 值
+        """
+        return dict(zip(self._fields, self))
+
+    return type(base.__name__, (base,), dict(__slots__=(), to_dict=to_dict))
+
+def select_list(columns):
+    """生成SELECT的列部分
+
+    :param columns:列名队列
+    :return:例如：`id`, `name`
+    """
+    return ', '.join('`%s`' % c for c in columns)
+
+def _padded_in_chunks(keys, batch_size):
+    """把参数分批，每批的参数个数补齐到2的幂（重复最后一个值），减少需要缓存的查询形态
+
+    :param keys:参数队列
+    :param batch_size:每批最多包含的参数数量
+    :return:(补齐后的参数个数, 补齐后的参数队列)的生成器
+    """
+    for i in range(0, len(keys), batch_size):
+        chunk = keys[i:i + batch_size]
+        n = 1 << (len(chunk) - 1).bit_length()
+        yield n, chunk + [chunk[-1]] * (n - len(chunk))
+
+def normalize_key(value):
+    """主键的比较形式
+
+    数据库返回的主键可能与调用方传入的不同，例如整数主键传入了'5'，或char列带有尾部空格
+
+    :param value:主键值
+    :return:字符串
+    """
+    return value.rstrip(' ') if isinstance(value, str) else str(value)
+
+class FindBatcher(object):
+    """合并find()调用
+
+    同一轮事件循环中对同一模型的并发find()调用会被合并为一次批量查询，
+    模型声明 __batch_find__ = True 时启用
+    """
+
+    def __init__(self, model):
+        """初始化
+
+        :param model:模型类
+        """
+        self.model = model
+        self.pending = None     # 等待查询的主键 ==> future队列
+
+    def load(self, pk):
+        """登记一次查找，在本轮事件循环结束时统一查询
+
+        :param pk:主键
+        :return:查找结果的future
+        """
+        loop = asyncio.get_event_loop()
+        if self.pending is None:    # 本轮第一次查找时安排批量查询
+            self.pending = dict()
+            loop.call_soon(self._dispatch, loop)
+        future = loop.create_future()
+        self.pending.setdefault(pk, []).append(future)
+        return future
+
+    def _dispatch(self, loop):
+        pending, self.pending = self.pending, None
+        loop.create_task(self._load(pending))
+
+    async def _load(self, pending):
+        try:
+            rows = await self.model._fetchMany(list(pending))  # find()已经查找过缓存，不再重复查找
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for pk, futures in pending.items():
+            row = rows.get(normalize_key(pk))
+            for future in futures:
+                if not future.done():   # 每个调用方都拿到独立的对象
+                    future.set_result(None if row is None else self.model._fromRow(row))
+
+COUNTER_TABLE = 'counters'
+TABLE_OPTIONS = dict(mysql=' engine=innodb default charset=utf8', sqlite='')    # 各方言建表语句的表选项
+
+def counter_ddl(dialect_name=None):
+    """生成计数表的建表语句
+
+    :param dialect_name:SQL方言，默认为当前驱动的方言
+    :return:
+    """
+    return ('create table if not exists `%s` ('
+            '`name` varchar(100) not null, '            # 表名:维度列，例如：comments:blog_id，总数为comments:*
+            '`k` varchar(255) not null, '               # 维度值的JSON数组
+            '`n` bigint not null, '
+            '`updated_at` real not null, '
+            'primary key (`name`, `k`))%s' % (COUNTER_TABLE, TABLE_OPTIONS[dialect_name or dialect()]))
+
+def upsert_sql(table, keys, columns):
+    """生成插入或更新的语句
+
+    :param table:表名
+    :param keys:主键列
+    :param columns:其余的列，主键已存在时更新这些列
+    :return:使用'?'占位符的SQL语句
+    """
+    names = list(keys) + list(columns)
+    sql = 'insert into `%s` (%s) values (%s)' % (table, ', '.join('`%s`' % c for c in names), create_args_string(len(names)))
+    if dialect() == 'sqlite':
+        return '%s on conflict (%s) do update set %s' % (sql, ', '.join('`%s`' % c for c in keys),
+                                                         ', '.join('`%s`=excluded.`%s`' % (c, c) for c in columns))
+    return '%s on duplicate key update %s' % (sql, ', '.join('`%s`=values(`%s`)' % (c, c) for c in columns))
+_COUNT_FIELD_RE = re.compile(r'^count\((\*|1|`?\w+`?)\)$', re.I)
+_EQ_TERM_RE = re.compile(r'^`?(\w+)`?\s*=\s*\?$')
+_AND_RE = re.compile(r'\s+and\s+', re.I)
+_counter_sets = []
+
+class CounterSet(object):
+    """维护模型的计数器，代替findNumber()中的COUNT(*)查询
+
+    模型声明 __counters__ = [(), ('blog_id',)] 表示维护总数以及每个blog_id的记录数。
+    save()/remove()提交后在内存中累计增量，定期合并写入计数表；读取时使用计数表中的值加上本进程未写入的增量，
+    计数表中没有对应的行时执行一次真实的COUNT(*)初始化。
+    update()修改维度列、其他进程尚未写入的增量等造成的偏差由定期的校对修正，因此计数是近似值。
+    计数表不可用（例如尚未创建）时记录一次警告，retry_interval内findNumber()改用COUNT(*)
+    """
+
+    def __init__(self, model, dimensions, flush_interval=1.0, ttl=5.0, reconcile_interval=3600.0, retry_interval=60.0):
+        """初始化
+
+        :param model:模型类
+        :param dimensions:维度列表，每个维度为列名元组，()表示总数
+        :param flush_interval:增量写入计数表的间隔（秒）
+        :param ttl:从计数表读取的值在内存中的有效期（秒）
+        :param reconcile_interval:用真实COUNT(*)校对计数表的间隔（秒），为None时不校对
+        :param retry_interval:计数表出错后暂停使用的时间（秒）
+        """
+        self.model = model
+        self.dimensions = [tuple(d) for d in dimensions]
+        self.columns = list(dict.fromkeys(c for d in self.dimensions for c in d))   # 所有维度列
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.reconcile_interval = reconcile_interval
+        self.retry_interval = retry_interval
+        self._unavailable_until = 0.0  # 计数表出错后在此之前不使用计数器
+        self._failing = False
+        self._where = dict()        # where语句 ==> (维度, 参数在维度中的顺序)，不能使用计数器时为None
+        self._cache = dict()        # (维度名, 键) ==> (计数, 过期时间)
+        self._pending = dict()      # (维度名, 键) ==> 未写入计数表的增量
+        self._task = None
+        self._last_reconcile = time.monotonic()
+        self.hits = self.misses = 0
+
+    def _name(self, dimension):
+        return '%s:%s' % (self.model.__table__, ','.join(dimension) or '*')
+
+    def _fail(self, e):
+        """计数表出错，retry_interval内不再使用，只在开始出错时记录一次警告
+
+        :param e:异常
+        :return:
+        """
+        self._unavailable_until = time.monotonic() + self.retry_interval
+        if not self._failing:
+            self._failing = True
+            logging.warning('counters of %s are unavailable, findNumber() falls back to COUNT(*): %s'
+                            % (self.model.__table__, e))
+
+    def _recover(self):
+        if self._failing:
+            self._failing = False
+            logging.info('counters of %s are available again' % self.model.__table__)
+
+    def match(self, selectField, where):
+        """判断findNumber()的查询能否由计数器回答
+
+        支持 count(*)/count(1)/count(主键) 且where为空或者由and连接的 `列`=? 条件
+
+        :param selectField:查找字段
+        :param where:where语句
+        :return:(维度, 参数顺序)，不能使用计数器时返回None
+        """
+        m = _COUNT_FIELD_RE.match(selectField.strip())
+        if m is None or m.group(1).strip('`') not in ('*', '1', self.model.__primary_key__):
+            return None
+        if where in self._where:
+            return self._where[where]
+        matched = None
+        columns = []
+        for term in (_AND_RE.split(where.strip()) if where else []):
+            t = _EQ_TERM_RE.match(term.strip())
+            if t is None:
+                columns = None
+                break
+            columns.append(t.group(1))
+        if columns is not None:
+            for dimension in self.dimensions:
+                if sorted(dimension) == sorted(columns):
+                    matched = (dimension, [columns.index(c) for c in dimension])
+                    break
+        self._where[where] = matched
+        return matched
+
+    async def count(self, selectField, where, args):
+        """查询计数
+
+        :param selectField:查找字段
+        :param where:where语句
+        :param args:参数
+        :return:计数，不能使用计数器时返回None
+        """
+        matched = self.match(selectField, where)
+        if matched is None or time.monotonic() < self._unavailable_until:
+            return None
+        dimension, order = matched
+        key = (self._name(dimension), json.dumps([args[i] for i in order]))
+        entry = self._cache.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            try:
+                n = await self._load(key, where, args)
+            except Exception as e:
+                self._fail(e)
+                return None
+            self._recover()
+            entry = (n, time.monotonic() + self.ttl)
+            self._cache[key] = entry
+        else:
+            self.hits += 1
+        return entry[0] + self._pending.get(key, 0)
+
+    async def _load(self, key, where, args):
+        rs = await select('select `n` from `%s` where `name`=? and `k`=?' % COUNTER_TABLE, list(key), 1, primary=True)
+        if rs:
+            return rs[0]['n']
+        sql = 'select count(*) _num_ from `%s`' % self.model.__table__   # 计数表中没有记录时用真实COUNT(*)初始化
+        if where:
+            sql = '%s where %s' % (sql, where)
+        rs = await select(sql, args, 1, primary=True)
+        n = rs[0]['_num_'] - self._pending.get(key, 0)  # 尚未写入的增量已经包含在真实计数中
+        await execute(upsert_sql(COUNTER_TABLE, ('name', 'k'), ('n', 'updated_at')), [key[0], key[1], n, time.time()])
+        return n
+
+    def on_change(self, model, action, objs):
+        """数据变更监听函数，在提交后累计增量
+
+        :return:
+        """
+        if model is not self.model or action not in ('save', 'remove'):
+            return
+        delta = 1 if action == 'save' else -1
+        pending = self._pending
+        for dimension in self.dimensions:
+            name = self._name(dimension)
+            for obj in objs:
+                key = (name, json.dumps([obj.getValue(c) for c in dimension]))
+                pending[key] = pending.get(key, 0) + delta
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() < self._unavailable_until:
+                continue
+            try:
+                await self.flush()
+                if self.reconcile_interval is not None and \
+                        time.monotonic() - self._last_reconcile >= self.reconcile_interval:
+                    await self.reconcile()
+            except Exception as e:
+                self._fail(e)
+
+    async def flush(self):
+        """将累计的增量写入计数表
+
+        :return:
+        """
+        pending, self._pending = self._pending, dict()
+        items = [(delta, time.time(), name, k) for (name, k), delta in pending.items() if delta]
+        if not items:
+            return
+        try:
+            await executemany('update `%s` set `n`=`n`+?, `updated_at`=? where `name`=? and `k`=?' % COUNTER_TABLE, items)
+        except BaseException:
+            for key, delta in pending.items():  # 写入失败时保留增量，下次重试
+                self._pending[key] = self._pending.get(key, 0) + delta
+            raise
+        self._recover()
+        for key, delta in pending.items():      # 计数表中没有的行在读取时初始化，内存中的值同步加上增量
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache[key] = (entry[0] + delta, entry[1])
+
+    async def reconcile(self):
+        """用真实COUNT(*)校对计数表中本模型的所有计数
+
+        每个维度执行一次GROUP BY全表扫描，应在低峰期或较长的间隔执行
+
+        :return:
+        """
+        self._last_reconcile = time.monotonic()
+        await self.flush()
+        table = self.model.__table__
+        for dimension in self.dimensions:
+            name = self._name(dimension)
+            if dimension:
+                columns = ', '.join('`%s`' % c for c in dimension)
+                rs = await select('select %s, count(*) _num_ from `%s` group by %s' % (columns, table, columns),
+                                  [], tuples=True, primary=True)
+                actual = {json.dumps(list(r[:-1])): r[-1] for r in rs}
+            else:
+                rs = await select('select count(*) _num_ from `%s`' % table, [], tuples=True, primary=True)
+                actual = {json.dumps([]): rs[0][0]}
+            rs = await select('select `k`, `n` from `%s` where `name`=?' % COUNTER_TABLE, [name], tuples=True, primary=True)
+            fixes = [(actual.get(k, 0), time.time(), name, k) for k, n in rs if actual.get(k, 0) != n]
+            if fixes:
+                logging.info('reconcile counters %s: %d corrected' % (name, len(fixes)))
+                await executemany('update `%s` set `n`=?, `updated_at`=? where `name`=? and `k`=?' % COUNTER_TABLE, fixes)
+        self._cache.clear()
+
+    def stats(self):
+        """计数器统计信息
+
+        :return:
+        """
+        return dict(hits=self.hits, misses=self.misses, cached=len(self._cache), pending=len(self._pending),
+                    unavailable=self._failing)
+
+async def create_counter_table():
+    """创建计数表
+
+    :return:
+    """
+    await execute(counter_ddl(), [])
+
+async def flush_counters():
+    """写入所有模型累计的计数增量，关闭链接池前调用
+
+    :return:
+    """
+    for counters in _counter_sets:
+        if counters._task is not None:
+            counters._task.cancel()
+            counters._task = None
+        await counters.flush()
+
+class Index(object):
+    """索引声明
+
+    用于模型的__indexes__，例如：__indexes__ = [('blog_id', 'created_at'), Index('email', unique=True)]
+    """
+
+    def __init__(self, *columns, unique=False, name=None):
+        """初始化
+
+        :param columns:列名，多个列为联合索引
+        :param unique:是否为唯一索引
+        :param name:索引名，默认为idx_表名_列名或uniq_表名_列名（SQLite中索引名在整个数据库内唯一）
+        """
+        if not columns:
+            raise ValueError('Index needs at least one column')
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name
+
+    def __str__(self):
+        return '<Index %s (%s)%s>' % (self.name, ', '.join(self.columns), ' unique' if self.unique else '')
+
 class Field(object):
     """字段基类
 
     """
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False, deferred=False):
         """初始化
 
         :param name:名称
         :param column_type:列类型
         :param primary_key:是否为主键
         :param default:默认值
+        :param index:是否为该列单独建立索引
+        :param unique:是否为该列建立唯一索引
+        :param deferred:是否延迟加载，延迟加载的列不在findAll()等列表查询的默认列中，需要时通过load()批量读取
         """
+        if primary_key and deferred:
+            raise ValueError('Primary key can not be deferred')
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
+        self.unique = unique
+        self.deferred = deferred
 
     def __str__(self):
         """打印字段信息
@@ -129,69 +1231,279 @@ class StringField(Field):
 
     """
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
+    def __init__(self, name=None, primary_key=False, default=None, ddl=None, index=False, unique=False):
         """初始化
 
+        使用20位时间有序ID作为主键时需指定default=ids.next_id_str和ddl='char(20)'
+
         :param name:名称
         :param primary_key:是否为主键（默认为否）
         :param default:默认值
         :param ddl:数据定义语言，这里本质是对应列类型
+        :param index:是否建立索引
+        :param unique:是否建立唯一索引
         """
-        super().__init__(name,ddl,primary_key,default)
+        super().__init__(name,ddl or 'varchar(100)',primary_key,default,index,unique)
 
 class BooleanField(Field):
     """布尔字段
 
     """
 
-    def __init__(self, name=None, default=False):
+    def __init__(self, name=None, default=False, index=False):
         """初始化
 
         :param name:名称
         :param default:默认值为否
+        :param index:是否建立索引
         """
-        super().__init__(name,'boolean',False,default)  # 列类型为boolean
+        super().__init__(name,'boolean',False,default,index)  # 列类型为boolean
 
 class IntegerField(Field):
     """整形字段
 
     """
 
-    def __init__(self, name=None, primary_key=False, default=0):
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
         """初始化
 
+        使用64位时间有序ID作为主键时需指定default=ids.next_id
+
         :param name:名称
         :param primary_key:是否为主键
         :param default:默认值
+        :param index:是否建立索引
+        :param unique:是否建立唯一索引
         """
-        super().__init__(name, 'bigint', primary_key, default)  # 列类型为'bigint'
+        super().__init__(name, 'bigint', primary_key, default, index, unique)  # 列类型为'bigint'
 
 class FloatField(Field):
     """单精字段
 
     """
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
         """初始化
 
         :param name:名称
         :param primary_key:是否为主键
         :param default:默认值为0.0
+        :param index:是否建立索引
+        :param unique:是否建立唯一索引
         """
-        super().__init__(name, 'real', primary_key, default)    # 列类型为'real'
+        super().__init__(name, 'real', primary_key, default, index, unique)    # 列类型为'real'
 
 class TextField(Field):
     """文本字段
 
     """
 
-    def __init__(self, name=None, default=None):
+    def __init__(self, name=None, default=None, deferred=True):
         """初始化
 
         :param name:名称
         :param default:默认值
+        :param deferred:是否延迟加载，默认为是，列表页通常不需要大段文本
+        """
+        super().__init__(name, 'text', False, default, deferred=deferred)  #列类型为'text'
+
+_models = dict()        # 模型类名 ==> 模型类，用于按名称解析关联的模型
+
+class Relation(ABC):
+    """关联基类，子类实现ownerKey()/targetKey()/fetch()
+
+    声明为模型的类属性，例如：user = BelongsTo('User', 'user_id')；
+    关联的对象通过findAll(prefetch=[...])或Model.prefetch()批量读取后保存在对象中
+    """
+
+    def __init__(self, model, key):
+        """初始化
+
+        :param model:关联的模型类或类名，引用尚未定义的模型时使用类名
+        :param key:关联所用的属性名
+        """
+        self._model = model
+        self.key = key
+        self.name = None    # 关联名称，由元类设置
+
+    @property
+    def model(self):
+        """关联的模型类
+
+        :return:
+        """
+        if isinstance(self._model, str):
+            if self._model not in _models:
+                raise Exception('Model %s of relation %s not found' % (self._model, self.name))
+            self._model = _models[self._model]
+        return self._model
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return obj[self.name]
+        except KeyError:    # 由Model.__getattr__()给出错误信息
+            raise AttributeError(self.name)
+
+    def __str__(self):
+        return '<%s, %s:%s>' % (self.__class__.__name__, self.name, self.key)
+
+    many = False        # 每个对象是否关联多个对象
+
+    @abstractmethod
+    def ownerKey(self, owner):
+        """本关联所属模型中用于关联的属性名
+
+        :param owner:本关联所属的模型类
+        :return:
+        """
+
+    @abstractmethod
+    def targetKey(self):
+        """关联模型中用于关联的属性名
+
+        :return:
+        """
+
+    @abstractmethod
+    async def fetch(self, keys, primary=False):
+        """按关联属性的值批量读取关联的对象
+
+        :param keys:不重复且不为None的值队列
+        :param primary:是否强制在主库上查询
+        :return:关联的对象队列
+        """
+
+    async def load(self, objs, primary=False):
+        """为一组对象读取关联的对象并保存在对象中
+
+        关联属性的值按normalize_key()比较，数据库返回的值与对象中的值形式不同时（例如整数与字符串）也能对应
+
+        :param objs:本关联所属模型的对象队列
+        :param primary:是否强制在主库上查询
+        :return:读取到的关联对象队列
+        """
+        ownerKey = self.ownerKey(type(objs[0]))
+        targetKey = self.targetKey()
+        keys = [obj.getValue(ownerKey) for obj in objs]
+        targets = await self.fetch([k for k in dict.fromkeys(keys) if k is not None], primary)
+        groups = dict()                                 # normalize_key(关联属性的值) ==> 关联对象（队列）
+        for target in targets:
+            k = normalize_key(target.getValue(targetKey))
+            if self.many:
+                groups.setdefault(k, []).append(target)
+            else:
+                groups[k] = target                      # 多个对象关联同一记录时共享同一个对象
+        for obj, k in zip(objs, keys):
+            found = None if k is None else groups.get(normalize_key(k))
+            obj[self.name] = (found or []) if self.many else found
+        return targets
+
+class BelongsTo(Relation):
+    """多对一关联，本模型的key属性保存关联对象的主键
+
+    例如：Comment.user = BelongsTo('User', 'user_id')
+    """
+
+    def ownerKey(self, owner):
+        return self.key
+
+    def targetKey(self):
+        return self.model.__primary_key__
+
+    async def fetch(self, keys, primary=False):
+        return [target for target in await self.model.find_many(keys, primary=primary) if target is not None]
+
+class HasMany(Relation):
+    """一对多关联，关联模型的key属性保存本模型对象的主键
+
+    例如：Blog.comments = HasMany('Comment', 'blog_id', orderBy='created_at desc')
+    """
+
+    many = True
+
+    def __init__(self, model, key, orderBy=None, batch_size=512):
+        """初始化
+
+        :param model:关联的模型类或类名
+        :param key:关联模型中保存本模型主键的属性名
+        :param orderBy:每个对象的关联对象列表的排序方式
+        :param batch_size:每条查询最多包含的主键数量
         """
-        super().__init__(name, 'text', False, default)  #列类型为'text'
+        super().__init__(model, key)
+        self.orderBy = orderBy
+        self.batch_size = batch_size
+
+    def ownerKey(self, owner):
+        return owner.__primary_key__
+
+    def targetKey(self):
+        return self.key
+
+    async def fetch(self, keys, primary=False):
+        children = []
+        for n, chunk in _padded_in_chunks(keys, self.batch_size):
+            children.extend(await self.model.findAll('`%s` in (%s)' % (self.key, create_args_string(n)), chunk,
+                                                     orderBy=self.orderBy, primary=primary))
+        return children
+
+async def prefetch(model, objs, paths, primary=False):
+    """为一组对象批量读取关联的对象
+
+    每一层关联只发送一次批量查询（超过512个主键时分批），查询次数与对象数量无关
+
+    :param model:对象所属的模型类
+    :param objs:对象队列
+    :param paths:关联路径队列，例如：['comments', 'comments.user']
+    :param primary:是否强制在主库上查询
+    :return:
+    """
+    tree = dict()                                       # 关联名称 ==> 下一层的关联路径
+    for path in paths:
+        name, _, rest = path.partition('.')
+        tree.setdefault(name, [])
+        if rest:
+            tree[name].append(rest)
+    for name, rest in tree.items():
+        relation = model.__relations__.get(name)
+        if relation is None:
+            raise ValueError('Unknown relation for %s: %s' % (model.__name__, name))
+        targets = await relation.load(objs, primary) if objs else []
+        if rest:
+            await prefetch(relation.model, targets, rest, primary)
+
+def _collect_indexes(name, table, mappings, declared):
+    """汇总字段上的index/unique和模型的__indexes__声明
+
+    :param name:模型名
+    :param table:表名
+    :param mappings:属性 ==> 字段
+    :param declared:__indexes__，每项为列名、列名元组或Index对象
+    :return:Index列表
+    """
+    indexes = []
+    for k, f in mappings.items():
+        if f.primary_key:
+            continue
+        if f.unique:
+            indexes.append(Index(f.name or k, unique=True))
+        elif f.index:
+            indexes.append(Index(f.name or k))
+    for d in declared:
+        if isinstance(d, str):
+            d = Index(d)
+        elif not isinstance(d, Index):
+            d = Index(*d)
+        indexes.append(d)
+    columns = {f.name or k for k, f in mappings.items()}
+    for index in indexes:
+        if index.name is None:
+            index.name = '%s_%s_%s' % ('uniq' if index.unique else 'idx', table, '_'.join(index.columns))
+        unknown = [c for c in index.columns if c not in columns]
+        if unknown:
+            raise Exception('Index %s of %s references unknown columns: %s' % (index.name, name, ', '.join(unknown)))
+    return indexes
 
 class ModelMetaclass(type):
     """数据模型元类
@@ -212,10 +1524,14 @@ class ModelMetaclass(type):
         tableName = attrs.get('__table__', None) or name                # 获取'__table__'属性如果为None则使用类名
         logging.info('found model:%s (table: %s)' % (name, tableName))  # 日志记录找到模型及对应的表
         mappings = dict()                                               # 创建映射空字典
+        relations = dict()                                              # 创建关联空字典
         fields = []                                                     # 创建字段空列表
         primaryKey = None                                               # 定义主键为空
         for k,  v in attrs.items():                                     # 循环获取属性对象
-            if isinstance(v, Field):                                    # 如果属性是字段类型
+            if isinstance(v, Relation):                                 # 如果属性是关联
+                v.name = k
+                relations[k] = v
+            elif isinstance(v, Field):                                  # 如果属性是字段类型
                 logging.info(' found mapping:%s ==> %s' % (k, v))       # 日志记录找到映射关系
                 mappings[k] = v                                         # 创建一条映射
                 if v.primary_key:                                       # 如果是主键
@@ -226,16 +1542,24 @@ class ModelMetaclass(type):
                     fields.append(k)                                    # 否则放入字段列表中
         if not primaryKey:                                              # 如果不存在主键
             raise Exception('Primary key not found.')                   # 抛出找不到主键错误
+        for k, v in relations.items():
+            if v.key not in mappings and not isinstance(v, HasMany):    # HasMany的key属于关联的模型
+                raise Exception('Relation %s of %s references unknown field: %s' % (k, name, v.key))
         for k in mappings.keys():                                       # 移除原类中所定义的字段
             attrs.pop(k)
         escaped_fields = list(map(lambda f:'`%s`' % f, fields))         # 生成列字符串
+        deferred = [k for k in fields if mappings[k].deferred]          # 延迟加载的列
         attrs['__mappings__'] = mappings                                # 保存属性和列的映射关系
+        attrs['__relations__'] = relations                              # 保存关联，关联描述符保留在类中
         attrs['__table__'] = tableName                                  # 保存表名
         attrs['__primary_key__'] = primaryKey                           # 保存主键属性名
         attrs['__fields__'] = fields                                    # 保存除主键以外的属性名
-        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey,# 生成查询语句
-                                                             ', '.join(escaped_fields),
-                                                             tableName)
+        attrs['__deferred__'] = deferred                                # 保存延迟加载的属性名
+        attrs['__select_all__'] = 'select `%s`, %s from `%s`' % (primaryKey,    # 生成包含所有列的查询语句，用于find()
+                                                                 ', '.join(escaped_fields),
+                                                                 tableName)
+        attrs['__select__'] = 'select %s from `%s`' % (select_list([primaryKey] + [k for k in fields if k not in deferred]),
+                                                       tableName)      # 生成列表查询语句，不包含延迟加载的列
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName,   # 生成插入语句
                                                                            ', '.join(escaped_fields),
                                                                            primaryKey,
@@ -245,13 +1569,38 @@ class ModelMetaclass(type):
                                                                    ,primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName,             # 生产删除语句
                                                                  primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__record__'] = make_record_class(name, [primaryKey] + [k for k in fields if k not in deferred])  # 生成紧凑记录类，列顺序与__select__一致
+        attrs['__projections__'] = dict()                               # 投影的列 ==> (查询语句, 紧凑记录类)
+        version = attrs.get('__version__', None)                        # 乐观锁的版本号属性，例如：__version__ = 'version'
+        if version is not None and version not in fields:
+            raise Exception('Version field %s of %s is not a non-primary field' % (version, name))
+        attrs['__index_list__'] = _collect_indexes(name, tableName, mappings, attrs.get('__indexes__', ()))  # 字段和模型声明的索引
+        attrs['__batcher__'] = None                                     # 合并find()调用，在下面创建类之后设置
+        cache = attrs.get('__cache__', None)                            # 获取缓存配置，例如：dict(maxsize=1000, ttl=60)
+        attrs['__cache_store__'] = LRUCache(**cache) if cache else None # 按主键缓存find()的结果
+        model = type.__new__(cls, name, bases, attrs)
+        _models[name] = model
+        if attrs.get('__batch_find__', False):
+            model.__batcher__ = FindBatcher(model)
+        counters = attrs.get('__counters__', None)                      # 获取计数维度，例如：[(), ('blog_id',)]
+        model.__counter_set__ = CounterSet(model, counters) if counters else None
+        if counters:
+            _counter_sets.append(model.__counter_set__)
+            add_change_listener(model.__counter_set__.on_change)
+        return model
+
+class StaleObjectError(Exception):
+    """乐观锁检查失败：记录在读取后已被其他请求修改或删除"""
+    pass
 
 class Model(dict, metaclass=ModelMetaclass):
     """数据模型类
 
-    继承字典类型
+    继承字典类型；从数据库读取或保存后的对象会记录之后被修改的属性，update()只写入这些列
     """
+
+    __version__ = None  # 乐观锁的版本号属性名，子类声明后update()检查并递增版本号
+
     def __init__(self, **kw):
         """初始化
 
@@ -259,6 +1608,49 @@ class Model(dict, metaclass=ModelMetaclass):
         """
         super(Model, self).__init__(**kw)
 
+    def __setitem__(self, key, value):
+        """设置值，记录被修改的列
+
+        :param key:属性名
+        :param value:值
+        :return:
+        """
+        dirty = self.__dict__.get('_dirty')
+        if dirty is not None and key in self.__mappings__ and (key not in self or self[key] != value):
+            dirty.add(key)
+        dict.__setitem__(self, key, value)
+
+    def _markClean(self):
+        """从数据库读取或写入成功后调用，此后开始记录被修改的列
+
+        在事务中写入时，事务回滚后恢复之前的修改记录，之后的update()仍会写入这些列
+
+        :return:
+        """
+        dirty = self.__dict__.get('_dirty')
+        self.__dict__['_dirty'] = set()
+        if _transaction.get() is not None:
+            on_rollback(lambda: self._restoreDirty(dirty))
+
+    def _restoreDirty(self, dirty):
+        """事务回滚后恢复写入前的修改记录，并保留写入后的修改
+
+        :param dirty:写入前的修改记录，None表示未记录修改
+        :return:
+        """
+        current = self.__dict__.get('_dirty')
+        self.__dict__['_dirty'] = None if dirty is None or current is None else dirty | current
+
+    def dirtyFields(self):
+        """读取或保存后被修改的属性名
+
+        :return:按声明顺序排列的属性名列表，未记录修改的对象（直接构造且未保存）返回None
+        """
+        dirty = self.__dict__.get('_dirty')
+        if dirty is None:
+            return None
+        return [k for k in self.__fields__ if k in dirty]
+
     def __getattr__(self, key):
         """获取属性
 
@@ -268,6 +1660,10 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:    # 如果无法找到则抛出错误
+            if key in self.__mappings__:    # 延迟加载或未投影的列
+                raise AttributeError(r"'%s' column '%s' is not loaded, call await obj.load() first" % (self.__class__.__name__, key))
+            if key in self.__relations__:   # 未读取的关联
+                raise AttributeError(r"'%s' relation '%s' is not loaded, use prefetch=['%s']" % (self.__class__.__name__, key, key))
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
@@ -308,64 +1704,475 @@ class Model(dict, metaclass=ModelMetaclass):
         SQL SELECT 语句参考
         [http://blog.csdn.net/litong09282039/article/details/46330069]
 
+        默认不查询延迟加载的列，fields指定只查询的列（总是包含主键），未查询的列通过load()批量读取；
+        prefetch指定同时读取的关联，例如：['comments', 'comments.user']
+
         :param where:SQL where部分
         :param args:值部分
-        :param kw:orderBy/limit/
+        :param kw:orderBy/limit/primary/fields/prefetch
         :return:查询结果通过本类类型队列的方式返回
         """
-        sql = [cls.__select__]              # 获取查询语句,并存入队列
-        if where:                           # 如果存在where部分
-            sql.append('where')             # 先把where加字段加进去
-            sql.append(where)               # 这里的字符串对应的是字段
+        sql, args = cls._selectSQL(where, args, **kw)
+        rs = await select(sql, args, primary=kw.get('primary', False))  # 传入参数并执行select查询
+        objs = cls._fromRows(rs, kw.get('fields'))  # 返回结果并将查询结果存入当前类类型的队列
+        if kw.get('prefetch'):
+            await prefetch(cls, objs, kw['prefetch'], kw.get('primary', False))
+        return objs
+
+    @classmethod
+    def _fromRow(cls, row):
+        """由一行查询结果构造本类对象，并开始记录修改
+
+        :param row:字典行
+        :return:本类对象
+        """
+        obj = cls(**row)
+        obj.__dict__['_dirty'] = set()
+        return obj
+
+    @classmethod
+    def _fromRows(cls, rs, fields=None):
+        """由查询结果构造本类对象
+
+        结果中缺少列时，同一次查询得到的对象互相记录，其中任意一个调用load()都会一次读取全部对象缺少的列
+
+        :param rs:字典行队列
+        :param fields:查询的列，None表示默认列
+        :return:本类对象队列
+        """
+        objs = list(map(cls._fromRow, rs))
+        if len(objs) > 1 and (fields is not None or cls.__deferred__):
+            for obj in objs:
+                obj.__dict__['_siblings'] = objs    # 不写入字典，不影响JSON序列化
+        return objs
+
+    @classmethod
+    async def findRecords(cls, where=None, args=None, **kw):
+        """以紧凑记录的形式查找所有记录
+
+        参数与findAll()相同，但使用元组游标并返回只读的__record__对象，内存占用和构造开销都小于本类对象；
+        指定fields时返回只包含这些列的记录类对象
+
+        :param where:SQL where部分
+        :param args:值部分
+        :param kw:orderBy/limit/primary/fields
+        :return:__record__对象队列
+        """
+        sql, args = cls._selectSQL(where, args, **kw)
+        rs = await select(sql, args, tuples=True, primary=kw.get('primary', False))
+        fields = kw.get('fields')
+        record = cls.__record__ if fields is None else cls._projection(fields)[1]
+        return list(map(record._make, rs))
+
+    @classmethod
+    async def iterate(cls, where=None, args=None, chunk_size=100, **kw):
+        """流式遍历记录
+
+        与findAll()参数相同，但按批从服务端取出记录并逐条返回，适合导出或重建索引等全表操作
+
+        :param where:SQL where部分
+        :param args:值部分
+        :param chunk_size:每次从服务端取出的记录数
+        :param kw:orderBy/limit/primary/fields
+        :return:逐条返回本类对象的异步生成器
+        """
+        sql, args = cls._selectSQL(where, args, **kw)
+        async for r in select_iter(sql, args, chunk_size, kw.get('primary', False)):
+            yield cls._fromRow(r)
+
+    @classmethod
+    async def findPage(cls, where=None, args=None, order='created_at desc', after=None, size=10, primary=False, fields=None,
+                       prefetch=None):
+        """键集（seek）分页
+
+        按(排序字段, 主键)定位下一页的起点，而不是用LIMIT偏移量跳过前面的记录，
+        因此翻到任意一页的代价都与第一页相同，需要(排序字段, 主键)上有索引
+
+        :param where:SQL where部分
+        :param args:值部分
+        :param order:排序方式，例如：'created_at desc'
+        :param after:上一页返回的游标，为None时返回第一页
+        :param size:每页记录数
+        :param primary:是否强制在主库上查询
+        :param fields:只查询的列，排序字段和主键总会被查询，默认不查询延迟加载的列（排序字段除外）
+        :param prefetch:同时读取的关联路径队列
+        :return:(本类对象列表, 下一页游标)，没有下一页时游标为None
+        """
+        column, _, direction = order.strip().partition(' ')
+        direction = direction.strip().lower() or 'asc'
+        if column not in cls.__mappings__ or direction not in ('asc', 'desc'):  # 防止拼接任意SQL
+            raise ValueError('Invalid order value: %s' % order)
+        pk = cls.__primary_key__
+        args = list(args or [])
+        if after is not None:
+            value, key = decode_page_cursor(after)
+            args.extend([key] if column == pk else [value, value, key])
+        args.append(size + 1)               # 多取一条用于判断是否还有下一页
+
+        if fields is not None:
+            fields = tuple(fields) if column in fields else tuple(fields) + (column,)
+        elif column in cls.__deferred__:    # 默认不查询延迟加载的列，按其排序时仍需要它生成游标
+            fields = tuple(k for k in cls.__fields__ if k not in cls.__deferred__) + (column,)
+        key = (cls, 'page', where, column, direction, after is None, fields)
+        sql = _compiled.get(key)
+        if sql is None:
+            op = '<' if direction == 'desc' else '>'
+            conditions = ['(%s)' % where] if where else []
+            if after is not None and column == pk:
+                conditions.append('`%s` %s ?' % (pk, op))
+            elif after is not None:
+                conditions.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (column, op, column, pk, op))
+            sql = [cls.__select__ if fields is None else cls._projection(fields)[0]]
+            if conditions:
+                sql.append('where')
+                sql.append(' and '.join(conditions))
+            if column == pk:
+                sql.append('order by `%s` %s limit ?' % (pk, direction))
+            else:
+                sql.append('order by `%s` %s, `%s` %s limit ?' % (column, direction, pk, direction))
+            sql = compile_sql(' '.join(sql), key)
+        rs = await select(sql, args, primary=primary)
+        cursor = None
+        if len(rs) > size:
+            last = rs[size - 1]
+            cursor = encode_page_cursor(last[column], last[pk])
+        objs = cls._fromRows(rs[:size], fields)
+        if prefetch:
+            await cls.prefetch(objs, *prefetch, primary=primary)
+        return objs, cursor
+
+    @classmethod
+    def _selectSQL(cls, where=None, args=None, **kw):
+        """生成findAll()/iterate()的查询语句
+
+        :param where:SQL where部分
+        :param args:值部分
+        :param kw:orderBy/limit/fields
+        :return:(查询语句, 参数值)
+        """
         if args is None:                    # 参数值如果为空
             args = []                       # 设置参数值为空队列
         orderBy = kw.get('orderBy', None)   # 获取orderBy如果不存在设置为None
+        limit = kw.get('limit', None)       # 获取limit如果不存在设置为None
+        if limit is None:
+            arity = 0
+        elif isinstance(limit, int):        # 如果该元素为整形
+            arity = 1
+            args.append(limit)              # 将获取的limit值加入参数队列
+        elif isinstance(limit, tuple) and len(limit) == 2:  # 如果limit是元组类型并且长度为2
+            arity = 2
+            args.extend(limit)              # 在参数队列中插入一个limit元组对象
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))    # 否则报limit值错误
+
+        fields = kw.get('fields', None)     # 获取投影的列，None表示默认列
+        if fields is not None:
+            fields = tuple(fields)
+        key = (cls, 'select', where, orderBy, arity, fields)
+        # 同一查询形态只拼接和转换一次SQL语句
+        return _compiled.get(key) or compile_sql(cls._buildSelect(where, orderBy, arity, fields), key), args
+
+    @classmethod
+    def _projection(cls, fields):
+        """生成只查询部分列的查询语句和紧凑记录类
+
+        :param fields:属性名队列，不包含主键时自动加上
+        :return:(不含where部分的查询语句, 紧凑记录类)
+        """
+        key = tuple(fields)
+        projection = cls.__projections__.get(key)
+        if projection is None:
+            unknown = [k for k in key if k not in cls.__mappings__]
+            if unknown:
+                raise ValueError('Unknown fields for %s: %s' % (cls.__name__, ', '.join(unknown)))
+            pk = cls.__primary_key__
+            columns = [pk] + [k for k in dict.fromkeys(key) if k != pk]
+            projection = cls.__projections__[key] = ('select %s from `%s`' % (select_list(columns), cls.__table__),
+                                                     make_record_class(cls.__name__, columns))
+        return projection
+
+    @classmethod
+    def _buildSelect(cls, where, orderBy, arity, fields=None):
+        """拼接查询语句
+
+        :param where:SQL where部分
+        :param orderBy:SQL order by部分
+        :param arity:limit参数个数
+        :param fields:只查询的列，None表示默认列
+        :return:使用'?'占位符的查询语句
+        """
+        sql = [cls.__select__ if fields is None else cls._projection(fields)[0]]    # 获取查询语句,并存入队列
+        if where:                           # 如果存在where部分
+            sql.append('where')             # 先把where加字段加进去
+            sql.append(where)               # 这里的字符串对应的是字段
         if orderBy:                         # 如果存在orderBy
             sql.append('order by')          # 加入order by字符串
             sql.append(orderBy)             # 这里也是字段字符串，用于排序
-        limit = kw.get('limit', None)       # 获取limit如果不存在设置为None
-        if limit is not None:               # 如果在字典中存在limit
-            sql.append('limit')             # 加入limit字符串
-            if isinstance(limit, int):      # 如果该元素为整形
-                sql.append('?')             # 在SQL语句后添加一个'?'
-                args.append(limit)          # 将获取的limit值加入参数队列
-            elif isinstance(limit, tuple) and len(limit) == 2:  # 如果limit是元组类型并且长度为2
-                sql.append('?, ?')          # 在SQL语句后添加'?, ?'
-                args.extend(limit)          # 在参数队列中插入一个limit元组对象
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))    # 否则报limit值错误
-        rs = await select(' '.join(sql), args)  # 传入参数并执行select查询
-        return [cls(**r) for r in rs]       # 返回结果并将查询结果存入当前类类型的队列
+        if arity == 1:
+            sql.append('limit ?')           # 在SQL语句后添加一个'?'
+        elif arity == 2:
+            sql.append('limit ?, ?')        # 在SQL语句后添加'?, ?'
+        return ' '.join(sql)
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, primary=False):
         """查找记录集数量
 
         :param selectField:查找字段
         :param where:where语句
         :param args:值
+        :param primary:是否强制在主库上查询
         :return:记录数量
         """
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]  # 生成查询语句
-        if where:
-            sql.append('where')     # 如果存在where部分
-            sql.append(where)       # 这里的字符串对应的是字段
-        rs = await select(' '.join(sql), args, 1)   # 查询
+        counters = cls.__counter_set__
+        if counters is not None and not primary and _transaction.get() is None:   # 优先使用维护的计数器
+            n = await counters.count(selectField, where, args)
+            if n is not None:
+                return n
+        key = (cls, 'count', selectField, where)
+        sql = _compiled.get(key)
+        if sql is None:
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]  # 生成查询语句
+            if where:
+                sql.append('where') # 如果存在where部分
+                sql.append(where)   # 这里的字符串对应的是字段
+            sql = compile_sql(' '.join(sql), key)
+        rs = await select(sql, args, 1, primary=primary)   # 查询
         if len(rs) == 0:            # 如果记录数量为0返回None
             return None
         return rs[0]['_num_']       # 返回记录数量？不太明白为什么要用这样方式
 
     @classmethod
-    async def find(cls, pk):
+    def _findCache(cls):
+        """find()/find_many()使用的缓存
+
+        事务中读到的行可能尚未提交，也可能被回滚，不能让其他请求读到；缓存中的行也可能比事务中看到的旧，
+        因此事务中既不读也不写缓存
+
+        :return:未开启缓存或在事务中时返回None
+        """
+        if _transaction.get() is not None:
+            return None
+        return cls.__cache_store__
+
+    @classmethod
+    async def find(cls, pk, primary=False):
         """查找
 
+        按主键查找单条记录时查询所有列，包括延迟加载的列
+
         :param pk:查找信息(字典)
+        :param primary:是否强制在主库上查询
         :return:查找记录
         """
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)   # 生成查询语句
+        store = cls._findCache()
+        if store is not None:   # 如果开启了缓存则先从缓存中查找
+            row = store.get(pk)
+            if row is not None:
+                return cls._fromRow(row)
+        if cls.__batcher__ is not None and not primary and _transaction.get() is None:  # 与同一轮事件循环中的其他find()合并查询
+            return await cls.__batcher__.load(pk)
+        key = (cls, 'find')
+        sql = _compiled.get(key) or compile_sql('%s where `%s`=?' % (cls.__select_all__, cls.__primary_key__), key)  # 生成查询语句
+        rs = await select(sql, [pk], 1, primary=primary)
         if len(rs) == 0:        # 如果返回记录条数为0则返回None
             return None
-        return cls(**rs[0])     # 返回类类型数据集
+        if store is not None:   # 写入缓存
+            store.put(pk, rs[0])
+        return cls._fromRow(rs[0])  # 返回类类型数据集
+
+    @classmethod
+    async def find_many(cls, pks, batch_size=512, primary=False):
+        """按主键批量查找
+
+        每批只发送一条 where `主键` in (...) 查询，开启缓存时先从缓存中查找，与find()一样查询所有列
+
+        :param pks:主键队列
+        :param batch_size:每条查询最多包含的主键数量
+        :param primary:是否强制在主库上查询
+        :return:与pks顺序一致的本类对象队列，找不到的记录为None
+        """
+        pks = list(pks)
+        store = cls._findCache()
+        found = dict()                      # normalize_key(主键) ==> 行
+        missing = []
+        for pk in dict.fromkeys(pks):       # 去掉重复的主键
+            row = store.get(pk) if store is not None else None
+            if row is None:
+                missing.append(pk)
+            else:
+                found[normalize_key(pk)] = row
+        found.update(await cls._fetchMany(missing, batch_size, primary))
+        return [cls._fromRow(found[k]) if k in found else None for k in map(normalize_key, pks)]
+
+    @classmethod
+    async def _fetchMany(cls, pks, batch_size=512, primary=False):
+        """按主键批量查询数据库并写入缓存，不查找缓存
+
+        :param pks:不重复的主键队列
+        :param batch_size:每条查询最多包含的主键数量
+        :param primary:是否强制在主库上查询
+        :return:normalize_key(主键) ==> 行
+        """
+        store = cls._findCache()
+        primaryKey = cls.__primary_key__
+        found = dict()
+        for n, chunk in _padded_in_chunks(pks, batch_size):
+            key = (cls, 'find_many', n)
+            sql = _compiled.get(key) or compile_sql('%s where `%s` in (%s)' % (cls.__select_all__, primaryKey, create_args_string(n)), key)
+            for r in await select(sql, chunk, primary=primary):
+                found[normalize_key(r[primaryKey])] = r     # 数据库返回的主键可能与传入的类型或形式不同
+                if store is not None:
+                    store.put(r[primaryKey], r)
+        return found
+
+    @classmethod
+    async def loadDeferred(cls, objs, fields=None, batch_size=512, primary=False):
+        """批量读取对象中尚未加载的列
+
+        每批只发送一条 where `主键` in (...) 查询，只读取至少一个对象缺少的列，已有的值不会被覆盖
+
+        :param objs:本类对象队列
+        :param fields:要读取的属性名队列，默认为所有未加载的列
+        :param batch_size:每条查询最多包含的主键数量
+        :param primary:是否强制在主库上查询
+        :return:
+        """
+        pk = cls.__primary_key__
+        fields = list(fields) if fields else cls.__fields__
+        unknown = [k for k in fields if k not in cls.__mappings__]
+        if unknown:
+            raise ValueError('Unknown fields for %s: %s' % (cls.__name__, ', '.join(unknown)))
+        pending = dict()                                # normalize_key(主键) ==> 缺少列的对象队列
+        pks = []                                        # 不重复的主键，用于查询
+        columns = dict()                                # 至少一个对象缺少的列，保持声明顺序
+        for obj in objs:
+            missing = [k for k in fields if k not in obj]
+            if missing:
+                key = normalize_key(obj[pk])
+                if key not in pending:
+                    pending[key] = []
+                    pks.append(obj[pk])
+                pending[key].append(obj)
+                columns.update(dict.fromkeys(missing))
+        columns = [k for k in fields if k in columns]
+        for n, chunk in _padded_in_chunks(pks, batch_size):
+            key = (cls, 'load', tuple(columns), n)
+            sql = _compiled.get(key) or compile_sql('select %s from `%s` where `%s` in (%s)' % (
+                select_list([pk] + columns), cls.__table__, pk, create_args_string(n)), key)
+            for r in await select(sql, chunk, primary=primary):
+                for obj in pending.get(normalize_key(r[pk]), ()):    # 数据库返回的主键可能与对象中的类型或形式不同
+                    for k in columns:
+                        if k not in obj:
+                            dict.__setitem__(obj, k, r[k])  # 读取的值不算修改
+
+    @classmethod
+    async def prefetch(cls, objs, *paths, primary=False):
+        """为已查询出的对象批量读取关联，例如：await Blog.prefetch([blog], 'comments', 'comments.user')
+
+        :param objs:本类对象队列
+        :param paths:关联路径
+        :param primary:是否强制在主库上查询
+        :return:objs
+        """
+        objs = list(objs)
+        await prefetch(cls, objs, paths, primary)
+        return objs
+
+    async def load(self, *fields):
+        """读取本对象尚未加载的列
+
+        对象来自同一次findAll()/findPage()查询时，同时为其他对象读取缺少的列，
+        因此在列表中逐个调用load()也只会发送一次查询
+
+        :param fields:要读取的属性名，默认为所有未加载的列
+        :return:本对象
+        """
+        await self.loadDeferred(self.__dict__.get('_siblings') or [self], fields)
+        return self
+
+    @classmethod
+    def createTableSQL(cls, dialect_name=None):
+        """生成建表和建索引语句
+
+        :param dialect_name:SQL方言，默认为当前驱动的方言
+        :return:SQL语句列表，第一条为CREATE TABLE，其后每个索引一条CREATE INDEX
+        """
+        columns = []
+        for k, f in cls.__mappings__.items():
+            column = '`%s` %s not null' % (f.name or k, f.column_type)
+            if f.primary_key:
+                column += ' primary key'
+            columns.append(column)
+        sqls = ['create table `%s` (\n    %s\n)%s' % (cls.__table__, ',\n    '.join(columns), TABLE_OPTIONS[dialect_name or dialect()])]
+        for index in cls.__index_list__:
+            sqls.append(cls.createIndexSQL(index))
+        return sqls
+
+    @classmethod
+    def createIndexSQL(cls, index):
+        """生成建索引语句
+
+        :param index:Index对象
+        :return:
+        """
+        return 'create %sindex `%s` on `%s` (%s)' % ('unique ' if index.unique else '', index.name, cls.__table__,
+                                                    ', '.join('`%s`' % c for c in index.columns))
+
+    @classmethod
+    async def explain(cls, where=None, args=None, **kw):
+        """查看findAll()的执行计划，全表扫描或需要额外排序时输出警告
+
+        :param where:SQL where部分
+        :param args:值部分
+        :param kw:orderBy/limit
+        :return:EXPLAIN结果的字典列表
+        """
+        sql, args = cls._selectSQL(where, args, **kw)
+        if dialect() == 'sqlite':
+            rs = await select('explain query plan ' + sql, args, primary=True)
+            for r in rs:
+                detail = r.get('detail') or ''
+                if detail.startswith('SCAN') and 'INDEX' not in detail:
+                    logging.warning('full table scan (%s): %s' % (detail, sql))
+                if 'TEMP B-TREE' in detail:
+                    logging.warning('sort without index (%s): %s' % (detail, sql))
+            return rs
+        rs = await select('explain ' + sql, args, primary=True)
+        for r in rs:
+            extra = r.get('Extra') or ''
+            if r.get('type') == 'ALL':
+                logging.warning('full table scan on %s (%s rows): %s' % (r.get('table'), r.get('rows'), sql))
+            if 'Using filesort' in extra:
+                logging.warning('filesort on %s: %s' % (r.get('table'), sql))
+        return rs
+
+    @classmethod
+    def cacheStats(cls):
+        """find()缓存的统计信息
+
+        :return:命中/未命中/淘汰次数等，未开启缓存时返回None
+        """
+        store = cls.__cache_store__
+        return store.stats() if store is not None else None
+
+    def _refreshCache(self, ok=True):
+        """写操作后刷新缓存
+
+        :param ok:写操作是否成功，失败时仅使缓存失效
+        :return:
+        """
+        store = self.__cache_store__
+        if store is None:
+            return
+        pk = self.getValue(self.__primary_key__)
+        if _transaction.get() is not None:  # 事务可能回滚，先使缓存失效，事务结束后再失效一次
+            store.pop(pk)
+            on_commit(lambda: store.pop(pk), always=True)
+        elif ok and all(k in self for k in self.__mappings__):  # 只缓存所有列都已加载的对象
+            store.put(pk, {k: self.getValue(k) for k in self.__mappings__})
+        else:
+            store.pop(pk)
 
     async def save(self):
         """保存
@@ -377,24 +2184,118 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__insert__, args)                 # 插入一条记录
         if rows != 1:                                               # 如果返回值不为1则报错
             logging.warning('failed to insert record: affected rows: %s' % rows)
+        self._refreshCache(rows == 1)
+        if rows == 1:
+            self._markClean()
+            notify_change(self.__class__, 'save', [self])
+
+    @classmethod
+    async def save_many(cls, objs, batch_size=100):
+        """批量保存
+
+        为每个对象填充默认值后按批写入，每一批只发送一条多行INSERT语句
+
+        :param objs: 本类对象列表
+        :param batch_size: 每批写入的行数
+        :return: 每一批所影响的行数列表
+        """
+        objs = list(objs)
+        rows = []
+        for obj in objs:
+            args = list(map(obj.getValueOrDefault, cls.__fields__))    # 生成字段队列
+            args.append(obj.getValueOrDefault(cls.__primary_key__))     # 加上主键
+            rows.append(args)
+        affected = await executemany(cls.__insert__, rows, batch_size)
+        if sum(affected) != len(rows):                                  # 如果影响行数与对象数量不符则报错
+            logging.warning('failed to insert records: affected rows: %s of %s' % (sum(affected), len(rows)))
+        if cls.__cache_store__ is not None:
+            for obj in objs:
+                obj._refreshCache()
+        for obj in objs:
+            obj._markClean()
+        if objs:
+            notify_change(cls, 'save', objs)
+        return affected
+
+    @classmethod
+    def _updateSQL(cls, fields):
+        """生成只更新指定列的语句，按列的组合缓存
+
+        声明了__version__时，版本号不在fields中，而是递增并作为条件
+
+        :param fields:要更新的属性名元组
+        :return:
+        """
+        version = cls.__version__
+        if version is None and len(fields) == len(cls.__fields__):
+            return cls.__update__
+        key = (cls, 'update', fields)
+        sql = _compiled.get(key)
+        if sql is None:
+            columns = ['`%s`=?' % (cls.__mappings__[k].name or k) for k in fields]
+            where = '`%s`=?' % cls.__primary_key__
+            if version is not None:
+                column = cls.__mappings__[version].name or version
+                columns.append('`%s`=`%s`+1' % (column, column))
+                where += ' and `%s`=?' % column
+            sql = compile_sql('update `%s` set %s where %s' % (cls.__table__, ', '.join(columns), where), key)
+        return sql
 
     async def update(self):
         """更新记录
 
+        从数据库读取或保存后的对象只更新被修改的列，没有修改时不执行语句；
+        其他对象更新已加载的列，延迟加载或投影查询时未读取的列保持不变；
+        声明了__version__时，记录已被其他请求修改则抛出StaleObjectError；
+        没有版本号的对象（例如直接构造且未设置版本号）无法做乐观锁检查，抛出ValueError
+
         :return:
         """
-        args = list(map(self.getValue, self.__fields__))    # 生成字段队列
+        version = self.__version__
+        if version is not None and self.getValue(version) is None:
+            raise ValueError('%s %s has no %s loaded, find() it or set the version before update()' % (
+                self.__class__.__name__, self.getValue(self.__primary_key__), version))
+        dirty = self.dirtyFields()
+        if dirty is None:
+            fields = [k for k in self.__fields__ if k in self and k != version]    # 已加载的列
+        else:
+            fields = [k for k in dirty if k != version]
+        if not fields:                                      # 没有修改，不需要访问数据库
+            return
+        args = list(map(self.getValue, fields))             # 生成字段队列
         args.append(self.getValue(self.__primary_key__))    # 加上主键
-        rows = await execute(self.__update__, args)         # 执行更新操作
+        if version is not None:
+            args.append(self.getValue(version))             # 加上读取时的版本号
+        rows = await execute(self._updateSQL(tuple(fields)), args)  # 执行更新操作
+        if version is not None and rows != 1:
+            self._refreshCache(False)
+            raise StaleObjectError('%s %s was modified or removed (version %s)' % (
+                self.__class__.__name__, self.getValue(self.__primary_key__), self.getValue(version)))
         if rows != 1:                                       # 如果返回值不为1则报错
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
+        if version is not None:
+            previous = self.getValue(version)
+            dict.__setitem__(self, version, previous + 1)
+            on_rollback(lambda: dict.__setitem__(self, version, previous))  # 事务回滚后数据库中仍是原版本号
+        if rows == 1:
+            self._markClean()
+        self._refreshCache(rows == 1)
+        notify_change(self.__class__, 'update', [self])
 
     async def remove(self):
         """删除该记录
 
         :return:
         """
+        counters = self.__counter_set__
+        if counters is not None:                        # 只读取了部分列的对象，先读取计数器需要的维度列
+            missing = [c for c in counters.columns if c not in self]
+            if missing:
+                await self.loadDeferred([self], missing, primary=True)
         args = [self.getValue(self.__primary_key__)]    # 获取主键
         rows = await execute(self.__delete__, args)     # 执行删除操作
         if rows != 1:                                   # 如果返回值不为1则报错
-            logging.warning('failed to remove by primary key: affected rows: %s' % rows)
\ No newline at end of file
+            logging.warning('failed to remove by primary key: affected rows: %s' % rows)
+        self._refreshCache(False)
+        if rows == 1:
+            notify_change(self.__class__, 'remove', [self])
\ No newline at end of file
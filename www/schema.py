@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Generate the database schema from models.py and compare it with a live database.
+
+Usage:
+    python3 schema.py ddl                                   # print CREATE TABLE/INDEX statements
+    python3 schema.py ddl --dialect sqlite | sqlite3 awesome.db
+    python3 schema.py diff --user www-data --password www-data --db awesome
+    python3 schema.py diff --apply ...                      # also create missing tables and indexes
+
+diff reads information_schema and therefore needs MySQL.
+'''
+
+import argparse, asyncio, logging
+
+import orm
+import models
+
+def all_models(module=models):
+    """获取模块中定义的所有模型
+
+    :param module: 模块
+    :return: 模型类列表
+    """
+    return [v for v in vars(module).values()
+            if isinstance(v, type) and issubclass(v, orm.Model) and v is not orm.Model and v.__module__ == module.__name__]
+
+def ddl(model_list=None, dialect_name=None):
+    """生成所有模型和计数表的建表语句
+
+    :param model_list: 模型类列表，默认为models.py中的所有模型
+    :param dialect_name: SQL方言，默认为当前驱动的方言
+    :return: SQL语句列表
+    """
+    sqls = []
+    for model in model_list or all_models():
+        sqls.extend(model.createTableSQL(dialect_name))
+    sqls.append(orm.counter_ddl(dialect_name))
+    return sqls
+
+async def live_indexes(table):
+    """获取数据库中表的索引
+
+    :param table: 表名
+    :return: 索引名 ==> (列名元组, 是否唯一)
+    """
+    rs = await orm.select('select `index_name` as `name`, `column_name` as `col`, `non_unique` as `nu` '
+                          'from information_schema.statistics where table_schema=database() and table_name=? '
+                          'order by `index_name`, `seq_in_index`', [table], primary=True)
+    indexes = dict()
+    for r in rs:
+        columns, unique = indexes.get(r['name'], ((), not r['nu']))
+        indexes[r['name']] = (columns + (r['col'],), unique)
+    return indexes
+
+def covered(index, live):
+    """判断声明的索引是否已被数据库中的某个索引覆盖
+
+    数据库中的索引以声明的列为最左前缀即可，唯一索引要求列完全相同
+
+    :param index: orm.Index对象
+    :param live: live_indexes()的结果
+    :return:
+    """
+    n = len(index.columns)
+    for columns, unique in live.values():
+        if index.unique:
+            if unique and columns == index.columns:
+                return True
+        elif columns[:n] == index.columns:
+            return True
+    return False
+
+async def diff(model_list=None):
+    """比较模型与数据库的差异
+
+    :param model_list: 模型类列表，默认为models.py中的所有模型
+    :return: (问题描述, 修复语句)列表，无法自动修复的问题修复语句为None
+    """
+    problems = []
+    for model in model_list or all_models():
+        table = model.__table__
+        rs = await orm.select('select `column_name` as `col` from information_schema.columns '
+                              'where table_schema=database() and table_name=?', [table], primary=True)
+        if not rs:
+            problems.extend(('missing table %s' % table, sql) for sql in model.createTableSQL()[:1])
+            problems.extend(('missing index %s.%s' % (table, i.name), model.createIndexSQL(i)) for i in model.__index_list__)
+            continue
+        live_columns = {r['col'] for r in rs}
+        for k, f in model.__mappings__.items():
+            if (f.name or k) not in live_columns:
+                problems.append(('missing column %s.%s %s' % (table, f.name or k, f.column_type), None))
+        live = await live_indexes(table)
+        for index in model.__index_list__:
+            if not covered(index, live):
+                problems.append(('missing index %s.%s (%s)' % (table, index.name, ', '.join(index.columns)),
+                                 model.createIndexSQL(index)))
+    if any(model.__counter_set__ is not None for model in model_list or all_models()):
+        rs = await orm.select('select count(*) as `n` from information_schema.tables '
+                              'where table_schema=database() and table_name=?', [orm.COUNTER_TABLE], primary=True)
+        if not rs[0]['n']:
+            problems.append(('missing table %s' % orm.COUNTER_TABLE, orm.counter_ddl()))
+    return problems
+
+async def run(loop, args):
+    await orm.create_pool(loop, host=args.host, port=args.port, user=args.user, password=args.password, db=args.db)
+    try:
+        problems = await diff()
+        for problem, sql in problems:
+            print('%s%s' % (problem, '' if sql else ' (fix by hand)'))
+        if not problems:
+            print('schema is up to date')
+        if args.apply:
+            for problem, sql in problems:
+                if sql:
+                    print('apply: %s' % sql)
+                    await orm.execute(sql, [])
+    finally:
+        await orm.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the schema from models.py and compare it with a database.')
+    parser.add_argument('command', choices=('ddl', 'diff'))
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='www-data')
+    parser.add_argument('--password', default='www-data')
+    parser.add_argument('--db', default='awesome')
+    parser.add_argument('--apply', action='store_true', help='create missing tables and indexes')
+    parser.add_argument('--dialect', choices=sorted(orm.TABLE_OPTIONS), default='mysql', help='SQL dialect for ddl')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == 'ddl':
+        for sql in ddl(dialect_name=args.dialect):
+            print('%s;\n' % sql)
+        return
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop, args))
+
+if __name__ == '__main__':
+    main()
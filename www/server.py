@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Production entry point: a supervisor process forks worker processes. Each
+worker binds its own listening socket to the same address with SO_REUSEPORT,
+so the kernel spreads connections across all cores.
+
+Signals sent to the supervisor:
+    SIGTERM / SIGINT    drain in-flight requests in every worker, then exit
+    SIGHUP              graceful reload: start a new set of workers, then drain the old ones
+
+Usage:
+    python3 server.py --workers 4 --bind 0.0.0.0:9000 --worker-id-base 0 \
+        --db-user www-data --db-password www-data --db-name awesome --db-connections 40
+
+Each host needs its own --worker-id-base (or WORKER_ID), at least 2 * --workers
+apart, because worker slot i generates ids as worker id base + i.
+'''
+
+import argparse, asyncio, logging, os, select, signal, socket, time
+
+import ids
+import orm
+from aiohttp import web
+
+from app import create_app
+
+def make_socket(host, port, backlog=1024):
+    """创建设置了SO_REUSEPORT的监听socket
+
+    :param host: 监听地址
+    :param port: 端口
+    :param backlog: 等待队列长度
+    :return:
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # 多个进程绑定同一端口，由内核分配连接
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def parse_bind(bind):
+    """解析监听地址
+
+    :param bind: 例如：127.0.0.1:9000 或 [::1]:9000
+    :return: (host, port)
+    """
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+def db_config(args):
+    """生成当前worker的数据库参数，链接池大小由全局链接数预算平均分配
+
+    :param args: 命令行参数
+    :return: orm.create_pool()的参数，未配置数据库时返回None
+    """
+    if not args.db_user:
+        return None
+    maxsize = max(1, args.db_connections // args.workers)
+    return dict(host=args.db_host, port=args.db_port, user=args.db_user, password=args.db_password,
+                db=args.db_name, maxsize=maxsize, minsize=min(args.db_min_connections, maxsize),
+                acquire_timeout=args.db_acquire_timeout)
+
+def run_worker(slot, args, ready=None):
+    """worker进程主函数
+
+    :param slot: worker编号，在所有存活的worker中唯一
+    :param args: 命令行参数
+    :param ready: 开始监听后写入一个字节的管道fd，用于通知supervisor
+    :return:
+    """
+    ids.set_worker_id(args.worker_id_base + slot)     # 保证不同主机、不同worker生成的ID不重复
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stopping = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        loop.add_signal_handler(sig, stopping.set)
+
+    async def serve():
+        db = db_config(args)
+        if db:
+            await orm.create_pool(loop, **db)
+        app = create_app()
+        runner = web.AppRunner(app, shutdown_timeout=args.graceful_timeout)
+        await runner.setup()
+        host, port = parse_bind(args.bind)
+        await web.SockSite(runner, make_socket(host, port, args.backlog)).start()
+        logging.info('worker %s (pid %s) serving on %s' % (slot, os.getpid(), args.bind))
+        if ready is not None:
+            os.write(ready, b'1')
+            os.close(ready)
+        await stopping.wait()
+        logging.info('worker %s (pid %s) draining...' % (slot, os.getpid()))
+        # 停止监听，关闭空闲链接，等待进行中的请求完成（超过graceful_timeout后关闭所有链接），再执行app的清理
+        await runner.cleanup()
+        if db:
+            await orm.close_pool()
+
+    loop.run_until_complete(serve())
+    loop.close()
+
+class Supervisor(object):
+    """管理worker进程：异常退出时重启，收到信号时平滑退出或重载"""
+
+    def __init__(self, args):
+        self.args = args
+        self.workers = dict()       # pid ==> slot
+        self.retiring = set()       # 正在退出的旧worker的pid，退出后不再重启
+        self.stopping = False
+        self.reloading = False
+        self.last_spawn = dict()    # slot ==> 上次启动时间，用于限制崩溃后的重启频率
+
+    def free_slot(self):
+        """选择最小的空闲编号
+
+        编号只在0到2 * workers - 1之间（重载期间新旧两代worker），worker ID = --worker-id-base + 编号，
+        超出范围会与其他主机的worker ID重叠
+
+        :return:
+        """
+        used = set(self.workers.values())
+        for slot in range(2 * self.args.workers):
+            if slot not in used:
+                return slot
+        raise RuntimeError('no free worker slot, %d workers are running' % len(self.workers))
+
+    def spawn(self, slot=None):
+        """启动一个worker进程
+
+        :param slot: worker编号，为None时选择最小的空闲编号
+        :return: 管道的读端fd，worker开始监听后可读
+        """
+        if slot is None:
+            slot = self.free_slot()
+        wait = self.last_spawn.get(slot, 0) + 1.0 - time.monotonic()
+        if wait > 0:                        # 同一编号每秒最多启动一次，避免崩溃循环
+            time.sleep(wait)
+        self.last_spawn[slot] = time.monotonic()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+                signal.signal(sig, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(slot, self.args, w)
+            except BaseException:
+                logging.exception('worker %s crashed' % slot)
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(w)
+        self.workers[pid] = slot
+        return r
+
+    def wait_ready(self, fds, timeout=30.0):
+        """等待新启动的worker开始监听
+
+        :param fds: spawn()返回的fd列表
+        :param timeout: 最长等待时间（秒）
+        :return: 全部就绪时返回True
+        """
+        pending = set(fds)
+        failed = False
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline and not self.stopping:
+            readable, _, _ = select.select(list(pending), [], [], 0.2)
+            for fd in readable:
+                pending.discard(fd)
+                failed = failed or not os.read(fd, 1)   # 读到EOF说明worker在就绪前退出
+        for fd in fds:
+            os.close(fd)
+        return not pending and not failed
+
+    def on_stop(self, signum, frame):
+        self.stopping = True
+
+    def on_reload(self, signum, frame):
+        self.reloading = True
+
+    def reload(self):
+        """平滑重载：先启动新worker，再让旧worker处理完进行中的请求后退出
+
+        新旧worker同时存在期间，数据库链接数最多达到预算的两倍。
+        上一次重载的旧worker尚未全部退出时返回False，由调用方稍后重试，保证编号不超出2 * workers
+
+        :return: 是否已经执行
+        """
+        if self.retiring:
+            return False
+        logging.info('reloading %s workers...' % self.args.workers)
+        old = list(self.workers)
+        fds = [self.spawn() for _ in range(self.args.workers)]
+        if not self.wait_ready(fds):
+            logging.warning('new workers are not ready, keeping old workers running')
+            for pid in self.workers:        # 停止已经启动的新worker，释放编号和数据库链接
+                if pid not in old:
+                    self.retiring.add(pid)
+                    self.kill(pid, signal.SIGTERM)
+            return True
+        for pid in old:
+            self.retiring.add(pid)
+            self.kill(pid, signal.SIGTERM)
+        return True
+
+    def kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        """回收已退出的worker，异常退出的worker会被重启
+
+        :return:
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self.workers.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif not self.stopping and slot is not None:
+                logging.warning('worker %s (pid %s) exited with status %s, restarting' % (slot, pid, status))
+                os.close(self.spawn(slot))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        signal.signal(signal.SIGHUP, self.on_reload)
+        self.wait_ready([self.spawn() for _ in range(self.args.workers)])
+        logging.info('supervisor %s started %s workers on %s' % (os.getpid(), self.args.workers, self.args.bind))
+        while not self.stopping:
+            if self.reloading and self.reload():   # 上一代worker仍在退出时，等它们退出后再重载
+                self.reloading = False
+            self.reap()
+            time.sleep(0.2)
+        logging.info('stopping workers...')
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):      # 超时仍未退出则强制结束
+            self.kill(pid, signal.SIGKILL)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the web app with multiple worker processes.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--bind', default='127.0.0.1:9000')
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--graceful-timeout', type=float, default=30.0, help='seconds to wait for in-flight requests')
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', type=int, default=3306)
+    parser.add_argument('--db-user')
+    parser.add_argument('--db-password', default='')
+    parser.add_argument('--db-name', default='awesome')
+    parser.add_argument('--db-connections', type=int, default=40, help='connection budget shared by all workers')
+    parser.add_argument('--db-min-connections', type=int, default=1)
+    parser.add_argument('--db-acquire-timeout', type=float, default=1.0,
+                        help='seconds to wait for a free connection before answering 503')
+    parser.add_argument('--worker-id-base', type=int, default=os.environ.get('WORKER_ID'),
+                        help='first id generator worker id of this host (default: $WORKER_ID); '
+                             'workers use base to base + 2 * workers - 1, ranges must not overlap across hosts')
+    args = parser.parse_args()
+    if not 1 <= args.workers <= (ids.MAX_WORKER + 1) // 2:     # 重载期间新旧worker同时占用编号
+        parser.error('--workers must be between 1 and %d' % ((ids.MAX_WORKER + 1) // 2))
+    if args.worker_id_base is None:
+        parser.error('--worker-id-base or WORKER_ID is required so that ids from different hosts do not collide')
+    last = args.worker_id_base + 2 * args.workers - 1
+    if args.worker_id_base < 0 or last > ids.MAX_WORKER:
+        parser.error('worker ids %d to %d are out of range 0 to %d' % (args.worker_id_base, last, ids.MAX_WORKER))
+    Supervisor(args).run()
+
+if __name__ == '__main__':
+    main()
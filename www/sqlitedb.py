@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Embedded SQLite driver for orm, for single-node deployments and test runs
+that should not need a MySQL server.
+
+    await orm.create_pool(loop, driver=sqlitedb.SQLiteDriver(), db='awesome.db')
+
+The database runs in WAL mode. Reads run on reader threads with their own
+connections, so they never block the event loop or wait for writers. All
+writes go through one writer thread:
+    - autocommit statements are queued, and everything queued while the
+      previous commit was running is committed together (group commit);
+      each statement runs inside its own savepoint, so one failing statement
+      does not affect the others in the batch
+    - orm.transaction() takes the writer exclusively until it commits or
+      rolls back
+'''
+
+import asyncio, queue, sqlite3, threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+sqlite3.register_converter('boolean', lambda v: v not in (b'0', b''))   # BooleanField按布尔值返回
+
+class Cursor(object):
+    """返回元组的游标"""
+    dict_rows = False
+    streaming = False
+
+class DictCursor(Cursor):
+    """返回字典的游标"""
+    dict_rows = True
+
+class SSCursor(Cursor):
+    """流式游标，迭代期间占用一个读链接"""
+    streaming = True
+
+class SSDictCursor(DictCursor):
+    """流式的字典游标"""
+    streaming = True
+
+_READ_PREFIXES = ('select', 'explain', 'pragma')
+
+class SQLiteDriver(object):
+    """SQLite驱动
+
+    传入orm.create_pool(driver=...)，db参数为数据库文件路径
+    """
+
+    Cursor = Cursor
+    DictCursor = DictCursor
+    SSCursor = SSCursor
+    SSDictCursor = SSDictCursor
+    placeholder = '?'           # sqlite3使用qmark占位符，orm不再替换'?'
+    dialect = 'sqlite'
+
+    def __init__(self, readers=2, cached_statements=256, max_batch=512, busy_timeout=5.0, synchronous='normal'):
+        """初始化
+
+        :param readers: 读线程数
+        :param cached_statements: 每个链接缓存的预编译语句数量
+        :param max_batch: 一次组提交最多包含的语句数
+        :param busy_timeout: 等待数据库锁的时间（秒）
+        :param synchronous: PRAGMA synchronous，WAL模式下normal只在检查点时同步磁盘
+        """
+        self.readers = readers
+        self.cached_statements = cached_statements
+        self.max_batch = max_batch
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+
+    async def create_pool(self, db, maxsize=10, loop=None, **kw):
+        return SQLitePool(self, db, maxsize)
+
+class SQLitePool(object):
+    """数据库文件对应的线程和链接
+
+    接口与aiomysql的链接池一致：get()返回异步上下文管理器，进入时得到链接对象
+    """
+
+    def __init__(self, driver, path, maxsize):
+        self.driver = driver
+        self.path = path
+        self.maxsize = maxsize
+        self.size = maxsize
+        self.in_use = 0
+        self._readers = ThreadPoolExecutor(driver.readers, thread_name_prefix='sqlite-reader')
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='sqlite-writer')
+        self._read_conns = queue.SimpleQueue()  # 空闲的读链接，不够时新建
+        self._all_conns = []
+        self._conns_lock = threading.Lock()
+        self._write_conn = None                 # 只在写线程中使用
+        self._write_lock = asyncio.Lock()       # 组提交与事务轮流占用写链接
+        self._pending = []                      # 等待组提交的(SQL语句, 参数, 是否批量, future)
+        self._flusher = None
+        self._kinds = dict()                    # SQL语句 ==> 是否为只读语句
+        self.batches = self.batched = 0
+
+    @property
+    def freesize(self):
+        return max(0, self.maxsize - self.in_use)
+
+    def get(self):
+        return _PoolContext(self)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.driver.busy_timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=self.driver.cached_statements,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('pragma synchronous=%s' % self.driver.synchronous)
+        with self._conns_lock:
+            self._all_conns.append(conn)
+        return conn
+
+    def is_read(self, sql):
+        kind = self._kinds.get(sql)
+        if kind is None:
+            kind = self._kinds[sql] = sql.lstrip()[:7].lower().startswith(_READ_PREFIXES)
+        return kind
+
+    # 以下方法在读线程中执行
+
+    def _checkout(self):
+        try:
+            return self._read_conns.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _read(self, sql, args, dict_rows):
+        conn = self._checkout()
+        try:
+            cur = conn.execute(sql, args)
+            return _rows(cur, cur.fetchall(), dict_rows)
+        finally:
+            self._read_conns.put(conn)
+
+    def _open_stream(self, sql, args):
+        conn = self._checkout()
+        try:
+            return conn, conn.execute(sql, args)
+        except BaseException:
+            self._read_conns.put(conn)
+            raise
+
+    def _fetch_stream(self, cur, size, dict_rows):
+        return _rows(cur, cur.fetchall() if size is None else cur.fetchmany(size), dict_rows)
+
+    def _close_stream(self, conn, cur):
+        cur.close()
+        self._read_conns.put(conn)
+
+    # 以下方法在写线程中执行
+
+    def _wconn(self):
+        if self._write_conn is None:
+            self._write_conn = self._connect()
+        return self._write_conn
+
+    def _exec(self, sql, args, many, dict_rows=False):
+        conn = self._wconn()
+        cur = conn.executemany(sql, args) if many else conn.execute(sql, args)
+        rows = _rows(cur, cur.fetchall(), dict_rows) if cur.description else []
+        return cur.rowcount, rows
+
+    def _group_commit(self, items):
+        conn = self._wconn()
+        if len(items) == 1:                     # 只有一条语句时不需要保存点
+            sql, args, many = items[0]
+            try:
+                conn.execute('begin immediate')
+                n = (conn.executemany(sql, args) if many else conn.execute(sql, args)).rowcount
+                conn.execute('commit')
+                return [(n, None)]
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute('rollback')
+                return [(None, e)]
+        results = []
+        conn.execute('begin immediate')
+        try:
+            for sql, args, many in items:
+                conn.execute('savepoint batch_item')
+                try:
+                    n = (conn.executemany(sql, args) if many else conn.execute(sql, args)).rowcount
+                    conn.execute('release batch_item')
+                    results.append((n, None))
+                except Exception as e:
+                    conn.execute('rollback to batch_item')
+                    conn.execute('release batch_item')
+                    results.append((None, e))
+            conn.execute('commit')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('rollback')
+            return [(None, e)] * len(items)
+        return results
+
+    # 以下方法在事件循环中执行
+
+    async def read(self, sql, args, dict_rows):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._readers, self._read, sql, args, dict_rows)
+
+    async def run_writer(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._writer, func, *args)
+
+    def write(self, sql, args, many):
+        """登记一条自动提交的写语句，在下一次组提交中执行
+
+        :return: 返回影响行数的future
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((sql, args, many, future))
+        if self._flusher is None:
+            self._flusher = loop.create_task(self._flush())
+        return future
+
+    async def _flush(self):
+        try:
+            while self._pending:
+                async with self._write_lock:
+                    items = self._pending[:self.driver.max_batch]
+                    del self._pending[:len(items)]
+                    try:
+                        results = await self.run_writer(self._group_commit, [i[:3] for i in items])
+                    except BaseException as e:
+                        results = [(None, e)] * len(items)
+                self.batches += 1
+                self.batched += len(items)
+                for (sql, args, many, future), (n, error) in zip(items, results):
+                    if future.done():
+                        continue
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(n)
+        finally:
+            self._flusher = None
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        while self._flusher is not None:
+            await asyncio.sleep(0.001)
+        with self._conns_lock:
+            conns, self._all_conns = self._all_conns, []
+        self._writer.shutdown()
+        self._readers.shutdown()
+        for conn in conns:
+            conn.close()
+
+def _rows(cur, rows, dict_rows):
+    if dict_rows and rows:
+        columns = [d[0] for d in cur.description]
+        return [dict(zip(columns, r)) for r in rows]
+    return rows
+
+class _PoolContext(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        self.pool.in_use += 1
+        return SQLiteConnection(self.pool)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.in_use -= 1
+
+class SQLiteConnection(object):
+    """链接对象，开始事务后独占写链接直到提交或回滚"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.in_transaction = False
+
+    def cursor(self, cursorclass=Cursor):
+        return SQLiteCursor(self, cursorclass)
+
+    async def begin(self):
+        await self.pool._write_lock.acquire()
+        try:
+            await self.pool.run_writer(self.pool._exec, 'begin immediate', (), False)
+        except BaseException:
+            self.pool._write_lock.release()
+            raise
+        self.in_transaction = True
+
+    async def commit(self):
+        await self._end('commit')
+
+    async def rollback(self):
+        await self._end('rollback')
+
+    async def _end(self, sql):
+        if not self.in_transaction:
+            return
+        try:
+            await self.pool.run_writer(self.pool._exec, sql, (), False)
+        finally:
+            self.in_transaction = False
+            self.pool._write_lock.release()
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, cursorclass):
+        self.conn = conn
+        self.pool = conn.pool
+        self.dict_rows = cursorclass.dict_rows
+        self.streaming = cursorclass.streaming
+        self.rowcount = -1
+        self._rows = []
+        self._stream = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def execute(self, sql, args=None):
+        args = args or ()
+        pool = self.pool
+        if self.conn.in_transaction:            # 事务中的所有语句都在写链接上执行，才能读到未提交的修改
+            self.rowcount, self._rows = await pool.run_writer(pool._exec, sql, args, False, self.dict_rows)
+        elif pool.is_read(sql):
+            if self.streaming:
+                loop = asyncio.get_event_loop()
+                self._stream = await loop.run_in_executor(pool._readers, pool._open_stream, sql, args)
+            else:
+                self._rows = await pool.read(sql, args, self.dict_rows)
+            self.rowcount = -1
+        else:
+            self.rowcount = await pool.write(sql, args, False)
+        return self.rowcount
+
+    async def executemany(self, sql, args):
+        pool = self.pool
+        if self.conn.in_transaction:
+            self.rowcount, _ = await pool.run_writer(pool._exec, sql, args, True)
+        else:
+            self.rowcount = await pool.write(sql, args, True)
+        return self.rowcount
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+    async def fetchmany(self, size=1):
+        if self._stream is not None:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.pool._readers, self.pool._fetch_stream,
+                                              self._stream[1], size, self.dict_rows)
+        rs, self._rows = self._rows[:size], self._rows[size:]
+        return rs
+
+    async def fetchall(self):
+        if self._stream is not None:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.pool._readers, self.pool._fetch_stream,
+                                              self._stream[1], None, self.dict_rows)
+        rs, self._rows = self._rows, []
+        return rs
+
+    async def close(self):
+        if self._stream is not None:
+            stream, self._stream = self._stream, None
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.pool._readers, self.pool._close_stream, *stream)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio, os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('WORKER_ID', '1')     # 测试进程生成ID使用的worker编号
+
+import orm, sqlitedb
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    tasks = asyncio.all_tasks(loop)     # 例如计数器的定期写入任务
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+@pytest.fixture
+def db(loop, tmp_path):
+    """每个测试使用一个新的SQLite数据库
+
+    :return:建表函数 create(*models)
+    """
+    loop.run_until_complete(orm.create_pool(loop, driver=sqlitedb.SQLiteDriver(), db=str(tmp_path / 'test.db')))
+    for model in orm._models.values():
+        if model.__cache_store__ is not None:
+            model.__cache_store__.clear()
+
+    def create(*models):
+        for model in models:
+            for sql in model.createTableSQL():
+                loop.run_until_complete(orm.execute(sql, []))
+
+    yield create
+    loop.run_until_complete(orm.close_pool())
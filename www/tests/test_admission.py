@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+import fakedb, orm
+from admission import Admission, RouteClass
+
+def single(target=0.05):
+    rc = RouteClass('read', limit=1, max_queue=4, target=target)
+    return Admission([rc]), rc
+
+def test_timed_out_waiters_leave_the_queue(loop):
+    admission, rc = single()
+
+    async def scenario():
+        assert await admission.enter(rc)
+        assert not await admission.enter(rc)        # 排队超过target后被拒绝
+        assert len(rc.waiters) == 0 and rc.shed == 1
+        rc.release()
+        assert rc.in_flight == 0
+
+    loop.run_until_complete(scenario())
+
+def test_cancelled_waiters_leave_the_queue(loop):
+    admission, rc = single(target=10)
+
+    async def scenario():
+        assert await admission.enter(rc)
+        waiting = asyncio.ensure_future(admission.enter(rc))
+        await asyncio.sleep(0)
+        assert len(rc.waiters) == 1
+        waiting.cancel()                            # 客户端断开
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert len(rc.waiters) == 0
+        rc.release()
+        assert rc.in_flight == 0
+
+    loop.run_until_complete(scenario())
+
+def test_release_hands_the_slot_to_the_next_waiter(loop):
+    admission, rc = single(target=10)
+
+    async def scenario():
+        assert await admission.enter(rc)
+        waiting = asyncio.ensure_future(admission.enter(rc))
+        await asyncio.sleep(0)
+        rc.release()
+        assert await waiting and rc.in_flight == 1
+        rc.release()
+        assert rc.in_flight == 0
+
+    loop.run_until_complete(scenario())
+
+def test_acquire_times_out_only_when_the_pool_is_exhausted(loop):
+
+    async def scenario():
+        await orm.create_pool(loop, driver=fakedb.FakeDriver(), db='fake', maxsize=1, acquire_timeout=0.05)
+        try:
+            pool = vars(orm)['__pool']
+            assert orm._idle(pool)
+            assert not isinstance(orm.acquire(), orm._TimedAcquire)     # 有空闲链接时不计时
+            async with orm.acquire():
+                assert not orm._idle(pool) and orm.pool_saturated()
+                with pytest.raises(orm.PoolTimeoutError):
+                    async with orm.acquire():
+                        pass
+            assert orm._idle(pool)
+            async with orm.acquire():
+                pass
+        finally:
+            await orm.close_pool()
+
+    loop.run_until_complete(scenario())
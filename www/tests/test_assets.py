@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from assets import StaticFiles, accepted_encodings, build
+
+def test_accepted_encodings():
+    assert accepted_encodings('') == set()
+    assert accepted_encodings('gzip, deflate, br') == {'gzip', 'br'}
+    assert accepted_encodings('gzip;q=0') == set()
+    assert accepted_encodings('GZIP; Q=0.5, br;q=0') == {'gzip'}
+    assert accepted_encodings('*;q=0.1, br;q=0') == {'gzip'}
+    assert accepted_encodings('gzip;q=oops') == set()
+
+def test_static_files_skip_refused_encodings(loop, tmp_path):
+    (tmp_path / 'app.css').write_text('body { color: red; }\n' * 50)
+    build(str(tmp_path))
+    static = StaticFiles(str(tmp_path), '/static/')
+    app = web.Application()
+    app.router.add_route('GET', '/static/{filename:.+}', static)
+
+    async def scenario():
+        async with TestClient(TestServer(app)) as client:
+            r = await client.get('/static/app.css', headers={'Accept-Encoding': 'gzip'}, auto_decompress=False)
+            assert r.headers.get('Content-Encoding') == 'gzip'
+            r = await client.get('/static/app.css', headers={'Accept-Encoding': 'gzip;q=0'}, auto_decompress=False)
+            assert 'Content-Encoding' not in r.headers
+            assert (await r.text()).startswith('body')
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from apis import APIValeError
+
+from coroweb import get, post, add_route, response_cache, response_factory, purge_cache
+
+def serve(loop, handlers, scenario, middlewares=(response_factory,)):
+    """启动测试服务器，注册处理函数后执行 scenario(client)"""
+    app = web.Application(middlewares=list(middlewares))
+    for fn in handlers:
+        add_route(app, fn)
+
+    async def run():
+        async with TestClient(TestServer(app)) as client:
+            await scenario(client)
+
+    loop.run_until_complete(run())
+
+@get('/plain/{name}')
+def plain(name, *, page='1'):
+    return dict(name=name, page=int(page))
+
+@get('/coro')
+async def coro(request):
+    return [1, 2, 3]
+
+@get('/text')
+def text():
+    return '<p>hi</p>'
+
+def test_routes_results_reach_response_factory(loop):
+
+    async def scenario(client):
+        r = await client.get('/plain/bob?page=2')
+        assert r.status == 200 and r.content_type == 'application/json'
+        assert await r.json() == dict(name='bob', page=2)
+        r = await client.get('/coro')
+        assert await r.json() == [1, 2, 3]
+        r = await client.get('/text')
+        assert r.content_type == 'text/html' and await r.text() == '<p>hi</p>'
+
+    serve(loop, [plain, coro, text], scenario)
+
+@post('/api/users')
+def create_user(*, name, email, admin='0'):
+    if '@' not in email:
+        raise APIValeError('email', 'invalid email')
+    return dict(name=name, email=email, admin=admin)
+
+@post('/api/echo/{id}')
+def echo(id, request, **kw):
+    return dict(id=id, method=request.method, kw=kw)
+
+def test_arguments_bound_from_json_form_and_path(loop):
+
+    async def scenario(client):
+        r = await client.post('/api/users', json=dict(name='a', email='a@b.c', extra=1))
+        assert await r.json() == dict(name='a', email='a@b.c', admin='0')
+        r = await client.post('/api/users', data=dict(name='a', email='a@b.c', admin='1'))
+        assert (await r.json())['admin'] == '1'
+        r = await client.post('/api/users', json=dict(name='a'))
+        assert r.status == 400 and 'email' in await r.text()
+        r = await client.post('/api/users', json=dict(name='a', email='nope'))
+        assert (await r.json())['error'] == 'value:invalid'
+        r = await client.post('/api/users', json=[1, 2])
+        assert r.status == 400
+        r = await client.post('/api/echo/7', json=dict(a=1))
+        assert await r.json() == dict(id='7', method='POST', kw=dict(a=1))
+
+    serve(loop, [create_user, echo], scenario)
+
+@get('/login', cache=60)
+def login(request):
+    resp = web.Response(text='welcome')
+    resp.set_cookie('session', 'abc')
+    return resp
+
+@get('/page', cache=60)
+def page(request):
+    resp = web.Response(text='page')
+    resp.headers['X-Frame-Options'] = 'DENY'
+    return resp
+
+def test_response_cache_keeps_handler_headers(loop):
+    purge_cache()
+
+    async def scenario(client):
+        for _ in range(2):      # 设置了Cookie的响应不缓存，每次都返回处理函数的响应
+            r = await client.get('/login')
+            assert r.cookies['session'].value == 'abc' and 'ETag' not in r.headers
+        miss = await client.get('/page')
+        hit = await client.get('/page')
+        for r in (miss, hit):
+            assert await r.text() == 'page'
+            assert r.headers['X-Frame-Options'] == 'DENY' and r.headers['Cache-Control'] == 'no-cache'
+        assert miss.headers['ETag'] == hit.headers['ETag']
+        r = await client.get('/page', headers={'If-None-Match': hit.headers['ETag']})
+        assert r.status == 304
+
+    serve(loop, [login, page], scenario, middlewares=(response_cache, response_factory))
+
+received = []
+
+@post('/upload', stream=True, max_body=64 * 1024)
+def upload(*, title, attachment):
+    received.append(attachment)
+    if title == 'fail':
+        raise RuntimeError('handler failed')
+    return dict(title=title, size=attachment.size, head=attachment.read(5).decode())
+
+def test_streamed_uploads_are_closed(loop):
+    received.clear()
+
+    def form(title, data):
+        form = aiohttp.FormData()
+        form.add_field('title', title)
+        form.add_field('attachment', data, filename='a.txt', content_type='text/plain')
+        return form
+
+    async def scenario(client):
+        r = await client.post('/upload', data=form('ok', b'hello world'))
+        assert await r.json() == dict(title='ok', size=11, head='hello')
+        r = await client.post('/upload', data=form('fail', b'data'))
+        assert r.status == 500
+        assert len(received) == 2 and all(u.file.closed for u in received)
+        r = await client.post('/upload', data=form('big', b'x' * (128 * 1024)))
+        assert r.status == 413
+
+    serve(loop, [upload], scenario)
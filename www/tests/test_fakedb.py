@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import fakedb, orm
+from bench import make_load_app
+from models import Blog
+
+def test_columns_come_from_the_select_list():
+    driver = fakedb.FakeDriver()
+    assert driver.columns('select `id`, count(`x`, `y`) _num_, `name` from `t` where a=?') == ('id', '_num_', 'name')
+    assert driver.columns('update `t` set a=?') is None
+    columns, rows = driver.result('select count(*) _num_ from `t`')
+    assert rows == [(driver.rows,)]
+
+def test_orm_runs_against_the_fake_driver(loop):
+    driver = fakedb.FakeDriver(rows=7)
+
+    async def scenario():
+        await orm.create_pool(loop, driver=driver, db='fake', maxsize=2)
+        try:
+            blogs = await Blog.findAll(orderBy='created_at desc', limit=7)
+            assert len(blogs) == 7 and blogs[0].name == 'name-0'
+            await Blog(user_id='u', user_name='n', user_image='', name='t', summary='s', content='c').save()
+            assert driver.statements == 2
+        finally:
+            await orm.close_pool()
+
+    loop.run_until_complete(scenario())
+
+def test_load_app_serves_fake_rows(loop):
+    driver = fakedb.FakeDriver(rows=3)
+
+    async def scenario():
+        await orm.create_pool(loop, driver=driver, db='fake')
+        try:
+            async with TestClient(TestServer(make_load_app())) as client:
+                r = await client.get('/api/blogs')
+                assert len((await r.json())['blogs']) == 3
+                r = await client.get('/api/blog?id=blog-1')
+                assert (await r.json())['id'] == 'id-0'
+        finally:
+            await orm.close_pool()
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import ids
+from orm import Model, IntegerField, StringField
+
+def test_ids_are_ordered_and_carry_the_worker():
+    first, second = ids.next_id(), ids.next_id()
+    assert first < second
+    assert ids.id_worker(first) == ids._worker
+    assert ids.next_id_str() > ids.to_str(second)
+    assert len(ids.next_id_str()) == ids.STR_WIDTH
+
+def test_worker_id_is_required(monkeypatch):
+    monkeypatch.setattr(ids, '_worker', None)
+    with pytest.raises(ids.WorkerIdError):
+        ids.next_id()
+    with pytest.raises(ids.WorkerIdError):
+        ids.next_id_str()
+
+def test_make_id_round_trip():
+    id = ids.make_id(ids.EPOCH + 1234, worker_id=7, sequence=3)
+    assert ids.id_worker(id) == 7
+    assert ids.id_time(id) == (ids.EPOCH + 1234) / 1000.0
+
+class Plain(Model):
+    __table__ = 'plain'
+
+    id = IntegerField(primary_key=True)
+    count = IntegerField()
+    optional = IntegerField(default=None)
+
+class Snowflake(Model):
+    __table__ = 'snowflake'
+
+    id = IntegerField(primary_key=True, default=ids.next_id)
+
+def test_generated_primary_keys_are_opt_in():
+    plain = Plain()
+    assert plain.getValueOrDefault('id') == 0       # 自增主键不会被生成的ID覆盖
+    assert plain.getValueOrDefault('count') == 0
+    assert plain.getValueOrDefault('optional') is None
+    generated = Snowflake().getValueOrDefault('id')
+    assert isinstance(generated, int) and ids.id_worker(generated) == ids._worker
+    assert StringField(primary_key=True).default is None
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+import fakedb, ids, orm
+from orm import Model, StringField, IntegerField, TextField, BelongsTo, HasMany
+
+class Note(Model):
+    __table__ = 'notes'
+
+    id = StringField(primary_key=True, default=ids.next_id_str, ddl='char(20)')
+    title = StringField()
+    stars = IntegerField()
+
+class CachedNote(Model):
+    __table__ = 'cached_notes'
+    __cache__ = dict(maxsize=100)
+
+    id = StringField(primary_key=True, default=ids.next_id_str, ddl='char(20)')
+    title = StringField()
+
+class Counted(Model):
+    __table__ = 'counted'
+    __batch_find__ = True
+
+    id = IntegerField(primary_key=True)
+    name = StringField()
+
+class Tally(Model):
+    __table__ = 'tallies'
+    __counters__ = [(), ('blog',)]
+
+    id = StringField(primary_key=True, default=ids.next_id_str, ddl='char(20)')
+    blog = StringField()
+
+class Article(Model):
+    __table__ = 'articles'
+
+    id = IntegerField(primary_key=True)
+    title = StringField()
+    body = TextField()
+
+class Owner(Model):
+    __table__ = 'owners'
+
+    id = IntegerField(primary_key=True)
+    name = StringField()
+    pets = HasMany('Pet', 'owner_id', orderBy='name', batch_size=2)
+
+class Pet(Model):
+    __table__ = 'pets'
+
+    id = StringField(primary_key=True, default=ids.next_id_str, ddl='char(20)')
+    owner_id = StringField()     # 与Owner的整数主键类型不同
+    name = StringField()
+    owner = BelongsTo('Owner', 'owner_id')
+
+class Doc(Model):
+    __table__ = 'docs'
+    __version__ = 'version'
+
+    id = StringField(primary_key=True, default=ids.next_id_str, ddl='char(20)')
+    title = StringField()
+    body = StringField()
+    version = IntegerField()
+
+class QueryLog(orm.QueryHook):
+
+    def __init__(self):
+        self.statements = []
+        self.slow = []
+
+    def on_query(self, sql, seconds, rows, error):
+        self.statements.append(sql)
+
+    def on_slow_query(self, sql, args, seconds):
+        self.slow.append((sql, args))
+
+def test_save_many(loop, db):
+    db(Note)
+
+    async def scenario():
+        notes = [Note(title='n%d' % i, stars=i) for i in range(25)]
+        affected = await Note.save_many(notes, batch_size=10)
+        assert affected == [10, 10, 5]
+        assert await Note.findNumber('count(*)') == 25
+        assert sorted(n.title for n in await Note.findAll()) == sorted(n.title for n in notes)
+        assert all(n.dirtyFields() == [] for n in notes)
+
+    loop.run_until_complete(scenario())
+
+def test_find_cache_read_through_and_invalidation(loop, db):
+    db(CachedNote)
+
+    async def scenario():
+        note = CachedNote(title='a')
+        await note.save()
+        await orm.execute('update cached_notes set title=? where id=?', ['changed behind the cache', note.id])
+        assert (await CachedNote.find(note.id)).title == 'a'     # save()写入了缓存
+        note.title = 'b'
+        await note.update()
+        assert (await CachedNote.find(note.id)).title == 'b'
+        await note.remove()
+        assert await CachedNote.find(note.id) is None
+
+    loop.run_until_complete(scenario())
+
+def test_find_cache_bypassed_inside_transaction(loop, db):
+    db(CachedNote)
+
+    async def scenario():
+        note = CachedNote(title='committed')
+        await note.save()
+        CachedNote.__cache_store__.clear()
+        try:
+            async with orm.transaction():
+                await orm.execute('update cached_notes set title=? where id=?', ['uncommitted', note.id])
+                assert (await CachedNote.find(note.id)).title == 'uncommitted'
+                assert (await CachedNote.find_many([note.id]))[0].title == 'uncommitted'
+                raise RuntimeError('rollback')
+        except RuntimeError:
+            pass
+        assert CachedNote.__cache_store__.get(note.id) is None
+        assert (await CachedNote.find(note.id)).title == 'committed'
+
+    loop.run_until_complete(scenario())
+
+def test_find_many_and_batched_find_match_normalized_keys(loop, db):
+    db(Counted)
+    log = QueryLog()
+
+    async def scenario():
+        await Counted.save_many([Counted(id=i, name='c%d' % i) for i in range(1, 4)])
+        found = await Counted.find_many(['2', 1, 99, 2])
+        assert [c.name if c else None for c in found] == ['c2', 'c1', None, 'c2']
+        orm.add_hook(log)
+        try:
+            a, b, c = await asyncio.gather(Counted.find('1'), Counted.find(3), Counted.find(42))
+        finally:
+            orm.remove_hook(log)
+        assert (a.name, b.name, c) == ('c1', 'c3', None)
+        assert len(log.statements) == 1     # 同一轮事件循环中的find()合并为一次查询
+
+    loop.run_until_complete(scenario())
+
+def test_transaction_commit_rollback_and_savepoints(loop, db):
+    db(Note)
+    events = []
+
+    async def scenario():
+        async with orm.transaction():
+            await Note(title='outer').save()
+            orm.on_commit(lambda: events.append('outer committed'))
+            try:
+                async with orm.transaction():
+                    await Note(title='inner').save()
+                    orm.on_commit(lambda: events.append('inner committed'))
+                    raise RuntimeError('rollback to savepoint')
+            except RuntimeError:
+                pass
+        assert [n.title for n in await Note.findAll()] == ['outer']
+        assert events == ['outer committed']
+        try:
+            async with orm.transaction():
+                await Note(title='discarded').save()
+                orm.on_commit(lambda: events.append('discarded committed'))
+                orm.on_commit(lambda: events.append('always'), always=True)
+                raise RuntimeError('rollback')
+        except RuntimeError:
+            pass
+        assert await Note.findNumber('count(*)') == 1
+        assert events == ['outer committed', 'always']
+
+    loop.run_until_complete(scenario())
+
+def test_counters_fall_back_to_count_when_table_missing(loop, db):
+    db(Tally)
+    counters = Tally.__counter_set__
+    counters.retry_interval = 0     # 计数表可用后立即恢复使用
+
+    async def scenario():
+        await Tally.save_many([Tally(blog='a'), Tally(blog='a'), Tally(blog='b')])
+        assert await Tally.findNumber('count(*)', '`blog`=?', ['a']) == 2
+        assert counters.stats()['unavailable']
+        await orm.create_counter_table()
+        assert await Tally.findNumber('count(*)') == 3
+        assert not counters.stats()['unavailable']
+        first = (await Tally.findAll('`blog`=?', ['a']))[0]
+        await Tally(id=first.id).remove()   # 只有主键的对象先读取维度列
+        assert await Tally.findNumber('count(*)', '`blog`=?', ['a']) == 1
+        assert await Tally.findNumber('count(*)') == 2
+        await orm.flush_counters()
+        rows = await orm.select('select `k`, `n` from `counters` where `name`=?', ['tallies:blog'])
+        assert {r['k']: r['n'] for r in rows} == {'["a"]': 1}
+
+    loop.run_until_complete(scenario())
+
+def test_deferred_columns_and_load_deferred(loop, db):
+    db(Article)
+
+    async def scenario():
+        await Article.save_many([Article(id=i, title='t%d' % i, body='b%02d' % (10 - i)) for i in range(1, 6)])
+        articles = await Article.findAll(orderBy='id')
+        assert all('body' not in a for a in articles)
+        with pytest.raises(AttributeError):
+            articles[0].body
+        projected = await Article.findAll(fields=['title'])
+        assert all(set(a) == {'id', 'title'} for a in projected)
+        strays = [Article(id=str(a.id)) for a in articles]  # 主键与数据库返回的类型不同
+        await Article.loadDeferred(articles + strays, ['title', 'body'], batch_size=2)
+        assert [a.body for a in articles] == ['b09', 'b08', 'b07', 'b06', 'b05']
+        assert [a.body for a in strays] == [a.body for a in articles]
+        assert articles[0].dirtyFields() == []   # 读取的值不算修改
+
+    loop.run_until_complete(scenario())
+
+def test_find_page_by_deferred_column(loop, db):
+    db(Article)
+
+    async def scenario():
+        await Article.save_many([Article(id=i, title='t%d' % i, body='b%02d' % (20 - i)) for i in range(1, 16)])
+        seen, cursor = [], None
+        while True:
+            page, cursor = await Article.findPage(order='body asc', size=4, after=cursor)
+            seen += [a.body for a in page]
+            if cursor is None:
+                break
+        assert seen == sorted('b%02d' % (20 - i) for i in range(1, 16))
+
+    loop.run_until_complete(scenario())
+
+def test_prefetch_matches_keys_of_different_types(loop, db):
+    db(Owner, Pet)
+
+    async def scenario():
+        await Owner.save_many([Owner(id=i, name='o%d' % i) for i in range(1, 5)])
+        await Pet.save_many([Pet(owner_id=str(i), name='p%d%s' % (i, c)) for i in (1, 2, 3) for c in 'ba'])
+        owners = await Owner.findAll(orderBy='id', prefetch=['pets', 'pets.owner'])
+        assert [[p.name for p in o.pets] for o in owners] == [['p1a', 'p1b'], ['p2a', 'p2b'], ['p3a', 'p3b'], []]
+        assert all(p.owner.id == o.id for o in owners for p in o.pets)
+        pets = await Pet.findAll(prefetch=['owner'])
+        assert all(p.owner is not None and p.owner.name == 'o' + p.owner_id for p in pets)
+
+    loop.run_until_complete(scenario())
+
+def test_update_writes_only_dirty_fields(loop, db):
+    db(Doc)
+    log = QueryLog()
+
+    async def scenario():
+        await Doc(title='t', body='b').save()
+        doc = (await Doc.findAll())[0]
+        orm.add_hook(log)
+        try:
+            await doc.update()                      # 没有修改时不执行语句
+            doc.title = 't2'
+            await doc.update()
+        finally:
+            orm.remove_hook(log)
+        assert len(log.statements) == 1
+        assert '`title`' in log.statements[0] and '`body`' not in log.statements[0]
+        assert doc.version == 1 and doc.dirtyFields() == []
+
+    loop.run_until_complete(scenario())
+
+def test_rollback_restores_dirty_fields_and_version(loop, db):
+    db(Doc)
+
+    async def scenario():
+        await Doc(title='t', body='b').save()
+        doc = (await Doc.findAll())[0]
+        doc.title = 't2'
+        try:
+            async with orm.transaction():
+                await doc.update()
+                assert doc.version == 1 and doc.dirtyFields() == []
+                raise RuntimeError('rollback')
+        except RuntimeError:
+            pass
+        assert doc.dirtyFields() == ['title'] and doc.version == 0
+        async with orm.transaction():
+            try:
+                async with orm.transaction():
+                    await doc.update()
+                    raise RuntimeError('rollback to savepoint')
+            except RuntimeError:
+                pass
+        assert doc.dirtyFields() == ['title'] and doc.version == 0
+        await doc.update()                          # 回滚后可以重新写入，不会误报StaleObjectError
+        rows = await orm.select('select `title`, `version` from `docs`', [])
+        assert rows == [dict(title='t2', version=1)]
+
+    loop.run_until_complete(scenario())
+
+def test_versioned_update_checks(loop, db):
+    db(Doc)
+
+    async def scenario():
+        doc = Doc(title='t', body='b', version=0)
+        await doc.save()
+        with pytest.raises(ValueError):             # 直接构造且没有版本号的对象
+            await Doc(id=doc.id, title='x').update()
+        await Doc(id=doc.id, title='y', version=0).update()
+        stale = (await Doc.findAll())[0]
+        doc.title = 'z'
+        with pytest.raises(orm.StaleObjectError):   # 数据库中的版本号已经是1
+            await doc.update()
+        stale.title = 'w'
+        await stale.update()
+        assert (await Doc.findAll())[0].title == 'w'
+
+    loop.run_until_complete(scenario())
+
+def test_iterate_streams_all_rows(loop, db):
+    db(Note)
+
+    async def scenario():
+        await Note.save_many([Note(title='n%02d' % i, stars=i) for i in range(23)])
+        titles = [n.title async for n in Note.iterate('`stars`>=?', [3], chunk_size=5, orderBy='stars')]
+        assert titles == ['n%02d' % i for i in range(3, 23)]
+
+    loop.run_until_complete(scenario())
+
+def test_find_page_walks_ties_once(loop, db):
+    db(Note)
+
+    async def scenario():
+        await Note.save_many([Note(title='n%02d' % i, stars=i // 4) for i in range(18)])   # 排序字段有重复值
+        seen, cursor = [], None
+        while True:
+            page, cursor = await Note.findPage('`stars`<?', [4], order='stars desc', size=5, after=cursor)
+            seen += [n.title for n in page]
+            if cursor is None:
+                break
+        assert len(seen) == len(set(seen)) == 16
+        with pytest.raises(ValueError):
+            await Note.findPage(order='stars; drop table notes')
+        with pytest.raises(ValueError):
+            await Note.findPage(order='stars desc', after='not a cursor')
+
+    loop.run_until_complete(scenario())
+
+def test_compiled_sql_is_reused_per_query_shape(loop, db):
+    db(Note)
+
+    async def scenario():
+        await Note.findAll('`stars`=?', [1], orderBy='title', limit=(0, 5))
+        size = len(orm._compiled)
+        for i in range(10):
+            await Note.findAll('`stars`=?', [i], orderBy='title', limit=(i, 5))
+        assert len(orm._compiled) == size
+
+    loop.run_until_complete(scenario())
+
+def test_compile_sql_converts_placeholders():
+    orm.set_placeholder('%s')
+    try:
+        sql = orm.compile_sql('select * from `notes` where `id`=? and `stars`>?')
+        assert sql == 'select * from `notes` where `id`=%s and `stars`>%s'
+        assert orm.compile_sql('select * from `notes` where `id`=? and `stars`>?') is sql
+    finally:
+        orm.set_placeholder('?')
+
+def test_find_records_returns_compact_rows(loop, db):
+    db(Article)
+
+    async def scenario():
+        await Article.save_many([Article(id=i, title='t%d' % i, body='b%d' % i) for i in range(3)])
+        records = await Article.findRecords(orderBy='id')
+        assert [r.title for r in records] == ['t0', 't1', 't2']
+        assert records[0]._fields == ('id', 'title')     # 默认不包含延迟加载的列
+        assert records[1].to_dict() == dict(id=1, title='t1')
+        projected = await Article.findRecords('`id`=?', [2], fields=['body'])
+        assert projected[0].to_dict() == dict(id=2, body='b2')
+
+    loop.run_until_complete(scenario())
+
+def test_reads_go_to_replicas(loop):
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await orm.create_pool(loop, driver=fakedb.FakeDriver(), db='fake', replica_policy='random')
+        await orm.create_pool(loop, driver=fakedb.FakeDriver(), db='fake', replicas=[dict(host='r1'), dict(host='r2')])
+        try:
+            primary, replicas = vars(orm)['__pool'], vars(orm)['__replicas']
+            assert orm.acquire().pool is primary
+            picked = {orm.acquire(readonly=True).pool for _ in range(4)}
+            assert picked == set(replicas)      # 轮询所有副本
+            async with orm.transaction():
+                assert isinstance(orm.acquire(readonly=True), orm._Lease)   # 事务中的读也在主库上执行
+        finally:
+            await orm.close_pool()
+
+    loop.run_until_complete(scenario())
+
+def test_query_stats_and_slow_query_hook(loop, db):
+    db(Note)
+    log = QueryLog()
+
+    async def scenario():
+        orm.reset_stats()
+        await Note.save_many([Note(title='a', stars=1), Note(title='b', stars=2)])
+        for _ in range(3):
+            await Note.findAll('`stars`>?', [0])
+        stats = orm.query_stats()
+        counted = [s for sql, s in stats['statements'].items() if sql.startswith('select') and 'from `notes`' in sql]
+        assert len(counted) == 1 and counted[0]['calls'] == 3 and counted[0]['rows'] == 6
+        assert stats['acquire_wait']['count'] == 4
+        orm.add_hook(log)
+        orm.set_slow_query_threshold(0)
+        try:
+            await Note.findAll('`stars`>?', [1])
+        finally:
+            orm.set_slow_query_threshold(None)
+            orm.remove_hook(log)
+        assert log.slow == [(log.statements[0], [1])]
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import orm, schema
+from models import User, Blog, Comment
+from orm import Index, Model, StringField
+
+def test_declared_indexes_generate_ddl():
+    sqls = Comment.createTableSQL('mysql')
+    assert sqls[0].startswith('create table `comments`') and sqls[0].endswith('engine=innodb default charset=utf8')
+    assert sqls[1:] == ['create index `idx_comments_created_at` on `comments` (`created_at`)',
+                        'create index `idx_comments_blog_id_created_at` on `comments` (`blog_id`, `created_at`)']
+    assert [(i.name, i.unique) for i in User.__index_list__] == [('uniq_users_email', True), ('idx_users_created_at', False)]
+
+def test_unknown_index_columns_are_rejected():
+    with pytest.raises(Exception):
+        class Broken(Model):
+            __table__ = 'broken'
+            __indexes__ = [('missing',)]
+
+            id = StringField(primary_key=True)
+
+def test_covered_by_live_indexes():
+    live = {'PRIMARY': (('id',), True), 'idx': (('blog_id', 'created_at'), False), 'uniq': (('email', 'name'), True)}
+    assert schema.covered(Index('blog_id'), live)
+    assert not schema.covered(Index('created_at'), live)
+    assert not schema.covered(Index('email', unique=True), live)
+    assert schema.covered(Index('email', 'name', unique=True), live)
+
+def test_ddl_creates_a_working_sqlite_schema(loop, db):
+
+    async def scenario():
+        for sql in schema.ddl(dialect_name='sqlite'):
+            await orm.execute(sql, [])
+        user = User(email='a@b.c', passwd='x', admin=False, name='a', image='')
+        await user.save()
+        await Blog(user_id=user.id, user_name='a', user_image='', name='t', summary='s', content='c').save()
+        assert (await User.find(user.id)).email == 'a@b.c'
+        assert await Blog.findNumber('count(*)', '`user_id`=?', [user.id]) == 1
+
+    loop.run_until_complete(scenario())
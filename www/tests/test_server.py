@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse, itertools, signal
+
+import pytest
+
+from server import Supervisor
+
+class FakeSupervisor(Supervisor):
+    """不fork进程的Supervisor，记录发送的信号"""
+
+    def __init__(self, workers, ready=True):
+        super().__init__(argparse.Namespace(workers=workers))
+        self.ready = ready
+        self.killed = []
+        self._pids = itertools.count(100)
+
+    def spawn(self, slot=None):
+        if slot is None:
+            slot = self.free_slot()
+        self.workers[next(self._pids)] = slot
+        return None
+
+    def wait_ready(self, fds, timeout=30.0):
+        return self.ready
+
+    def kill(self, pid, sig):
+        self.killed.append((pid, sig))
+
+    def exit(self, pids):
+        """模拟worker退出并被回收"""
+        for pid in pids:
+            self.workers.pop(pid)
+            self.retiring.discard(pid)
+
+def test_reload_retires_old_workers():
+    sup = FakeSupervisor(2)
+    sup.spawn(), sup.spawn()
+    old = set(sup.workers)
+    assert sup.reload()
+    assert sup.retiring == old
+    assert sup.killed == [(pid, signal.SIGTERM) for pid in old]
+    assert sorted(sup.workers.values()) == [0, 1, 2, 3]
+
+def test_failed_reload_stops_new_workers():
+    sup = FakeSupervisor(2, ready=False)
+    sup.spawn(), sup.spawn()
+    old = set(sup.workers)
+    assert sup.reload()
+    new = set(sup.workers) - old
+    assert sup.retiring == new
+    assert {pid for pid, sig in sup.killed} == new
+
+def test_worker_slots_stay_in_range():
+    sup = FakeSupervisor(2)
+    sup.spawn(), sup.spawn()
+    for _ in range(3):
+        assert sup.reload()
+        assert not sup.reload()     # 上一代worker尚未退出时不重载
+        assert set(sup.workers.values()) <= set(range(4))
+        sup.exit(list(sup.retiring))
+    sup.spawn(), sup.spawn()
+    with pytest.raises(RuntimeError):   # 编号超出2 * workers会与其他主机的worker ID重叠
+        sup.spawn()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import ids, orm
+from orm import Model, StringField
+
+class Entry(Model):
+    __table__ = 'entries'
+
+    id = StringField(primary_key=True, default=ids.next_id_str, ddl='char(20)')
+    name = StringField()
+
+def test_concurrent_writes_are_group_committed(loop, db):
+    db(Entry)
+
+    async def scenario():
+        pool = vars(orm)['__pool']
+        batches, batched = pool.batches, pool.batched
+        await asyncio.gather(*[Entry(name='e%d' % i).save() for i in range(100)])
+        assert pool.batched - batched == 100
+        assert pool.batches - batches < 100     # 多条语句在同一次提交中写入
+        assert await Entry.findNumber('count(*)') == 100
+
+    loop.run_until_complete(scenario())
+
+def test_failing_statement_does_not_affect_its_batch(loop, db):
+    db(Entry)
+
+    async def scenario():
+        first = Entry(name='first')
+        await first.save()
+        results = await asyncio.gather(Entry(id=first.id, name='duplicate').save(), Entry(name='ok').save(),
+                                       return_exceptions=True)
+        assert isinstance(results[0], Exception) and results[1] is None
+        assert sorted(e.name for e in await Entry.findAll()) == ['first', 'ok']
+
+    loop.run_until_complete(scenario())
+
+def test_transaction_sees_its_own_writes(loop, db):
+    db(Entry)
+
+    async def scenario():
+        async with orm.transaction():
+            await Entry(name='inside').save()
+            assert await Entry.findNumber('count(*)') == 1
+        assert await Entry.findNumber('count(*)') == 1
+
+    loop.run_until_complete(scenario())